@@ -6,29 +6,49 @@ import sys
 import os
 import os.path
 import json
-import pickle
+import math
 import ConfigParser
+import threading
 
 # Libraries
 from epictree import *
+from sharding import shard_for_tree, shard_data_filename, shard_port, get_shard_argument, run_router, CONNECTIONS_PER_SHARD
+from snapshot import write_snapshot, read_manifest, segment_node_count, is_snapshot_file, load_snapshot
+from metrics import Registry, instrument_methods
+from profiler import SamplingProfiler
+from cache import ResponseCache
+from changefeed import ChangeFeed, ChangesHandler
+from rpc import RpcServer
+from timetravel import HistoryExpired
+from usage import QuotaExceeded
+from ratelimit import TokenBucketLimiter, parse_tenant_scales
+from serialiser import accepts_msgpack, encode_json, encode_msgpack, encode_level, encode_envelope, JSON_MIMETYPE, MSGPACK_MIMETYPE
 
 # External libraries
-from flask import Flask, jsonify, request
+from flask import Flask, request, g
 from flask.ext.cors import CORS
-from flask_limiter import Limiter
 import tornado.web
 import tornado.autoreload
 from tornado.wsgi import WSGIContainer
 from tornado.httpserver import HTTPServer
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.netutil import bind_unix_socket
 from tornado.log import enable_pretty_logging
 
 # Set up Flask/Tornado
 app = Flask(__name__)
-app.debug = True
 CORS(app)
-limiter = Limiter(app)
+limiter = TokenBucketLimiter(lambda: get_rate_limit_tenant(), lambda retry_after: rate_limited(retry_after))
 epicTree = None
+shard_index = None
+shard_count = 0
+profiler = SamplingProfiler()
+snapshot_thread = None
+MAX_DESCENDANT_PAIRS = 100000
+MAX_SUBTREE_LIMIT = 10000
+MAX_LOOKUPS = 1000
+LOOKUP_KINDS = ('level', 'breadcrumbs', 'root', 'path')
+MAX_RESERVED_IDS = 10000000
 
 # Read configuration file
 config = ConfigParser.ConfigParser()
@@ -36,6 +56,41 @@ config.read('config.ini')
 environment = config.get('Server', 'Environment')
 if environment is None or environment == '':
     environment = 'production'
+# Debug mode (and indented JSON) for development only
+app.debug = environment != 'production'
+
+def get_config(section, option, default=None):
+    """Read an optional configuration value (default if the section/option is missing or empty)"""
+    if not config.has_option(section, option):
+        return default
+    value = config.get(section, option)
+    if value is None or value == '':
+        return default
+    return value
+
+# Rate limits: per route and tree (see ratelimit.py), Scale multiplies every limit, Tenants per tree (154:10,165:0.5)
+limiter.configure(get_config('RateLimit', 'Enabled', 'true').lower() != 'false',
+                  float(get_config('RateLimit', 'Scale', 1)),
+                  parse_tenant_scales(get_config('RateLimit', 'Tenants')))
+
+# Unmanaged mode: the IDs callers don't send are allocated (see ids.py), blocks of BlockSize IDs at a time
+unmanaged = get_config('IDs', 'Mode', 'managed') == 'unmanaged'
+id_block_size = int(get_config('IDs', 'BlockSize', 1000))
+
+# Time travel: changes kept per segment (Size, 0 to disable) for at most Seconds (see timetravel.py)
+history_size = int(get_config('History', 'Size', 1000))
+history_seconds = float(get_config('History', 'Seconds', 86400))
+
+# Tiering (off by default, reads of frozen segments are slower): segments not written for IdleSeconds are frozen, checked
+# every CheckSeconds, at most MaxNodesPerCheck nodes at a time (~130ms per 100k nodes, see EpicTree.freeze_idle)
+freeze_idle_seconds = float(get_config('Tiering', 'IdleSeconds', 0))
+freeze_check_seconds = float(get_config('Tiering', 'CheckSeconds', 60))
+freeze_max_nodes = int(get_config('Tiering', 'MaxNodesPerCheck', 100000))
+
+# Quotas: MaxNodes / MaxBytes (estimated) per tree (0 to disable), Tenants scales them per tree (see usage.py)
+quota_max_nodes = int(get_config('Quotas', 'MaxNodes', 0))
+quota_max_bytes = int(get_config('Quotas', 'MaxBytes', 0))
+quota_tenant_scales = parse_tenant_scales(get_config('Quotas', 'Tenants'))
 
 # Set up logging
 logger = logging.getLogger()
@@ -47,6 +102,132 @@ logger.setLevel(logging.DEBUG)
 if environment == 'production':
     logger.setLevel(logging.ERROR)
 
+# region Metrics
+
+registry = Registry()
+route_latency = registry.histogram('epictree_http_request_duration_seconds', 'HTTP request latency', ('route', 'method'))
+route_responses = registry.counter('epictree_http_responses_total', 'HTTP responses by status code', ('route', 'code'))
+method_latency = registry.histogram('epictree_method_duration_seconds', 'EpicTree method latency', ('method',))
+method_errors = registry.counter('epictree_method_errors_total', 'EpicTree method exceptions', ('method',))
+serialise_latency = registry.histogram('epictree_serialise_duration_seconds', 'JSON response serialisation latency')
+persist_latency = registry.histogram('epictree_persist_duration_seconds', 'Persistence latency', ('mode',))
+
+INSTRUMENTED_METHODS = [
+    'add_tree', 'remove_tree', 'get_trees', 'get_segments', 'add_segment', 'remove_segment', 'duplicate_segment',
+    'get_segment_root_node', 'get_level', 'get_breadcrumbs', 'is_descendant', 'get_subtree', 'get_tree_from_node', 'get_tree_from_segment',
+    'get_tree', 'get_everything', 'add_directory', 'remove_directory', 'add_node', 'remove_node',
+    'clear_everything', 'persist_segments', '_re_sort_level', '_re_sort_item', '_increment_sort_after_item',
+    '_get_max_sort_at_level'
+]
+
+def count_segments_and_nodes():
+    segments = 0
+    nodes = 0
+    for tree_segments in epicTree.tree.values():
+        for segment_nodes in dict.values(tree_segments):
+            segments += 1
+            nodes += segment_node_count(segment_nodes)
+    return segments, nodes
+
+registry.gauge('epictree_trees', 'Number of trees', lambda: len(epicTree.tree))
+registry.gauge('epictree_segments', 'Number of segments', lambda: count_segments_and_nodes()[0])
+registry.gauge('epictree_nodes', 'Number of nodes', lambda: count_segments_and_nodes()[1])
+registry.gauge('epictree_materialised_paths', 'Size of the materialised paths list', lambda: len(epicTree.materialised_paths))
+registry.gauge('epictree_garbage', 'Nodes waiting for GC', lambda: len(epicTree.garbage))
+registry.gauge('epictree_frozen_segments', 'Segments frozen after being idle', lambda: len(epicTree.get_frozen_segments()))
+registry.gauge('epictree_dirty_segments', 'Segments changed since the last incremental persist', lambda: len(epicTree.dirty_segments))
+
+def enable_metrics():
+    """Instrument the EpicTree methods (nothing is wrapped, so there is no overhead, until this is called)"""
+    registry.enabled = True
+    instrument_methods(EpicTree, INSTRUMENTED_METHODS, method_latency, method_errors)
+    return
+
+@app.before_request
+def before_request_metrics():
+    if registry.enabled:
+        g.metrics_start = time.time()
+
+@app.after_request
+def after_request_metrics(response):
+    if registry.enabled and 'metrics_start' in g:
+        route = request.endpoint or 'unknown'
+        route_latency.observe(time.time() - g.metrics_start, (route, request.method))
+        route_responses.inc((route, str(response.status_code)))
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if not registry.enabled:
+        return error_not_found('Metrics are disabled (see [Metrics] in config.ini)')
+    return app.response_class(registry.render(), mimetype='text/plain; version=0.0.4')
+
+if get_config('Metrics', 'Enabled', 'false').lower() == 'true':
+    enable_metrics()
+
+# endregion
+
+# region Response cache
+
+response_cache = ResponseCache(int(get_config('Cache', 'Entries', 10000)))
+cache_lookups = registry.counter('epictree_cache_lookups_total', 'Response cache lookups', ('endpoint', 'result'))
+registry.gauge('epictree_cache_entries', 'Responses in the cache', lambda: len(response_cache))
+
+def cached_response(endpoint, tree_id, segment_id, node_id):
+    """Response with the cached body (in the format the client asked for), None on a miss"""
+    is_msgpack = accepts_msgpack(request.headers.get('Accept'))
+    body = response_cache.get((tree_id, segment_id, node_id, endpoint + ('.msgpack' if is_msgpack else '')))
+    if registry.enabled:
+        cache_lookups.inc((endpoint, 'miss' if body is None else 'hit'))
+    if body is None:
+        return None
+    return app.response_class(body, mimetype=MSGPACK_MIMETYPE if is_msgpack else JSON_MIMETYPE)
+
+def cache_response(endpoint, tree_id, segment_id, node_id, response, node_ids=None):
+    """Cache the body of a response, until one of node_ids (None: the segment itself) changes"""
+    if response.mimetype == MSGPACK_MIMETYPE:
+        endpoint += '.msgpack'
+    response_cache.put((tree_id, segment_id, node_id, endpoint), response.get_data(), node_ids)
+    return response
+
+# endregion
+
+# region Change feed
+
+change_feed = ChangeFeed(int(get_config('ChangeFeed', 'Size', 1000)))
+
+def read_changes(tree_id, segment_id, since=None, subtree_node_id=None, epoch=None):
+    """
+    Changes of a segment since a version (shared by the route below and the long-poll handler, see changefeed.py)
+    :return: (code, message, {'epoch': str, 'version': int, 'changes': []})
+    """
+    nodes, not_found = resolve_segment(tree_id, segment_id)
+    if nodes is None:
+        return 404, not_found, None
+    if subtree_node_id is not None and subtree_node_id not in nodes:
+        return 404, 'Node ' + str(subtree_node_id) + ' not found', None
+    if since is None:
+        since = epicTree.version
+    if since > epicTree.version or (epoch is not None and epoch != epicTree.epoch):
+        return 410, 'Unknown version (the service restarted), reload and subscribe again', None
+    changes = change_feed.read(tree_id, segment_id, since, subtree_node_id)
+    if changes is None:
+        return 410, 'Changes since version ' + str(since) + ' are no longer available, reload and subscribe again', None
+    return 200, 'OK', {'epoch': epicTree.epoch, 'version': epicTree.version, 'changes': changes}
+
+@app.route('/tree/<int:tree_id>/segment/<int:segment_id>/changes', methods=['GET'])
+@limiter.limit("100000/hour")
+def changes_get(tree_id, segment_id):
+    """Changes since a version, answers right away (the Tornado server long-polls instead, see changefeed.py)"""
+    since = request.args.get('since', None, type=int)
+    subtree_node_id = request.args.get('subtree', None, type=int)
+    code, message, result = read_changes(tree_id, segment_id, since, subtree_node_id, request.args.get('epoch'))
+    if code != 200:
+        return make_error(message, code)
+    return success(result)
+
+# endregion
+
 # region Trees
 
 @app.route('/tree', methods=['POST', 'DELETE'])
@@ -60,6 +241,9 @@ def tree():
     if 'tree_id' not in content:
         return make_error('Tree ID (tree_id) not sent (or incorrect format)', 400)
     tree_id = int(content['tree_id'])
+    # Sharded: only accept trees owned by this shard
+    if shard_index is not None and shard_for_tree(tree_id, shard_count) != shard_index:
+        return make_error('Tree ' + str(tree_id) + ' belongs to shard ' + str(shard_for_tree(tree_id, shard_count)), 421)
     # Execute tree operation
     try:
         if request.method == 'POST':
@@ -110,21 +294,31 @@ def segment_create(tree_id):
     content = request.json
     if content is None:
         return make_error('JSON body not sent', 400)
-    if 'segment_id' not in content:
+    if 'segment_id' not in content and not unmanaged:
         return make_error('Segment Id (segment_id) not sent (or incorrect format)', 400)
-    segment_id = int(content['segment_id'])
+    segment_id = None if 'segment_id' not in content else int(content['segment_id'])
     # Validate tree exists
     if tree_id not in epicTree.tree:
         return error_not_found('Tree ' + str(tree_id) + ' not found')
     # Execute tree operation
     try:
-        if 'root_node_id' not in content or not str(content['root_node_id']).isdigit():
+        if 'root_node_id' not in content and unmanaged:
+            root_node_id = None
+        elif 'root_node_id' not in content or not str(content['root_node_id']).isdigit():
             return make_error('Root Node Id (root_node_id) not sent (or incorrect format)', 400)
-        elif segment_id in epicTree.tree[tree_id]:
+        else:
+            root_node_id = int(content['root_node_id'])
+        if segment_id in epicTree.tree[tree_id]:
             return make_error('Segment ' + str(segment_id) + ' already exists for tree ' + str(tree_id), 409)
-        root_node_id = content['root_node_id']
+        # Unmanaged mode: IDs not sent are allocated
+        if segment_id is None:
+            segment_id = epicTree.allocate_segment_id()
+        if root_node_id is None:
+            root_node_id = epicTree.allocate_node_id()
         epicTree.add_segment(tree_id, segment_id, root_node_id)
-        return success(True)
+        return success({'segment_id': segment_id, 'root_node_id': root_node_id} if unmanaged else True)
+    except QuotaExceeded as inst:
+        return make_error(inst, 507)
     except KeyError as inst:
         return make_error(inst, 409)
     except Exception as inst:
@@ -138,12 +332,10 @@ def segment_remove(tree_id, segment_id):
         return make_error('Tree Id not sent (or incorrect format)', 400)
     if segment_id is None:
         return make_error('Segment Id not sent (or incorrect format)', 400)
-    # Validate tree exists
-    if tree_id not in epicTree.tree:
-        return error_not_found('Tree ' + str(tree_id) + ' not found')
-    # Validate segment exists
-    if segment_id not in epicTree.tree[tree_id]:
-        return error_not_found('Segment ' + str(segment_id) + ' not found')
+    # Validate tree and segment exist
+    nodes, not_found = resolve_segment(tree_id, segment_id)
+    if nodes is None:
+        return error_not_found(not_found)
     # Execute tree operation
     try:
         epicTree.remove_segment(tree_id, segment_id)
@@ -153,12 +345,35 @@ def segment_remove(tree_id, segment_id):
     except Exception as inst:
         return make_error(inst, 500)
 
-@app.route('/tree<int:tree_id>/segment/<int:segment_id>/duplicate', methods=['POST', 'PUT'])
+@app.route('/tree/<int:tree_id>/segment/<int:segment_id>/duplicate', methods=['POST', 'PUT'])
 @limiter.limit("10000/hour")
-def profile_duplicate(tree_id, segment_id):
-    # epicTree.duplicate_segment(tree_id, from_segment_id, to_segment_id, segment_structure):
-    # to_segment_id and segment_struture should be POST input, segment_structure = dict/tree
-    return make_error('not implemented', 400)
+def segment_duplicate(tree_id, segment_id):
+    # Get variables
+    content = request.json
+    if content is None:
+        return make_error('JSON body not sent', 400)
+    if 'to_segment_id' not in content and not unmanaged:
+        return make_error('Segment Id (to_segment_id) not sent (or incorrect format)', 400)
+    to_segment_id = None if 'to_segment_id' not in content else int(content['to_segment_id'])
+    # Validate tree and segment exist
+    nodes, not_found = resolve_segment(tree_id, segment_id)
+    if nodes is None:
+        return error_not_found(not_found)
+    if to_segment_id in epicTree.tree[tree_id]:
+        return make_error('Segment ' + str(to_segment_id) + ' already exists for tree ' + str(tree_id), 409)
+    # Execute tree operation
+    # TODO: segment_structure (new node IDs for the copy, a dict/tree in the POST input)
+    try:
+        if to_segment_id is None:
+            to_segment_id = epicTree.allocate_segment_id()
+        epicTree.duplicate_segment(tree_id, segment_id, to_segment_id, None)
+        return success(to_segment_id if unmanaged else True)
+    except QuotaExceeded as inst:
+        return make_error(inst, 507)
+    except KeyError as inst:
+        return make_error(inst, 409)
+    except Exception as inst:
+        return make_error(inst, 500)
 
 @app.route('/tree/<int:tree_id>/segment/<int:segment_id>/root', methods=['GET'])
 @limiter.limit("10000/hour")
@@ -168,15 +383,22 @@ def nodes_root(tree_id, segment_id):
         return make_error('Tree Id not sent (or incorrect format)', 400)
     if segment_id is None:
         return make_error('Segment Id not sent (or incorrect format)', 400)
-    # Validate tree exists
-    if tree_id not in epicTree.tree:
-        return error_not_found('Tree ' + str(tree_id) + ' not found')
-    # Validate segment exists
-    if segment_id not in epicTree.tree[tree_id]:
-        return error_not_found('Segment ' + str(segment_id) + ' not found')
+    etag = make_etag(epicTree.get_segment_version(tree_id, segment_id))
+    if is_not_modified(etag):
+        return not_modified(etag)
+    cached = cached_response('root', tree_id, segment_id, None)
+    if cached is not None:
+        cached.set_etag(etag)
+        return cached
+    # Validate tree and segment exist
+    nodes, not_found = resolve_segment(tree_id, segment_id)
+    if nodes is None:
+        return error_not_found(not_found)
     try:
-        root_node_id = epicTree.get_segment_root_node(tree_id, segment_id)
-        return success(root_node_id)
+        root_node_id = epicTree.get_segment_root_node(tree_id, segment_id, nodes)
+        response = success(root_node_id)
+        response.set_etag(etag)
+        return cache_response('root', tree_id, segment_id, None, response)
     except KeyError as inst:
         return error_not_found(inst)
     except Exception as inst:
@@ -194,24 +416,36 @@ def get_level(tree_id, segment_id, parent_node_id):
         return make_error('Tree Id not sent (or incorrect format)', 400)
     if segment_id is None:
         return make_error('Segment Id not sent (or incorrect format)', 400)
-    # Validate tree exists
-    if tree_id not in epicTree.tree:
-        return error_not_found('Tree ' + str(tree_id) + ' not found')
-    # Validate segment exists
-    if segment_id not in epicTree.tree[tree_id]:
-        return error_not_found('Segment ' + str(segment_id) + ' not found')
+    version, timestamp, error = get_as_of_arguments()
+    if error is not None:
+        return error
+    if version is not None or timestamp is not None:
+        # Time travel: the level as it was (no ETag / cache)
+        nodes, error = resolve_segment_as_of(tree_id, segment_id, version, timestamp)
+        if error is not None:
+            return error
+        if parent_node_id not in nodes:
+            return error_not_found('Parent node ' + str(parent_node_id) + ' not found')
+        return success_level(epicTree.get_level(tree_id, segment_id, parent_node_id, nodes))
+    etag = make_etag(epicTree.get_level_version(tree_id, segment_id, parent_node_id))
+    if is_not_modified(etag):
+        return not_modified(etag)
+    cached = cached_response('level', tree_id, segment_id, parent_node_id)
+    if cached is not None:
+        cached.set_etag(etag)
+        return cached
+    # Validate tree and segment exist
+    nodes, not_found = resolve_segment(tree_id, segment_id)
+    if nodes is None:
+        return error_not_found(not_found)
     # Validate parent node exists
-    if parent_node_id not in epicTree.tree[tree_id][segment_id]:
+    if parent_node_id not in nodes:
         return error_not_found('Parent node ' + str(parent_node_id) + ' not found')
     try:
-        children = epicTree.get_level(tree_id, segment_id, parent_node_id)
-        results = []
-        for child_dict in children:
-            child_id = child_dict['id']
-            child = child_dict['child']
-            result = make_simple_node(child_id, child)
-            results.append(result)
-        return success(results)
+        children = epicTree.get_level(tree_id, segment_id, parent_node_id, nodes)
+        response = success_level(children)
+        response.set_etag(etag)
+        return cache_response('level', tree_id, segment_id, parent_node_id, response, [parent_node_id])
     except KeyError as inst:
         return error_not_found(inst)
     except Exception as inst:
@@ -227,36 +461,235 @@ def breadcrumbs(tree_id, segment_id, node_id):
         return make_error('Segment Id not sent (or incorrect format)', 400)
     if node_id is None:
         return make_error('Node Id not sent (or incorrect format)', 400)
-    # Validate tree exists
-    if tree_id not in epicTree.tree:
-        return error_not_found('Tree ' + str(tree_id) + ' not found')
-    # Validate segment exists
-    if segment_id not in epicTree.tree[tree_id]:
-        return error_not_found('Segment ' + str(segment_id) + ' not found')
+    etag = make_etag(epicTree.get_breadcrumbs_version(tree_id, segment_id, node_id))
+    if is_not_modified(etag):
+        return not_modified(etag)
+    cached = cached_response('breadcrumbs', tree_id, segment_id, node_id)
+    if cached is not None:
+        cached.set_etag(etag)
+        return cached
+    # Validate tree and segment exist
+    nodes, not_found = resolve_segment(tree_id, segment_id)
+    if nodes is None:
+        return error_not_found(not_found)
+    # Validate node exists
+    if node_id not in nodes:
+        return error_not_found('Node ' + str(node_id) + ' not found')
+    try:
+        crumbs = epicTree.get_breadcrumbs(tree_id, segment_id, node_id, nodes)
+        response = success(crumbs)
+        response.set_etag(etag)
+        return cache_response('breadcrumbs', tree_id, segment_id, node_id, response, crumbs[:-1])
+    except KeyError as inst:
+        return error_not_found(inst)
+    except Exception as inst:
+        return make_error(inst, 500)
+
+@app.route('/tree/<int:tree_id>/segment/<int:segment_id>/descendants', methods=['POST'])
+@limiter.limit("20000/hour")
+def descendants(tree_id, segment_id):
+    """Bulk ancestor checks: pairs [[node_id, ancestor_node_id], ...] => [true if node_id is under ancestor_node_id]"""
+    # Get variables
+    content = request.json
+    if content is None:
+        return make_error('JSON body not sent', 400)
+    pairs = content.get('pairs')
+    if not isinstance(pairs, list):
+        return make_error('Pairs (pairs) not sent (or incorrect format)', 400)
+    if len(pairs) > MAX_DESCENDANT_PAIRS:
+        return make_error('At most ' + str(MAX_DESCENDANT_PAIRS) + ' pairs per request', 400)
+    # Validate tree and segment exist
+    nodes, not_found = resolve_segment(tree_id, segment_id)
+    if nodes is None:
+        return error_not_found(not_found)
+    try:
+        results = []
+        for node_id, ancestor_node_id in pairs:
+            results.append(epicTree.is_descendant(tree_id, segment_id, int(node_id), int(ancestor_node_id), nodes))
+        return success(results)
+    except (TypeError, ValueError):
+        return make_error('Pairs must be [node_id, ancestor_node_id] lists of IDs', 400)
+    except Exception as inst:
+        return make_error(inst, 500)
+
+@app.route('/tree/<int:tree_id>/segment/<int:segment_id>/subtree/<int:node_id>', methods=['GET'])
+@limiter.limit("50000/hour")
+def subtree(tree_id, segment_id, node_id):
+    """Nodes under a node, filtered by type (type=a,b) and depth (min_depth, max_depth), at most limit of them"""
+    # Get variables
+    node_types = request.args.get('type')
+    if node_types is not None:
+        node_types = node_types.split(',')
+    try:
+        min_depth = int(request.args.get('min_depth', 1))
+        max_depth = request.args.get('max_depth')
+        max_depth = None if max_depth is None else int(max_depth)
+        limit = int(request.args.get('limit', 1000))
+    except ValueError:
+        return make_error('min_depth, max_depth and limit must be numbers', 400)
+    if min_depth < 0 or (max_depth is not None and max_depth < min_depth):
+        return make_error('Depths must be 0 <= min_depth <= max_depth', 400)
+    if limit < 1 or limit > MAX_SUBTREE_LIMIT:
+        return make_error('Limit must be between 1 and ' + str(MAX_SUBTREE_LIMIT), 400)
+    # Validate tree and segment exist
+    nodes, not_found = resolve_segment(tree_id, segment_id)
+    if nodes is None:
+        return error_not_found(not_found)
     # Validate node exists
-    if node_id not in epicTree.tree[tree_id][segment_id]:
+    if node_id not in nodes:
         return error_not_found('Node ' + str(node_id) + ' not found')
     try:
-        crumbs = epicTree.get_breadcrumbs(tree_id, segment_id, node_id)
-        return success(crumbs)
+        results = epicTree.get_subtree(tree_id, segment_id, node_id, node_types, min_depth, max_depth, limit, nodes)
+        output = []
+        for result in results:
+            node = make_simple_node(result['id'], result['child'])
+            node['parent'] = result['child'][0]
+            node['depth'] = result['depth']
+            output.append(node)
+        return success(output)
     except KeyError as inst:
         return error_not_found(inst)
     except Exception as inst:
         return make_error(inst, 500)
 
+@app.route('/tree/<int:tree_id>/lookup', methods=['POST'])
+@limiter.limit("20000/hour")
+def lookup(tree_id):
+    """
+    Multi-get: lookups [[segment_id, node_id, kind], ...] (kind: level, breadcrumbs, root or path) answered in one
+    response, all from the same version of the tree (nothing changes while the lookups run)
+    """
+    # Get variables
+    content = request.json
+    if content is None:
+        return make_error('JSON body not sent', 400)
+    lookups = content.get('lookups')
+    if not isinstance(lookups, list):
+        return make_error('Lookups (lookups) not sent (or incorrect format)', 400)
+    if len(lookups) > MAX_LOOKUPS:
+        return make_error('At most ' + str(MAX_LOOKUPS) + ' lookups per request', 400)
+    try:
+        lookups = [(int(segment_id), None if node_id is None else int(node_id), kind) for segment_id, node_id, kind in lookups]
+    except (TypeError, ValueError):
+        return make_error('Lookups must be [segment_id, node_id, kind] lists', 400)
+    for segment_id, node_id, kind in lookups:
+        if kind not in LOOKUP_KINDS:
+            return make_error('Kind must be one of ' + ', '.join(LOOKUP_KINDS), 400)
+        if node_id is None and kind != 'root':
+            return make_error('Node Id not sent for a ' + str(kind) + ' lookup', 400)
+    # Validate tree exists
+    if tree_id not in epicTree.tree:
+        return error_not_found('Tree ' + str(tree_id) + ' not found')
+    try:
+        # Every segment resolved once
+        segments = {}
+        results = []
+        for segment_id, node_id, kind in lookups:
+            if segment_id not in segments:
+                segments[segment_id] = resolve_segment(tree_id, segment_id)
+            results.append(lookup_one(tree_id, segment_id, node_id, kind, segments[segment_id]))
+        return success({'version': epicTree.version, 'results': results})
+    except Exception as inst:
+        return make_error(inst, 500)
+
 @app.route('/tree/<int:tree_id>/segment/<int:segment_id>', methods=['GET'])
 @limiter.limit("50000/hour")
 def segment_get(tree_id, segment_id):
-    # GET TREE (for a segment)
-    # TODO
-    return make_error('not implemented ' + str(segment_id), 400)
+    """Tree of a segment (from its root, or from node), depth levels deep (all if not set)"""
+    # Get variables
+    depth, error = get_depth_argument()
+    if error is not None:
+        return error
+    node_id = request.args.get('node', None, type=int)
+    version, timestamp, error = get_as_of_arguments()
+    if error is not None:
+        return error
+    # Validate tree and segment exist (as they were, with as_of / as_of_time)
+    nodes, error = resolve_segment_as_of(tree_id, segment_id, version, timestamp)
+    if error is not None:
+        return error
+    if node_id is None:
+        node_id = epicTree.get_segment_root_node(tree_id, segment_id, nodes)
+    # Validate node exists
+    if node_id not in nodes:
+        return error_not_found('Node ' + str(node_id) + ' not found')
+    try:
+        return success(epicTree.get_tree_from_node(tree_id, segment_id, node_id, depth, nodes))
+    except KeyError as inst:
+        return error_not_found(inst)
+    except Exception as inst:
+        return make_error(inst, 500)
+
+@app.route('/tree/<int:tree_id>/segment/<int:segment_id>/diff', methods=['GET'])
+@limiter.limit("10000/hour")
+def segment_diff(tree_id, segment_id):
+    """
+    What changed in a segment: since another segment (from), since a version / time (as_of, as_of_time), or since a
+    backup snapshot file next to the data file (file, from_segment: the segment in it, default the same)
+    """
+    # Get variables
+    from_segment_id = request.args.get('from', None, type=int)
+    filename = request.args.get('file')
+    version, timestamp, error = get_as_of_arguments()
+    if error is not None:
+        return error
+    sources = [x for x in (from_segment_id, filename, version if timestamp is None else timestamp) if x is not None]
+    if len(sources) != 1:
+        return make_error('One of from (segment ID), as_of / as_of_time or file must be set', 400)
+    # Validate tree and segment exist
+    nodes, not_found = resolve_segment(tree_id, segment_id)
+    if nodes is None:
+        return error_not_found(not_found)
+    try:
+        if from_segment_id is not None:
+            if from_segment_id not in epicTree.tree[tree_id]:
+                return error_not_found('Segment ' + str(from_segment_id) + ' not found')
+            result = epicTree.diff_segments(tree_id, from_segment_id, segment_id)
+        elif filename is not None:
+            filename, error = resolve_data_file(filename)
+            if error is not None:
+                return error
+            if not os.path.isfile(filename) or not is_snapshot_file(filename):
+                return error_not_found('Snapshot file ' + os.path.basename(filename) + ' not found')
+            from_nodes = load_snapshot(filename).get(tree_id, {}).get(request.args.get('from_segment', segment_id, type=int))
+            if from_nodes is None:
+                return error_not_found('Segment not found in ' + os.path.basename(filename))
+            result = epicTree.diff_from_nodes(from_nodes, tree_id, segment_id)
+        else:
+            result = epicTree.diff_as_of(tree_id, segment_id, version, timestamp)
+        result['version'] = epicTree.version
+        return success(result)
+    except HistoryExpired as inst:
+        return make_error(inst, 410)
+    except KeyError as inst:
+        return error_not_found(inst)
+    except Exception as inst:
+        return make_error(inst, 500)
 
 @app.route('/tree/<int:tree_id>', methods=['GET'])
 @limiter.limit("40000/hour")
 def tree_get(tree_id):
-    # GET TREE (for a full tree ID)
-    # TODO
-    return make_error('not implemented ' + str(tree_id), 400)
+    """Trees of every segment ({segment_id: tree}), or of a directory left out earlier (expand token)"""
+    # Get variables
+    depth, error = get_depth_argument()
+    if error is not None:
+        return error
+    expand = request.args.get('expand')
+    # Validate tree exists
+    if tree_id not in epicTree.tree:
+        return error_not_found('Tree ' + str(tree_id) + ' not found')
+    try:
+        if expand is None:
+            return success(epicTree.get_tree(tree_id, depth))
+        try:
+            segment_id, node_id = parse_expand_token(expand)
+        except ValueError:
+            return make_error('Expand token (expand) is not valid', 400)
+        return success(epicTree.get_tree_from_node(tree_id, segment_id, node_id, depth))
+    except KeyError as inst:
+        return error_not_found(inst)
+    except Exception as inst:
+        return make_error(inst, 500)
 
 @app.route('/tree', methods=['GET'])
 @limiter.limit("200000/hour")
@@ -284,30 +717,32 @@ def directory_add(tree_id, segment_id):
     if 'parent_node_id' not in content:
         return make_error('Parent Node Id (parent_node_id) not sent (or incorrect format)', 400)
     parent_node_id = int(content['parent_node_id'])
-    if 'node_id' not in content:
-        return make_error('Node Id (parent_node_id) not sent (or incorrect format)', 400)
-    node_id = int(content['node_id'])
+    if 'node_id' not in content and not unmanaged:
+        return make_error('Node Id (node_id) not sent (or incorrect format)', 400)
+    node_id = None if 'node_id' not in content else int(content['node_id'])
     position = None
     if 'position' in content:
         position = int(content['position'])
         if position < 1:
             return make_error('Position can\'t be less than 1', 400)
-    # Validate tree exists
-    if tree_id not in epicTree.tree:
-        return error_not_found('Tree ' + str(tree_id) + ' not found')
-    # Validate segment exists
-    if segment_id not in epicTree.tree[tree_id]:
-        return error_not_found('Segment ' + str(segment_id) + ' not found')
+    # Validate tree and segment exist
+    nodes, not_found = resolve_segment(tree_id, segment_id)
+    if nodes is None:
+        return error_not_found(not_found)
     # Validate parent exists
-    if parent_node_id not in epicTree.tree[tree_id][segment_id]:
+    if parent_node_id not in nodes:
         return error_not_found('Parent Node ' + str(node_id) + ' not found')
     # Validate directory does not exist
-    if node_id in epicTree.tree[tree_id][segment_id]:
+    if node_id in nodes:
         return error_not_found('An item with Node Id ' + str(node_id) + ' already exists')
     # Execute tree operation
     try:
-        epicTree.add_directory(tree_id, segment_id, parent_node_id, node_id, position, None)
-        return success(True)
+        if node_id is None:
+            node_id = epicTree.allocate_node_id()
+        epicTree.add_directory(tree_id, segment_id, parent_node_id, node_id, position, None, nodes)
+        return success(node_id if unmanaged else True)
+    except QuotaExceeded as inst:
+        return make_error(inst, 507)
     except KeyError as inst:
         return make_error(inst, 409)
     except Exception as inst:
@@ -323,18 +758,16 @@ def directory_remove(tree_id, segment_id, node_id):
         return make_error('Segment Id not sent (or incorrect format)', 400)
     if node_id is None:
         return make_error('Directory Id (node_id) not sent (or incorrect format)', 400)
-    # Validate tree exists
-    if tree_id not in epicTree.tree:
-        return error_not_found('Tree ' + str(tree_id) + ' not found')
-    # Validate segment exists
-    if segment_id not in epicTree.tree[tree_id]:
-        return error_not_found('Segment ' + str(segment_id) + ' not found')
+    # Validate tree and segment exist
+    nodes, not_found = resolve_segment(tree_id, segment_id)
+    if nodes is None:
+        return error_not_found(not_found)
     # Validate directory exists
-    if node_id not in epicTree.tree[tree_id][segment_id]:
+    if node_id not in nodes:
         return error_not_found('Directory ' + str(node_id) + ' not found')
     # Execute tree operation
     try:
-        epicTree.remove_directory(tree_id, segment_id, node_id)
+        epicTree.remove_directory(tree_id, segment_id, node_id, nodes)
         return success(True)
     except KeyError as inst:
         return error_not_found(inst)
@@ -372,9 +805,9 @@ def node_add(tree_id, segment_id):
     if 'parent_node_id' not in content:
         return make_error('Parent Node Id (parent_node_id) not sent (or incorrect format)', 400)
     parent_node_id = int(content['parent_node_id'])
-    if 'node_id' not in content:
-        return make_error('Node Id (parent_node_id) not sent (or incorrect format)', 400)
-    node_id = int(content['node_id'])
+    if 'node_id' not in content and not unmanaged:
+        return make_error('Node Id (node_id) not sent (or incorrect format)', 400)
+    node_id = None if 'node_id' not in content else int(content['node_id'])
     position = None
     if 'position' in content:
         position = int(content['position'])
@@ -383,27 +816,32 @@ def node_add(tree_id, segment_id):
     if 'type' not in content:
         return make_error('Node Type (type) not sent (or incorrect format)', 400)
     node_type = content['type']
+    # Stored in the snapshot's type table (see snapshot.write_segment)
+    if not isinstance(node_type, basestring) or node_type == '':
+        return make_error('Node Type (type) must be a non-empty string', 400)
     if node_type == 'dir' or node_type == 'root':
         return make_error('Node Type can\'t be root or dir, use the other endpoints to create these types', 400)
     if 'payload' not in content:
         return make_error('Payload (payload) not sent (or incorrect format)', 400)
     payload = content['payload']
-    # Validate tree exists
-    if tree_id not in epicTree.tree:
-        return error_not_found('Tree ' + str(tree_id) + ' not found')
-    # Validate segment exists
-    if segment_id not in epicTree.tree[tree_id]:
-        return error_not_found('Segment ' + str(segment_id) + ' not found')
+    # Validate tree and segment exist
+    nodes, not_found = resolve_segment(tree_id, segment_id)
+    if nodes is None:
+        return error_not_found(not_found)
     # Validate parent exists
-    if parent_node_id not in epicTree.tree[tree_id][segment_id]:
+    if parent_node_id not in nodes:
         return error_not_found('Parent Node ' + str(node_id) + ' not found')
     # Validate node does not exist
-    if node_id in epicTree.tree[tree_id][segment_id]:
+    if node_id in nodes:
         return error_not_found('Node with Id ' + str(node_id) + ' already exists')
     # Execute tree operation
     try:
-        epicTree.add_node(tree_id, segment_id, parent_node_id, node_id, position, None, node_type, payload)
-        return success(True)
+        if node_id is None:
+            node_id = epicTree.allocate_node_id()
+        epicTree.add_node(tree_id, segment_id, parent_node_id, node_id, position, None, node_type, payload, nodes)
+        return success(node_id if unmanaged else True)
+    except QuotaExceeded as inst:
+        return make_error(inst, 507)
     except KeyError as inst:
         return make_error(inst, 409)
     except Exception as inst:
@@ -419,18 +857,16 @@ def node_delete(tree_id, segment_id, node_id):
         return make_error('Segment Id not sent (or incorrect format)', 400)
     if node_id is None:
         return make_error('Node Id (node_id) not sent (or incorrect format)', 400)
-    # Validate tree exists
-    if tree_id not in epicTree.tree:
-        return error_not_found('Tree ' + str(tree_id) + ' not found')
-    # Validate segment exists
-    if segment_id not in epicTree.tree[tree_id]:
-        return error_not_found('Segment ' + str(segment_id) + ' not found')
+    # Validate tree and segment exist
+    nodes, not_found = resolve_segment(tree_id, segment_id)
+    if nodes is None:
+        return error_not_found(not_found)
     # Validate directory exists
-    if node_id not in epicTree.tree[tree_id][segment_id]:
+    if node_id not in nodes:
         return error_not_found('Node ' + str(node_id) + ' not found')
     # Execute tree operation
     try:
-        epicTree.remove_node(tree_id, segment_id, node_id)
+        epicTree.remove_node(tree_id, segment_id, node_id, nodes)
         return success(True)
     except KeyError as inst:
         return error_not_found(inst)
@@ -451,6 +887,41 @@ def level_add(tree_id, segment_id, parent_node_id):
 
 # endregion
 
+# region IDs
+
+@app.route('/ids', methods=['POST'])
+@limiter.limit("5000/hour")
+def ids_reserve():
+    """
+    Reserve a range of node / segment IDs (batch imports in unmanaged mode): {"first": ..., "last": ...}
+    With sharding every shard has its own IDs: tree_id (the tree they are for) is required, the router sends it to its shard
+    """
+    # Get variables
+    content = request.json
+    if content is None:
+        return make_error('JSON body not sent', 400)
+    if shard_index is not None:
+        if not str(content.get('tree_id')).isdigit():
+            return make_error('Tree ID (tree_id) not sent (or incorrect format), IDs are reserved per shard', 400)
+        tree_id = int(content['tree_id'])
+        if shard_for_tree(tree_id, shard_count) != shard_index:
+            return make_error('Tree ' + str(tree_id) + ' belongs to shard ' + str(shard_for_tree(tree_id, shard_count)), 421)
+    kind = content.get('kind', 'node')
+    if kind not in ('node', 'segment'):
+        return make_error('Kind (kind) must be node or segment', 400)
+    if not str(content.get('count')).isdigit():
+        return make_error('Count (count) not sent (or incorrect format)', 400)
+    count = int(content['count'])
+    if count < 1 or count > MAX_RESERVED_IDS:
+        return make_error('Count must be between 1 and ' + str(MAX_RESERVED_IDS), 400)
+    try:
+        first, last = epicTree.reserve_ids(kind, count)
+        return success({'first': first, 'last': last})
+    except Exception as inst:
+        return make_error(inst, 500)
+
+# endregion
+
 # region Generic, Persist and Cleanup
 
 @app.route('/clear', methods=['POST'])
@@ -468,22 +939,43 @@ def persist_tree():
     """Public method to persist the tree, can be made private if not called externally.
     The inspiration for this was to call this through cron or something to persist the tree"""
     # Get variables
-    data_filename = config.get('Files', 'DataFile')
+    data_filename = get_data_filename()
     content = request.json
     if content is not None and 'filename' in content:
-        data_filename = content['filename']
+        data_filename, error = resolve_data_file(content['filename'])
+        if error is not None:
+            return error
     try:
-        pickle.dump(epicTree.tree, open(data_filename, "wb"), pickle.HIGHEST_PROTOCOL)
+        start = time.time()
+        # Incremental mode: only the segments that changed since the last persist are re-written
+        if get_segments_directory() is not None and (content is None or 'filename' not in content):
+            epicTree.persist_segments(get_segments_directory())
+            if registry.enabled:
+                persist_latency.observe(time.time() - start, ('incremental',))
+            return success(True)
+        write_snapshot(epicTree.tree, data_filename, epicTree.get_meta())
+        if registry.enabled:
+            persist_latency.observe(time.time() - start, ('full',))
         return success(True)
     except Exception as inst:
         return make_error(inst, 500)
 
 def init_from_filesystem(filename=None):
-    """Load and initialise the tree using a pickled data file for the tree"""
+    """Load and initialise the tree using a snapshot data file for the tree (see snapshot.py)"""
     global epicTree
-    data_filename = config.get('Files', 'DataFile')
+    data_filename = get_data_filename()
     if filename is not None:
         data_filename = filename
+    # Incremental mode: load the segments directory once it has been persisted to (until then, the data file)
+    segments_directory = get_segments_directory()
+    if filename is None and segments_directory is not None:
+        if not os.path.isdir(segments_directory):
+            os.makedirs(segments_directory)
+        if read_manifest(segments_directory) is not None:
+            epicTree = EpicTree(segments_directory)
+            attach_listeners()
+            print 'Loaded tree from segments directory!'
+            return
     # No file with this name? Die!
     if not os.path.isfile(data_filename):
         print 'Data file does not exist (new setup? create a blank file called ' + data_filename + ')'
@@ -492,10 +984,11 @@ def init_from_filesystem(filename=None):
     if os.stat(data_filename).st_size == 0:
         print 'Data file is empty, initialising file with an empty tree'
         temp_tree = EpicTree()
-        pickle.dump(temp_tree.tree, open(data_filename, "wb"), pickle.HIGHEST_PROTOCOL)
+        write_snapshot(temp_tree.tree, data_filename)
     # Load the file into a new tree object
     try:
         epicTree = EpicTree(data_filename)
+        attach_listeners()
         print 'Loaded tree from filesystem!'
     except Exception as inst:
         print 'Error loading initial state from data file:'
@@ -503,10 +996,103 @@ def init_from_filesystem(filename=None):
         exit(1)
     return
 
+def publish_snapshot():
+    """
+    Write the read-only snapshot that other processes mmap (see snapshot.py)
+    The tree is pinned (see mvcc.py) and written in a thread: requests keep changing it meanwhile
+    """
+    global snapshot_thread
+    snapshot_filename = get_config('Snapshot', 'File')
+    if snapshot_filename is None:
+        return
+    if shard_index is not None:
+        snapshot_filename = shard_data_filename(snapshot_filename, shard_index)
+    # Still writing the previous one
+    if snapshot_thread is not None and snapshot_thread.is_alive():
+        return
+    pinned = epicTree.pin()
+    snapshot_thread = threading.Thread(target=write_pinned_snapshot, args=(pinned, snapshot_filename, epicTree.get_meta()))
+    snapshot_thread.daemon = True
+    snapshot_thread.start()
+    return
+
+def write_pinned_snapshot(pinned, snapshot_filename, meta):
+    start = time.time()
+    try:
+        write_snapshot(pinned.tree, snapshot_filename, meta)
+        if registry.enabled:
+            persist_latency.observe(time.time() - start, ('snapshot',))
+        logger.debug('Published snapshot ' + snapshot_filename + ' (version ' + str(pinned.version) + ') in ' +
+                     str(time.time() - start) + 's')
+    except Exception as inst:
+        logger.error('Error publishing snapshot: ' + str(inst))
+    finally:
+        pinned.release()
+    return
+
+def freeze_idle_segments():
+    """Freeze the segments not written for [Tiering] IdleSeconds (compact, read-only until the next write), a batch per call"""
+    start = time.time()
+    frozen = epicTree.freeze_idle(freeze_idle_seconds, max_nodes=freeze_max_nodes)
+    if frozen > 0:
+        logger.debug('Froze ' + str(frozen) + ' idle segments in ' + str(time.time() - start) + 's')
+    return
+
+def get_segments_directory():
+    """Directory for incremental persistence (one file per segment), None if not configured"""
+    segments_directory = get_config('Files', 'SegmentsDirectory')
+    if segments_directory is not None and shard_index is not None:
+        segments_directory = shard_data_filename(segments_directory, shard_index)
+    return segments_directory
+
+def get_data_filename():
+    """Data file from the config (each shard has its own file when sharded)"""
+    data_filename = config.get('Files', 'DataFile')
+    if shard_index is not None:
+        data_filename = shard_data_filename(data_filename, shard_index)
+    return data_filename
+
+def start_rpc_server():
+    """Binary RPC (see rpc.py) on the same IOLoop and tree as the HTTP API, if [RPC] Port and/or Socket are set"""
+    rpc_port = get_config('RPC', 'Port')
+    rpc_socket = get_config('RPC', 'Socket')
+    if rpc_port is None and rpc_socket is None:
+        return
+    rpc_server = RpcServer(lambda: epicTree, None if shard_index is None else (shard_index, shard_count))
+    if rpc_port is not None:
+        # Shards listen on the ports right after it
+        rpc_port = int(rpc_port) + (shard_index or 0)
+        rpc_server.listen(rpc_port, get_config('RPC', 'Host', '127.0.0.1'))
+    if rpc_socket is not None:
+        if shard_index is not None:
+            rpc_socket = shard_data_filename(rpc_socket, shard_index)
+        rpc_server.add_socket(bind_unix_socket(rpc_socket))
+    return
+
+def attach_listeners():
+    """Keep the response cache and the change feed in sync with the mutations of the (new) tree, apply the ID and quota settings"""
+    epicTree.ids.block_size = id_block_size
+    epicTree.history.size = history_size
+    epicTree.history.max_age = history_seconds
+    epicTree.set_quotas(quota_max_nodes, quota_max_bytes, quota_tenant_scales)
+    response_cache.clear()
+    change_feed.clear()
+    epicTree.add_listener(lambda tree_id, segment_id, node_ids, change: response_cache.invalidate(tree_id, segment_id, node_ids))
+    epicTree.add_listener(change_feed.record)
+    epicTree.add_listener(forget_removed_tree)
+    return
+
+def forget_removed_tree(tree_id, segment_id, node_ids, change):
+    """Listener: a removed tree's rate limit buckets go with it"""
+    if change['op'] == 'remove_tree':
+        limiter.forget(tree_id)
+    return
+
 def init():
     """Load an initialise an empty tree (for testing purposes, etc.)"""
     global epicTree
     epicTree = EpicTree()
+    attach_listeners()
     return
 
 def load_example_tree():
@@ -529,10 +1115,69 @@ def load_example_tree():
         165: {
             }
     }
+    response_cache.clear()
+    change_feed.clear()
     return
 
 # endregion
 
+# region Admin
+
+@app.route('/admin/usage', methods=['GET'])
+@limiter.limit("1000/hour")
+def usage_get():
+    """Approximate nodes / memory and quota of every tree, largest first (tree_id=: one tree, with its segments)"""
+    tree_id = request.args.get('tree_id', None, type=int)
+    if tree_id is not None:
+        if tree_id not in epicTree.tree:
+            return error_not_found('Tree ' + str(tree_id) + ' not found')
+        usage = epicTree.get_usage(tree_id, True)
+        usage['segments'] = [dict(segment_id=x, **y) for x, y in sorted(usage['segments'].items())]
+        return success(dict(tree_id=tree_id, **usage))
+    trees = [dict(tree_id=x, **epicTree.get_usage(x)) for x in epicTree.get_trees()]
+    trees.sort(key=lambda x: x['bytes'], reverse=True)
+    return success({
+        'nodes': sum(x['nodes'] for x in trees),
+        'bytes': sum(x['bytes'] for x in trees),
+        'trees': trees
+    })
+
+@app.route('/admin/profile', methods=['POST'])
+@limiter.limit("100/hour")
+def profile_start():
+    """Start the sampling profiler for a bounded window (the service keeps running)"""
+    content = request.get_json(silent=True) or {}
+    try:
+        duration = float(content.get('duration', 10))
+        interval = float(content.get('interval', 0.005))
+    except (TypeError, ValueError):
+        return make_error('Duration (duration) and interval (interval) must be numbers (seconds)', 400)
+    if duration <= 0 or interval <= 0:
+        return make_error('Duration and interval must be greater than 0', 400)
+    if not profiler.start(duration, interval):
+        return make_error('The profiler is already running', 409)
+    return success(profiler.status())
+
+@app.route('/admin/profile', methods=['GET'])
+@limiter.limit("1000/hour")
+def profile_get():
+    """Profiler status + collapsed stacks (format=collapsed returns plain text for flamegraph.pl)"""
+    limit = request.args.get('limit', None, type=int)
+    if request.args.get('format') == 'collapsed':
+        return app.response_class('\n'.join(profiler.collapsed(limit)) + '\n', mimetype='text/plain')
+    result = profiler.status()
+    result['stacks'] = profiler.collapsed(limit)
+    return success(result)
+
+@app.route('/admin/profile', methods=['DELETE'])
+@limiter.limit("100/hour")
+def profile_stop():
+    """Stop the profiler early (results are kept until the next start)"""
+    profiler.stop()
+    return success(profiler.status())
+
+# endregion
+
 # region HTTP Response Handler
 
 def success(obj):
@@ -543,8 +1188,59 @@ def success(obj):
         },
         'response': obj
     }
-    response = jsonify(response)
-    response.status_code = 200
+    return make_response(response, 200)
+
+def success_level(children):
+    """success() for EpicTree.get_level output, compact JSON is written straight from the node tuples"""
+    if app.debug or accepts_msgpack(request.headers.get('Accept')):
+        return success([make_simple_node(child['id'], child['child']) for child in children])
+    start = time.time()
+    body = encode_envelope(encode_level(children))
+    if registry.enabled:
+        serialise_latency.observe(time.time() - start)
+    return app.response_class(body, status=200, mimetype=JSON_MIMETYPE)
+
+def make_response(obj, code):
+    """Serialise a response envelope: MessagePack if the client accepts it, JSON otherwise (compact in production)"""
+    start = time.time()
+    if accepts_msgpack(request.headers.get('Accept')):
+        response = app.response_class(encode_msgpack(obj), status=code, mimetype=MSGPACK_MIMETYPE)
+    else:
+        response = app.response_class(encode_json(obj, not app.debug), status=code, mimetype=JSON_MIMETYPE)
+    if registry.enabled:
+        serialise_latency.observe(time.time() - start)
+    return response
+
+def get_rate_limit_tenant():
+    """Tenant of the routes without a tree_id in the URL: the tree_id of the JSON body, else the client's address"""
+    content = request.get_json(silent=True)
+    if isinstance(content, dict) and str(content.get('tree_id')).isdigit():
+        return int(content['tree_id'])
+    # Behind the shard router (same machine) every request comes from 127.0.0.1: the client is in X-Forwarded-For
+    forwarded_for = request.headers.get('X-Forwarded-For')
+    if forwarded_for and request.remote_addr in ('127.0.0.1', '::1'):
+        return forwarded_for.split(',')[0].strip()
+    return request.remote_addr
+
+def rate_limited(retry_after):
+    response = make_error('Rate limit exceeded, retry in ' + ('%.1f' % retry_after) + 's', 429)
+    response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+    return response
+
+def make_etag(version):
+    """ETag for a version of a resource (see EpicTree region Versions), the epoch changes on restart"""
+    if accepts_msgpack(request.headers.get('Accept')):
+        return epicTree.epoch + '-' + str(version) + '-msgpack'
+    return epicTree.epoch + '-' + str(version)
+
+def is_not_modified(etag):
+    """The client sent this ETag in If-None-Match (a 200 was answered with it, so the resource exists)"""
+    if_none_match = request.if_none_match
+    return not if_none_match.star_tag and if_none_match.contains_weak(etag)
+
+def not_modified(etag):
+    response = app.response_class(status=304)
+    response.set_etag(etag)
     return response
 
 @app.errorhandler(404)
@@ -582,14 +1278,86 @@ def make_error(msg, code):
         },
         'response': None
     }
-    response = jsonify(response)
-    response.status_code = code
-    return response
+    return make_response(response, code)
 
 # endregion
 
 # region Helper methods
 
+def get_depth_argument():
+    """depth query argument (None if not set): (depth, None) or (None, 400 response)"""
+    depth = request.args.get('depth')
+    if depth is None:
+        return None, None
+    if not depth.isdigit():
+        return None, make_error('Depth (depth) must be a number >= 0', 400)
+    return int(depth), None
+
+def get_as_of_arguments():
+    """as_of (version) / as_of_time (unix time) query arguments: (version, timestamp, None) or (None, None, 400 response)"""
+    try:
+        version = request.args.get('as_of')
+        version = None if version is None else int(version)
+        timestamp = request.args.get('as_of_time')
+        timestamp = None if timestamp is None else float(timestamp)
+    except ValueError:
+        return None, None, make_error('as_of must be a version, as_of_time a unix time', 400)
+    return version, timestamp, None
+
+def resolve_segment_as_of(tree_id, segment_id, version=None, timestamp=None):
+    """resolve_segment, then the segment as it was at a version / time if set: (nodes, None) or (None, error response)"""
+    nodes, not_found = resolve_segment(tree_id, segment_id)
+    if nodes is None:
+        return None, error_not_found(not_found)
+    if version is None and timestamp is None:
+        return nodes, None
+    try:
+        return epicTree.get_nodes_as_of(tree_id, segment_id, version, timestamp), None
+    except HistoryExpired as inst:
+        return None, make_error(inst, 410)
+
+def resolve_data_file(filename):
+    """File next to the data file: only plain file names, never caller-supplied paths: (path, None) or (None, 400 response)"""
+    filename = str(filename)
+    if filename in ('', '.', '..') or os.path.basename(filename) != filename:
+        return None, make_error('Filename (filename) must be a plain file name', 400)
+    return os.path.join(os.path.dirname(get_data_filename()), filename), None
+
+def resolve_segment(tree_id, segment_id):
+    """
+    Look up tree => segment once per request, the routes then hand the nodes to EpicTree (nodes=) which skips its checks
+    :return: (nodes, None) or (None, not found message)
+    """
+    try:
+        return epicTree.get_nodes(tree_id, segment_id), None
+    except KeyError as inst:
+        return None, inst.args[0]
+
+def lookup_one(tree_id, segment_id, node_id, kind, resolved):
+    """One lookup of the multi-get: {'code': 200, 'response': ...} or {'code': 404, 'message': ...}"""
+    nodes, not_found = resolved
+    if nodes is None:
+        return {'code': 404, 'message': not_found}
+    if kind != 'root' and node_id not in nodes:
+        return {'code': 404, 'message': 'Node ' + str(node_id) + ' not found'}
+    try:
+        if kind == 'level':
+            children = epicTree.get_level(tree_id, segment_id, node_id, nodes)
+            response = [make_simple_node(child['id'], child['child']) for child in children]
+        elif kind == 'breadcrumbs':
+            response = epicTree.get_breadcrumbs(tree_id, segment_id, node_id, nodes)
+        elif kind == 'root':
+            response = epicTree.get_segment_root_node(tree_id, segment_id, nodes)
+        else:
+            # Deep link: breadcrumbs, each with its level
+            response = []
+            for crumb in epicTree.get_breadcrumbs(tree_id, segment_id, node_id, nodes):
+                children = epicTree.get_level(tree_id, segment_id, crumb, nodes)
+                response.append({'id': crumb, 'children': [make_simple_node(x['id'], x['child']) for x in children]})
+    except KeyError as inst:
+        return {'code': 404, 'message': str(inst.args[0]) if len(inst.args) > 0 else 'Not found'}
+    return {'code': 200, 'response': response}
+
 def make_simple_node(node_id, node_data):
     return {
         "id": node_id,
@@ -603,14 +1371,37 @@ def make_simple_node(node_id, node_data):
 # region Init
 
 if __name__ == '__main__':
-    # Load tree
-    init_from_filesystem()
     # Get server config
     port = int(config.get('Server', 'Port'))
+    # Sharded: run as a router in front of the shards, or as one of the shards
+    shard_count = int(get_config('Sharding', 'Shards', 0))
+    shard_index = get_shard_argument(sys.argv)
+    if shard_count > 1 and shard_index is None:
+        for x in range(shard_count):
+            open(shard_data_filename(config.get('Files', 'DataFile'), x), 'a').close()
+        run_router(port, shard_count, os.path.abspath(__file__),
+                   int(get_config('Sharding', 'ConnectionsPerShard', CONNECTIONS_PER_SHARD)))
+        exit(0)
+    if shard_index is not None:
+        port = shard_port(port, shard_index)
+    # Load tree
+    init_from_filesystem()
     if environment == 'production':
         # Tornado
-        http_server = HTTPServer(WSGIContainer(app))
+        # Long-polled change feed on Tornado, everything else on Flask
+        http_server = HTTPServer(tornado.web.Application([
+            (r'/tree/([0-9]+)/segment/([0-9]+)/changes', ChangesHandler, dict(feed=change_feed, read_changes=read_changes)),
+            (r'.*', tornado.web.FallbackHandler, dict(fallback=WSGIContainer(app))),
+        ]))
         http_server.listen(port)
+        start_rpc_server()
+        # Read-only snapshot, refreshed periodically for reader processes
+        if get_config('Snapshot', 'File') is not None:
+            publish_snapshot()
+            PeriodicCallback(publish_snapshot, float(get_config('Snapshot', 'RefreshSeconds', 60)) * 1000).start()
+        # Idle segments frozen into their compact form
+        if freeze_idle_seconds > 0:
+            PeriodicCallback(freeze_idle_segments, freeze_check_seconds * 1000).start()
         # Debug & autoreload (dev only. tornado is for prod... maybe separate 'server' from 'logging level'?)
         #def fn():
         #    print "Hooked before reloading..."
@@ -0,0 +1,587 @@
+"""
+EpicTree benchmarks (run from the app directory)
+
+    python benchmark.py suite --scale small --output before.json
+    python benchmark.py suite --scale small --output after.json --cases get_level,get_breadcrumbs
+    python benchmark.py compare before.json after.json
+    python benchmark.py snapshot --nodes 10000000 --segments 100
+
+Every suite case runs in its own process (so peak memory is per case) on a synthetic tree generated with a
+fixed seed, and reports ops/sec, p50/p99 latency and peak RSS.
+"""
+
+# Standard libraries
+import argparse
+import json
+import multiprocessing
+import os
+import pickle
+import platform
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+# Libraries
+from epictree import EpicTree
+from snapshot import write_snapshot, load_snapshot
+from ratelimit import TokenBucketLimiter
+import serialiser
+
+SEED = 1234
+
+# Nodes in the generated trees / operations per case
+SCALES = {
+    'small': {'nodes': 10000, 'ops': 500},
+    'medium': {'nodes': 100000, 'ops': 2000},
+    'large': {'nodes': 1000000, 'ops': 5000},
+}
+
+# region Generators
+
+def generate_segment(node_count, fanout, first_node_id=0):
+    """Complete tree with node_count nodes where every directory has fanout children (breadth-first IDs)"""
+    nodes = {}
+    for x in range(node_count):
+        node_id = first_node_id + x
+        first_child = x * fanout + 1
+        children = None
+        if first_child < node_count:
+            children = [first_node_id + y for y in range(first_child, min(first_child + fanout, node_count))]
+        if x == 0:
+            nodes[node_id] = (None, 'root', None, 1, children)
+        elif children is not None:
+            nodes[node_id] = (first_node_id + (x - 1) // fanout, 'dir', None, (x - 1) % fanout + 1, children)
+        else:
+            nodes[node_id] = (first_node_id + (x - 1) // fanout, 'file', node_id, (x - 1) % fanout + 1, None)
+    return nodes
+
+def generate_chains(node_count, depth):
+    """Root with as many chains of directories (depth levels each, a file at the end) as node_count allows"""
+    nodes = {0: (None, 'root', None, 1, [])}
+    node_id = 1
+    chain = 0
+    while node_id + depth <= node_count:
+        chain += 1
+        parent_id = 0
+        nodes[0][4].append(node_id)
+        for level in range(depth):
+            is_last = level == depth - 1
+            node_type = 'file' if is_last else 'dir'
+            children = None if is_last else [node_id + 1]
+            nodes[node_id] = (parent_id, node_type, node_id if is_last else None, chain if level == 0 else 1, children)
+            parent_id = node_id
+            node_id += 1
+    return nodes
+
+def generate_tree(node_count, trees=1, segments=1, fanout=10):
+    """{tree_id: {segment_id: nodes}} with node_count nodes spread evenly over every segment"""
+    tree = {}
+    per_segment = max(1, node_count // (trees * segments))
+    for tree_id in range(1, trees + 1):
+        tree[tree_id] = {}
+        for segment_id in range(1, segments + 1):
+            tree[tree_id][segment_id] = generate_segment(per_segment, fanout)
+    return tree
+
+def generate_skewed(node_count, trees=100):
+    """One tenant holds 90% of the nodes, the rest is spread over the other tenants"""
+    tree = {1: {1: generate_segment(node_count * 9 // 10, 10)}}
+    per_tree = max(2, node_count // 10 // (trees - 1))
+    for tree_id in range(2, trees + 1):
+        tree[tree_id] = {1: generate_segment(per_tree, 10)}
+    return tree
+
+DATASETS = {
+    # Balanced: fanout 10
+    'balanced': lambda nodes: {1: {1: generate_segment(nodes, 10)}},
+    # Wide: one huge level under the root
+    'wide': lambda nodes: {1: {1: generate_segment(max(2, nodes // 10), nodes)}},
+    # Deep: chains of 500 directories, the worst case of the ancestor walks (breadcrumbs, is_descendant, deep links)
+    'deep': lambda nodes: {1: {1: generate_chains(nodes, 500)}},
+    # Many tenants: 1000 trees of 1 segment
+    'tenants': lambda nodes: generate_tree(nodes, trees=1000),
+    # Skewed: one tenant with 90% of the nodes
+    'skewed': lambda nodes: generate_skewed(nodes),
+}
+
+def make_epic_tree(dataset, nodes):
+    epic_tree = EpicTree()
+    epic_tree.tree = DATASETS[dataset](nodes)
+    return epic_tree
+
+# endregion
+
+# region Cases
+
+def _pick_nodes(epic_tree, count, node_type=None):
+    """Random (tree_id, segment_id, node_id) of a given type"""
+    candidates = []
+    for tree_id, segments in iter(epic_tree.tree.items()):
+        for segment_id, nodes in iter(segments.items()):
+            for node_id, node in iter(nodes.items()):
+                if node_type is None or node[1] == node_type:
+                    candidates.append((tree_id, segment_id, node_id))
+    candidates.sort()
+    return [random.choice(candidates) for x in range(count)]
+
+def _wide_parent(epic_tree):
+    return 1, 1, 0
+
+def case_add_node(epic_tree, ops):
+    """Append to a wide level (no position)"""
+    tree_id, segment_id, parent_node_id = _wide_parent(epic_tree)
+    node_id = 10 ** 9
+    for x in range(ops):
+        node_id += 1
+        yield lambda: epic_tree.add_node(tree_id, segment_id, parent_node_id, node_id, None, None, 'file', x)
+
+def case_add_node_pinned(epic_tree, ops):
+    """add_node while a reader has the tree pinned (compare: add_node), the pin is renewed every 100 adds"""
+    tree_id, segment_id, parent_node_id = _wide_parent(epic_tree)
+    node_id = 10 ** 9
+    pinned = epic_tree.pin(tree_id, segment_id)
+    for x in range(ops):
+        node_id += 1
+        if x % 100 == 0:
+            pinned.release()
+            pinned = epic_tree.pin(tree_id, segment_id)
+        yield lambda: epic_tree.add_node(tree_id, segment_id, parent_node_id, node_id, None, None, 'file', x)
+    pinned.release()
+
+def case_add_node_quota(epic_tree, ops):
+    """add_node with node and memory quotas on (compare: add_node), the tree is counted before the first add"""
+    tree_id, segment_id, parent_node_id = _wide_parent(epic_tree)
+    node_id = 10 ** 9
+    epic_tree.set_quotas(10 ** 9, 10 ** 12)
+    epic_tree.get_usage(tree_id)
+    for x in range(ops):
+        node_id += 1
+        yield lambda: epic_tree.add_node(tree_id, segment_id, parent_node_id, node_id, None, None, 'file', x)
+    epic_tree.set_quotas()
+
+def case_add_node_position(epic_tree, ops):
+    """Insert into a wide level at a random position (shifts the sort of the following siblings)"""
+    tree_id, segment_id, parent_node_id = _wide_parent(epic_tree)
+    size = len(epic_tree.tree[tree_id][segment_id][parent_node_id][4])
+    node_id = 10 ** 9
+    for x in range(ops):
+        node_id += 1
+        position = random.randint(1, size)
+        size += 1
+        yield lambda: epic_tree.add_node(tree_id, segment_id, parent_node_id, node_id, position, None, 'file', x)
+
+def case_remove_node(epic_tree, ops):
+    """Remove random files from a wide level (re-sorts the level)"""
+    tree_id, segment_id, parent_node_id = _wide_parent(epic_tree)
+    children = list(epic_tree.tree[tree_id][segment_id][parent_node_id][4])
+    random.shuffle(children)
+    for node_id in children[:ops]:
+        yield lambda: epic_tree.remove_node(tree_id, segment_id, node_id)
+
+def case_re_sort_level(epic_tree, ops):
+    """Full re-sort of a wide level"""
+    tree_id, segment_id, parent_node_id = _wide_parent(epic_tree)
+    for x in range(ops):
+        yield lambda: epic_tree._re_sort_level(tree_id, segment_id, parent_node_id)
+
+def case_get_level(epic_tree, ops):
+    """Random directories"""
+    for tree_id, segment_id, node_id in _pick_nodes(epic_tree, ops, 'dir'):
+        yield lambda: epic_tree.get_level(tree_id, segment_id, node_id)
+
+def case_get_root_level(epic_tree, ops):
+    """Root level of random tenants"""
+    for tree_id, segment_id, node_id in _pick_nodes(epic_tree, ops, 'root'):
+        yield lambda: epic_tree.get_level(tree_id, segment_id, node_id)
+
+def case_get_breadcrumbs(epic_tree, ops):
+    """Random files"""
+    for tree_id, segment_id, node_id in _pick_nodes(epic_tree, ops, 'file'):
+        yield lambda: epic_tree.get_breadcrumbs(tree_id, segment_id, node_id)
+
+def case_is_descendant(epic_tree, ops):
+    """Random file under a random directory? (compare: get_breadcrumbs + scan)"""
+    directories = _pick_nodes(epic_tree, ops, 'dir')
+    epic_tree.is_descendant(*directories[0][:2] + (directories[0][2], directories[0][2]))
+    for (tree_id, segment_id, node_id), directory in zip(_pick_nodes(epic_tree, ops, 'file'), directories):
+        yield lambda: epic_tree.is_descendant(tree_id, segment_id, node_id, directory[2])
+
+def case_subtree_by_type(epic_tree, ops):
+    """Directories at most 2 levels under random directories (compare: one get_level per directory)"""
+    directories = _pick_nodes(epic_tree, ops, 'dir')
+    epic_tree.get_subtree(*directories[0])
+    for tree_id, segment_id, node_id in directories:
+        yield lambda: epic_tree.get_subtree(tree_id, segment_id, node_id, ['dir'], 1, 2)
+
+def case_get_level_as_of(epic_tree, ops):
+    """A level as it was up to 100 changes ago (after 1000 appends, inserts and removals under it)"""
+    tree_id, segment_id, parent_node_id = _pick_nodes(epic_tree, 1, 'dir')[0]
+    node_id = 10 ** 9
+    for x in range(1000):
+        node_id += 1
+        epic_tree.add_node(tree_id, segment_id, parent_node_id, node_id, random.choice([None, None, 1]), None, 'file', x)
+        if x % 5 == 4:
+            epic_tree.remove_node(tree_id, segment_id, node_id - 1)
+    for x in range(ops):
+        version = epic_tree.version - random.randint(1, 100)
+        yield lambda: epic_tree.get_level(tree_id, segment_id, parent_node_id,
+                                          epic_tree.get_nodes_as_of(tree_id, segment_id, version))
+
+def case_diff_segments(epic_tree, ops):
+    """Segment against a copy of it with 10 nodes added (compare: export, the hashes are built before timing)"""
+    tree_id, segment_id = 1, 1
+    nodes = epic_tree.tree[tree_id][segment_id]
+    epic_tree.tree[tree_id][2] = dict((x, y[:4] + (None if y[4] is None else list(y[4]),)) for x, y in iter(nodes.items()))
+    node_id = 10 ** 9
+    for tree_id, segment_id, parent_node_id in _pick_nodes(epic_tree, 10, 'dir'):
+        node_id += 1
+        epic_tree.add_node(1, 2, parent_node_id, node_id, None, None, 'file', node_id)
+    epic_tree.diff_segments(1, 1, 2)
+    for x in range(ops):
+        yield lambda: epic_tree.diff_segments(1, 1, 2)
+
+def _frozen_case(case):
+    """A read case on the tree frozen first (see EpicTree.freeze_idle, compare: the case itself)"""
+    def frozen_case(epic_tree, ops):
+        epic_tree.freeze_idle(0)
+        return case(epic_tree, ops)
+    return frozen_case
+
+def case_export(epic_tree, ops):
+    """Whole tree export"""
+    for x in range(ops):
+        yield lambda: epic_tree.get_everything()
+
+def case_export_depth(epic_tree, ops):
+    """Top 3 levels of every segment of random trees, directories below as child counts (compare: export)"""
+    tree_ids = epic_tree.get_trees()
+    for x in range(ops):
+        tree_id = random.choice(tree_ids)
+        yield lambda: epic_tree.get_tree(tree_id, 3)
+
+def case_allocate_node_id(epic_tree, ops):
+    """Unmanaged-mode node ID (the one-off scan for the first free ID is not timed)"""
+    epic_tree.allocate_node_id()
+    for x in range(ops):
+        yield epic_tree.allocate_node_id
+
+def case_rate_limit(epic_tree, ops):
+    """Token-bucket check of a route for one of the trees (the per-request cost of the limiter)"""
+    limiter = TokenBucketLimiter()
+    tree_ids = epic_tree.get_trees()
+    for x in range(ops):
+        tree_id = random.choice(tree_ids)
+        yield lambda: limiter.consume('get_level', tree_id, 100000, 3600)
+
+def _serve(epic_tree):
+    """
+    Import app.py (it reads config.ini from the working directory) serving epic_tree, without cache or limits
+    The route cases call the view functions in a request context: the handler's own work, without the HTTP layer
+    """
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(directory, 'config.ini'), 'w') as f:
+            f.write('[Server]\nEnvironment=production\n')
+        os.chdir(directory)
+        import app
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+    app.epicTree = epic_tree
+    app.attach_listeners()
+    app.response_cache.max_entries = 0
+    app.limiter.configure(False)
+    return app
+
+def case_route_get_level(epic_tree, ops):
+    """GET level of random directories (validation, EpicTree, serialisation)"""
+    app = _serve(epic_tree)
+    app.app.test_request_context().push()
+    for tree_id, segment_id, node_id in _pick_nodes(epic_tree, ops, 'dir'):
+        yield lambda: app.get_level(tree_id, segment_id, node_id)
+
+def case_route_get_breadcrumbs(epic_tree, ops):
+    app = _serve(epic_tree)
+    app.app.test_request_context().push()
+    for tree_id, segment_id, node_id in _pick_nodes(epic_tree, ops, 'file'):
+        yield lambda: app.breadcrumbs(tree_id, segment_id, node_id)
+
+def case_route_add_node(epic_tree, ops):
+    """POST node under random directories (the request context, with its JSON body, is built outside the timing)"""
+    app = _serve(epic_tree)
+    node_id = 10 ** 9
+    for tree_id, segment_id, parent_node_id in _pick_nodes(epic_tree, ops, 'dir'):
+        node_id += 1
+        body = json.dumps({'parent_node_id': parent_node_id, 'node_id': node_id, 'type': 'file', 'payload': node_id})
+        context = app.app.test_request_context(method='POST', data=body, content_type='application/json')
+        context.push()
+        context.request.get_json()
+        yield lambda: app.node_add(tree_id, segment_id)
+        context.pop()
+
+def _deep_link(app, tree_id, segment_id, node_id):
+    # One breadcrumbs request, then one level request per ancestor
+    crumbs = json.loads(app.breadcrumbs(tree_id, segment_id, node_id).data)['response']
+    return [app.get_level(tree_id, segment_id, crumb) for crumb in crumbs]
+
+def case_route_deep_link(epic_tree, ops):
+    """Open a deep link to random files with the single routes (compare: route_lookup_path)"""
+    app = _serve(epic_tree)
+    app.app.test_request_context().push()
+    for tree_id, segment_id, node_id in _pick_nodes(epic_tree, ops, 'file'):
+        yield lambda: _deep_link(app, tree_id, segment_id, node_id)
+
+def case_route_lookup_path(epic_tree, ops):
+    """Same deep links as route_deep_link, as one multi-get path lookup"""
+    app = _serve(epic_tree)
+    for tree_id, segment_id, node_id in _pick_nodes(epic_tree, ops, 'file'):
+        body = json.dumps({'lookups': [[segment_id, node_id, 'path']]})
+        context = app.app.test_request_context(method='POST', data=body, content_type='application/json')
+        context.push()
+        context.request.get_json()
+        yield lambda: app.lookup(tree_id)
+        context.pop()
+
+def _serialise_case(encode):
+    """Serialise the (wide) root level's answer"""
+    def case(epic_tree, ops):
+        children = epic_tree.get_level(*_wide_parent(epic_tree))
+        for x in range(ops):
+            yield lambda: encode(children)
+    return case
+
+def _simple_nodes(children):
+    # What app.py's make_simple_node builds for every child
+    return [{'id': x['id'], 'type': x['child'][1], 'data': x['child'][2], 'sort': x['child'][3]} for x in children]
+
+def _file_case(save, load=None):
+    """Save the whole tree (or load it, in which case the save before each load is not timed)"""
+    def case(epic_tree, ops):
+        handle, filename = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            for x in range(ops):
+                if load is None:
+                    yield lambda: save(epic_tree.tree, filename)
+                else:
+                    save(epic_tree.tree, filename)
+                    yield lambda: load(filename)
+        finally:
+            os.remove(filename)
+    return case
+
+def _pickle_save(tree, filename):
+    with open(filename, 'wb') as f:
+        pickle.dump(tree, f, pickle.HIGHEST_PROTOCOL)
+
+def _pickle_load(filename):
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+def _snapshot_load(filename):
+    # Full decode, to compare with pickle
+    return [segments.items() for segments in load_snapshot(filename).values()]
+
+# (name, dataset, case, ops divisor)
+CASES = [
+    ('add_node', 'wide', case_add_node, 1),
+    ('add_node_pinned', 'wide', case_add_node_pinned, 1),
+    ('add_node_quota', 'wide', case_add_node_quota, 1),
+    ('add_node_position', 'wide', case_add_node_position, 1),
+    ('remove_node', 'wide', case_remove_node, 1),
+    ('re_sort_level', 'wide', case_re_sort_level, 10),
+    ('get_level', 'balanced', case_get_level, 1),
+    ('get_level_frozen', 'balanced', _frozen_case(case_get_level), 1),
+    ('get_level_tenants', 'tenants', case_get_root_level, 1),
+    ('get_level_skewed', 'skewed', case_get_root_level, 1),
+    ('get_breadcrumbs', 'deep', case_get_breadcrumbs, 1),
+    ('get_breadcrumbs_frozen', 'deep', _frozen_case(case_get_breadcrumbs), 1),
+    ('is_descendant', 'deep', case_is_descendant, 1),
+    ('subtree_by_type', 'balanced', case_subtree_by_type, 1),
+    ('get_level_as_of', 'balanced', case_get_level_as_of, 10),
+    ('diff_segments', 'balanced', case_diff_segments, 1),
+    ('export', 'balanced', case_export, 100),
+    ('export_frozen', 'balanced', _frozen_case(case_export), 100),
+    ('export_depth', 'balanced', case_export_depth, 10),
+    ('allocate_node_id', 'balanced', case_allocate_node_id, 1),
+    ('rate_limit', 'tenants', case_rate_limit, 1),
+    ('route_get_level', 'balanced', case_route_get_level, 1),
+    ('route_get_breadcrumbs', 'deep', case_route_get_breadcrumbs, 1),
+    ('route_add_node', 'balanced', case_route_add_node, 1),
+    ('route_deep_link', 'balanced', case_route_deep_link, 10),
+    ('route_lookup_path', 'balanced', case_route_lookup_path, 10),
+    ('serialise_level_dicts', 'wide', _serialise_case(lambda children: serialiser.encode_json(_simple_nodes(children))), 10),
+    ('serialise_level', 'wide', _serialise_case(serialiser.encode_level), 10),
+    ('pickle_save', 'balanced', _file_case(_pickle_save), 500),
+    ('pickle_load', 'balanced', _file_case(_pickle_save, _pickle_load), 500),
+    ('snapshot_save', 'balanced', _file_case(write_snapshot), 500),
+    ('snapshot_load', 'balanced', _file_case(write_snapshot, _snapshot_load), 500),
+]
+if serialiser.msgpack is not None:
+    CASES.append(('serialise_level_msgpack', 'wide', _serialise_case(lambda children: serialiser.encode_msgpack(_simple_nodes(children))), 10))
+
+# endregion
+
+# region Runner
+
+def percentile(sorted_values, fraction):
+    if len(sorted_values) == 0:
+        return 0.0
+    return sorted_values[int(round(fraction * (len(sorted_values) - 1)))]
+
+def run_case(name, dataset, case, ops, nodes, queue):
+    """Run one case (in a child process), put its results on the queue"""
+    random.seed(SEED)
+    epic_tree = make_epic_tree(dataset, nodes)
+    latencies = []
+    for operation in case(epic_tree, ops):
+        start = time.time()
+        operation()
+        latencies.append(time.time() - start)
+    latencies.sort()
+    total = sum(latencies)
+    queue.put({
+        'case': name,
+        'dataset': dataset,
+        'nodes': nodes,
+        'ops': len(latencies),
+        'ops_per_sec': len(latencies) / total if total > 0 else 0.0,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        # KB on Linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    })
+
+def run_suite(scale, case_names=None):
+    results = []
+    for name, dataset, case, divisor in CASES:
+        if case_names is not None and name not in case_names:
+            continue
+        ops = max(1, SCALES[scale]['ops'] // divisor)
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_case, args=(name, dataset, case, ops, SCALES[scale]['nodes'], queue))
+        process.start()
+        result = queue.get()
+        process.join()
+        results.append(result)
+        print_result(result)
+    return results
+
+def format_seconds(seconds):
+    if seconds < 0.001:
+        return '%.1fus' % (seconds * 1000000)
+    if seconds < 1:
+        return '%.2fms' % (seconds * 1000)
+    return '%.2fs' % seconds
+
+def print_result(result):
+    print (result['case'].ljust(24) + result['dataset'].ljust(10) + ('%.0f ops/s' % result['ops_per_sec']).rjust(16) +
+           ('p50 ' + format_seconds(result['p50'])).rjust(16) + ('p99 ' + format_seconds(result['p99'])).rjust(16) +
+           ('%.1f MB' % (result['peak_rss_kb'] / 1024.0)).rjust(12))
+
+def compare(before, after):
+    """Print the change of every case present in both runs"""
+    before_cases = dict((x['case'], x) for x in before['results'])
+    for result in after['results']:
+        if result['case'] not in before_cases:
+            continue
+        old = before_cases[result['case']]
+        change = 0.0
+        if old['ops_per_sec'] > 0:
+            change = (result['ops_per_sec'] / old['ops_per_sec'] - 1) * 100
+        print (result['case'].ljust(24) + ('%.0f -> %.0f ops/s' % (old['ops_per_sec'], result['ops_per_sec'])).rjust(28) +
+               ('%+.1f%%' % change).rjust(10) +
+               ('p99 ' + format_seconds(old['p99']) + ' -> ' + format_seconds(result['p99'])).rjust(28))
+
+# endregion
+
+# region Snapshot vs pickle
+
+def timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return result, time.time() - start
+
+def benchmark_snapshot(args):
+    """Save/load of the snapshot format against pickle (what the data file used to be)"""
+    tree, seconds = timed(generate_tree, args.nodes, args.trees, args.segments, args.fanout)
+    print 'Generated ' + str(args.nodes) + ' nodes in ' + ('%.2fs' % seconds)
+    directory = tempfile.mkdtemp()
+    pickle_filename = os.path.join(directory, 'tree.pickle')
+    snapshot_filename = os.path.join(directory, 'tree.snapshot')
+    results = []
+    try:
+        # Pickle
+        result, seconds = timed(_pickle_save, tree, pickle_filename)
+        results.append(('pickle save', seconds))
+        result, seconds = timed(_pickle_load, pickle_filename)
+        results.append(('pickle load', seconds))
+        result = None
+        # Snapshot
+        result, seconds = timed(write_snapshot, tree, snapshot_filename)
+        results.append(('snapshot save', seconds))
+        tree = None
+        loaded, seconds = timed(load_snapshot, snapshot_filename)
+        results.append(('snapshot load (lazy)', seconds))
+        result, seconds = timed(lambda: loaded[1][1][0])
+        results.append(('snapshot first segment decode', seconds))
+        result, seconds = timed(lambda: [segments.items() for segments in loaded.values()])
+        results.append(('snapshot full decode', seconds))
+        result, seconds = timed(write_snapshot, loaded, snapshot_filename)
+        results.append(('snapshot re-save', seconds))
+        print 'Pickle file: ' + str(os.path.getsize(pickle_filename)) + ' bytes'
+        print 'Snapshot file: ' + str(os.path.getsize(snapshot_filename)) + ' bytes'
+    finally:
+        for filename in [pickle_filename, snapshot_filename]:
+            if os.path.isfile(filename):
+                os.remove(filename)
+        os.rmdir(directory)
+    for name, seconds in results:
+        print name.ljust(32) + ('%.3fs' % seconds)
+
+# endregion
+
+def main_suite(args):
+    case_names = None
+    if args.cases:
+        case_names = args.cases.split(',')
+    results = run_suite(args.scale, case_names)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'scale': args.scale,
+                'python': platform.python_version(),
+                'time': time.time(),
+                'results': results
+            }, f, indent=2)
+
+def main_compare(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    compare(before, after)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='EpicTree benchmarks')
+    subparsers = parser.add_subparsers()
+    suite_parser = subparsers.add_parser('suite', help='operation benchmarks on synthetic trees')
+    suite_parser.add_argument('--scale', choices=sorted(SCALES.keys()), default='small')
+    suite_parser.add_argument('--cases', help='comma separated case names (default: all)')
+    suite_parser.add_argument('--output', help='write the results to this JSON file (for compare)')
+    suite_parser.set_defaults(run=main_suite)
+    compare_parser = subparsers.add_parser('compare', help='compare two suite results')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.set_defaults(run=main_compare)
+    snapshot_parser = subparsers.add_parser('snapshot', help='snapshot format vs pickle (save/load)')
+    snapshot_parser.add_argument('--nodes', type=int, default=10000000)
+    snapshot_parser.add_argument('--trees', type=int, default=1)
+    snapshot_parser.add_argument('--segments', type=int, default=100)
+    snapshot_parser.add_argument('--fanout', type=int, default=10)
+    snapshot_parser.set_defaults(run=benchmark_snapshot)
+    arguments = parser.parse_args()
+    arguments.run(arguments)
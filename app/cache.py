@@ -0,0 +1,96 @@
+"""
+LRU cache of serialised read responses
+
+Entries are keyed by (tree_id, segment_id, node_id, endpoint) and record the nodes their answer depends on
+(a level depends on its parent node, breadcrumbs on the ancestors of the node), so a mutation only invalidates
+the entries built from the nodes it touched. Entries that only change with the segment itself (e.g. its root)
+depend on None.
+"""
+
+# Standard libraries
+from collections import OrderedDict
+
+class ResponseCache:
+    """Bounded LRU cache, invalidated through EpicTree change listeners (see EpicTree.add_listener)"""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        # key => (body, node IDs it depends on), least recently used first
+        self.entries = OrderedDict()
+        # (tree_id, segment_id) => {node_id (None: whole segment): set of keys}
+        self.dependants = {}
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Cached body (marked as most recently used), None on a miss"""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        self.entries[key] = entry
+        return entry[0]
+
+    def put(self, key, body, node_ids=None):
+        """Cache a body for key = (tree_id, segment_id, node_id, endpoint), depending on node_ids (None: only the segment)"""
+        if self.max_entries <= 0:
+            return
+        if key in self.entries:
+            self._forget(key)
+        if node_ids is None or len(node_ids) == 0:
+            node_ids = [None]
+        self.entries[key] = (body, node_ids)
+        segment_dependants = self.dependants.setdefault((key[0], key[1]), {})
+        for node_id in node_ids:
+            segment_dependants.setdefault(node_id, set()).add(key)
+        while len(self.entries) > self.max_entries:
+            self._forget(next(iter(self.entries)))
+            self.evictions += 1
+        return
+
+    def invalidate(self, tree_id=None, segment_id=None, node_ids=None):
+        """Drop the entries depending on the given nodes (or on anything in the segment / tree / everything, for None)"""
+        if tree_id is None:
+            self.invalidations += len(self.entries)
+            self.clear()
+            return
+        if segment_id is None:
+            segments = [x for x in self.dependants if x[0] == tree_id]
+        else:
+            segments = [(tree_id, segment_id)]
+        keys = set()
+        for segment in segments:
+            segment_dependants = self.dependants.get(segment)
+            if segment_dependants is None:
+                continue
+            if segment_id is None or node_ids is None:
+                for node_keys in segment_dependants.values():
+                    keys.update(node_keys)
+            else:
+                for node_id in node_ids:
+                    keys.update(segment_dependants.get(node_id, ()))
+        for key in keys:
+            self._forget(key)
+        self.invalidations += len(keys)
+        return
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.dependants = {}
+        return
+
+    def _forget(self, key):
+        body, node_ids = self.entries.pop(key)
+        segment = (key[0], key[1])
+        segment_dependants = self.dependants[segment]
+        for node_id in node_ids:
+            node_keys = segment_dependants.get(node_id)
+            if node_keys is not None:
+                node_keys.discard(key)
+                if len(node_keys) == 0:
+                    del segment_dependants[node_id]
+        if len(segment_dependants) == 0:
+            del self.dependants[segment]
+        return
@@ -0,0 +1,162 @@
+"""
+Change feed: the recent mutations of every segment, and a long-poll handler to subscribe to them
+
+Changes are the dicts EpicTree passes to its listeners (see EpicTree.add_listener), each with the version of the
+tree clock it produced. Clients read the changes since the version they have, then ask again with the version of
+the answer. The Tornado handler holds the request open until something changes (or the timeout expires).
+
+Sort semantics: add_node with shifted=true moved the siblings with sort >= sort one up, remove_node moved the
+siblings after it one down.
+"""
+
+# Standard libraries
+from collections import deque
+import json
+
+# External libraries
+import tornado.gen
+import tornado.web
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+MAX_TIMEOUT = 60.0
+DEFAULT_TIMEOUT = 30.0
+
+class ChangeFeed:
+    """Bounded log of changes per segment (EpicTree listener)"""
+
+    def __init__(self, size=1000):
+        self.size = size
+        # (tree_id, segment_id) => deque of changes (oldest first)
+        self.changes = {}
+        # Older versions can't be replayed: (tree_id, segment_id) => version of the last dropped change, ...
+        self.truncated = {}
+        self.tree_reset_versions = {}
+        self.reset_version = 0
+        # (tree_id, segment_id) => futures of the requests waiting for a change
+        self.waiters = {}
+
+    def record(self, tree_id, segment_id, node_ids, change):
+        if tree_id is None:
+            self.clear()
+            self.reset_version = change['version']
+            self._notify(list(self.waiters))
+            return
+        if segment_id is None:
+            # Tree removed: its segments' changes can't be replayed anymore
+            self.tree_reset_versions[tree_id] = change['version']
+            keys = [x for x in set(self.changes.keys() + self.waiters.keys()) if x[0] == tree_id]
+            for key in keys:
+                self.changes.pop(key, None)
+                self.truncated.pop(key, None)
+            self._notify(keys)
+            return
+        key = (tree_id, segment_id)
+        changes = self.changes.get(key)
+        if changes is None:
+            changes = deque(maxlen=self.size)
+            self.changes[key] = changes
+        if len(changes) == self.size:
+            self.truncated[key] = changes[0]['version']
+        changes.append(change)
+        self._notify([key])
+        return
+
+    def read(self, tree_id, segment_id, since, subtree_node_id=None):
+        """Changes after version since (only the ones under subtree_node_id if set), None if some were dropped"""
+        key = (tree_id, segment_id)
+        if since < max(self.reset_version, self.tree_reset_versions.get(tree_id, 0), self.truncated.get(key, 0)):
+            return None
+        results = []
+        for change in self.changes.get(key, ()):
+            if change['version'] > since and (subtree_node_id is None or in_subtree(change, subtree_node_id)):
+                results.append(change)
+        return results
+
+    def clear(self):
+        """Forget everything (e.g. a new tree attached, its versions start over)"""
+        self.changes = {}
+        self.truncated = {}
+        self.tree_reset_versions = {}
+        self.reset_version = 0
+        return
+
+    def add_waiter(self, tree_id, segment_id, future):
+        self.waiters.setdefault((tree_id, segment_id), []).append(future)
+        return
+
+    def remove_waiter(self, tree_id, segment_id, future):
+        futures = self.waiters.get((tree_id, segment_id))
+        if futures is not None and future in futures:
+            futures.remove(future)
+            if len(futures) == 0:
+                del self.waiters[(tree_id, segment_id)]
+        return
+
+    def _notify(self, keys):
+        for key in keys:
+            for future in self.waiters.pop(key, []):
+                if not future.done():
+                    future.set_result(None)
+        return
+
+def in_subtree(change, node_id):
+    """The change happened at or under node_id (segment-wide changes concern every subtree)"""
+    if 'node_id' not in change:
+        return True
+    return change['node_id'] == node_id or node_id in change['path']
+
+class ChangesHandler(tornado.web.RequestHandler):
+    """
+    GET /tree/<id>/segment/<id>/changes?since=&subtree=&epoch=&timeout= (long-poll)
+    read_changes(tree_id, segment_id, since, subtree_node_id, epoch) => (code, message, result), see app.py
+    """
+
+    def initialize(self, feed, read_changes):
+        self.feed = feed
+        self.read_changes = read_changes
+        self.future = None
+        self.closed = False
+
+    def write_envelope(self, obj, code=200, message='OK'):
+        self.set_status(code)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({'meta': {'code': '200' if code == 200 else code, 'message': message}, 'response': obj}))
+
+    @tornado.gen.coroutine
+    def get(self, tree_id, segment_id):
+        tree_id = int(tree_id)
+        segment_id = int(segment_id)
+        try:
+            since = self.get_argument('since', None)
+            since = None if since is None else int(since)
+            subtree_node_id = self.get_argument('subtree', None)
+            subtree_node_id = None if subtree_node_id is None else int(subtree_node_id)
+            timeout = min(float(self.get_argument('timeout', DEFAULT_TIMEOUT)), MAX_TIMEOUT)
+        except ValueError:
+            self.write_envelope(None, 400, 'since, subtree and timeout must be numbers')
+            return
+        epoch = self.get_argument('epoch', None)
+        deadline = IOLoop.current().time() + timeout
+        while True:
+            code, message, result = self.read_changes(tree_id, segment_id, since, subtree_node_id, epoch)
+            if code != 200 or len(result['changes']) > 0 or IOLoop.current().time() >= deadline:
+                break
+            # Nothing yet: wait for the next change of the segment (it may be outside the subtree, then read again)
+            since = result['version']
+            self.future = Future()
+            self.feed.add_waiter(tree_id, segment_id, self.future)
+            try:
+                yield tornado.gen.with_timeout(deadline, self.future)
+            except tornado.gen.TimeoutError:
+                pass
+            finally:
+                self.feed.remove_waiter(tree_id, segment_id, self.future)
+            if self.closed:
+                return
+        self.write_envelope(result, code, message)
+
+    def on_connection_close(self):
+        self.closed = True
+        if self.future is not None and not self.future.done():
+            self.future.set_result(None)
@@ -1,5 +1,13 @@
-from collections import deque
+import os
 import pickle
+import time
+from ids import IdAllocator
+from intervals import IntervalIndex
+from merkle import MerkleIndex, ViewHashes, build_hashes, diff
+from mvcc import VersionStore
+from timetravel import ChangeHistory, MISSING
+from usage import NODE_BYTES, POINTER_BYTES, UsageAccounting, added_node_bytes, node_bytes, segment_bytes
+from snapshot import FrozenSegment, is_snapshot_file, load_snapshot, load_segments, read_meta, write_segments
 
 
 class EpicTree:
@@ -10,9 +18,46 @@ class EpicTree:
         self.tree = {}
         self.materialised_paths = []
         self.garbage = []
-        # Load data file if provided
+        self.dirty_segments = set()
+        # Last write per segment (unix time), segments idle for long enough are frozen (see freeze_idle)
+        self.write_times = {}
+        self.listeners = []
+        # Ancestor / descendant labels + type and depth index (see intervals.py), built per segment when first used
+        self.intervals = IntervalIndex()
+        self.add_listener(self.intervals.record)
+        # Subtree hashes for structural diffs (see merkle.py), built per segment on its first diff
+        self.merkle = MerkleIndex()
+        self.add_listener(self.merkle.record)
+        # Pinned read versions (see mvcc.py): old values of the nodes changed while pinned
+        self.pins = VersionStore()
+        # Undo log per segment, for reads of a past version (see timetravel.py)
+        self.history = ChangeHistory()
+        self.add_listener(self.history.record_change)
+        # Node / segment IDs for unmanaged mode (see ids.py), the high-water marks are persisted with the tree
+        self.ids = IdAllocator(scan=self._get_first_free_id)
+        self.add_listener(self.ids.record)
+        # Approximate nodes / memory per tree and segment + the quotas of the trees (see usage.py)
+        self.usage = UsageAccounting()
+        self.add_listener(self.usage.record)
+        # Versions (see region Versions): the process' epoch + a clock bumped on every change
+        self.epoch = '%x' % int(time.time() * 1000000)
+        self.version = 0
+        self.reset_version = 0
+        self.tree_versions = {}
+        self.segment_versions = {}
+        self.segment_reset_versions = {}
+        self.level_versions = {}
+        # Load data file (or segments directory) if provided
         if filename != '':
-            self.tree = pickle.load(open(filename, "rb"))
+            if os.path.isdir(filename):
+                self.tree = load_segments(filename)
+                self.ids.restore(read_meta(filename).get('ids'))
+            elif is_snapshot_file(filename):
+                self.tree = load_snapshot(filename)
+                self.ids.restore(read_meta(filename).get('ids'))
+            else:
+                # Legacy pickled data file (re-written as a snapshot on the next persist)
+                self.tree = pickle.load(open(filename, "rb"))
 
     # region Trees
 
@@ -30,6 +75,7 @@ class EpicTree:
             del self.tree[tree_id]
         except KeyError:
             raise KeyError('Tree ' + str(tree_id) + ' does not exist')
+        self._changed(tree_id, None, None, {'op': 'remove_tree'})
         # No GC as we killed the entire structure for the org
         # Materialise
         self.materialised_paths = [x for x in self.materialised_paths if not x.startswith(str(tree_id) + '/')]
@@ -43,11 +89,21 @@ class EpicTree:
 
     # region Segments
 
+    def get_nodes(self, tree_id, segment_id):
+        """Nodes of a segment ({node_id: node}), resolved once and handed to the methods taking nodes="""
+        segments = self.tree.get(tree_id)
+        if segments is None:
+            raise KeyError('Tree ' + str(tree_id) + ' not found')
+        nodes = segments.get(segment_id)
+        if nodes is None:
+            raise KeyError('Segment ' + str(segment_id) + ' not found')
+        return nodes
+
     def get_segments(self, tree_id):
         """Get the segments that belong to a tree"""
         if tree_id not in self.tree:
             raise KeyError('Tree ' + str(tree_id) + ' doesn\'t exist')
-        return [a for a, data in iter(self.tree[tree_id].items())]
+        return list(self.tree[tree_id].keys())
 
     def add_segment(self, tree_id, segment_id, root_node_id):
         """Segment adding"""
@@ -55,7 +111,9 @@ class EpicTree:
             raise KeyError('Tree ' + str(tree_id) + ' doesn\'t exist')
         if segment_id in self.tree[tree_id]:
             raise KeyError('Segment ' + str(segment_id) + ' already exists')
+        self.usage.check(tree_id, self.tree[tree_id], 1, NODE_BYTES)
         self.tree[tree_id][segment_id] = {root_node_id: (None, 'root', None, 1, None)}
+        self._changed(tree_id, segment_id, None, {'op': 'add_segment', 'root_node_id': root_node_id})
         self.materialised_paths.append(str(tree_id) + '/' + str(segment_id))
         self.materialised_paths.append(str(tree_id) + '/' + str(segment_id) + '/' + str(root_node_id))
         return
@@ -66,6 +124,7 @@ class EpicTree:
         try:
             root_node_id = self.get_segment_root_node(tree_id, segment_id)
             del self.tree[tree_id][segment_id]
+            self._changed(tree_id, segment_id, None, {'op': 'remove_segment'})
             # GC (from root node)
             self.garbage.append((tree_id, segment_id, root_node_id))
         except KeyError:
@@ -79,26 +138,33 @@ class EpicTree:
         return
 
     def duplicate_segment(self, tree_id, from_segment_id, to_segment_id, segment_structure):
-        """Segment duplication"""
+        """Segment duplication (same node IDs for now)"""
         if from_segment_id not in self.tree[tree_id]:
-            raise KeyError('Segment ' + from_segment_id + ' not found in tree when trying to duplicate it')
-        old_segment = self.tree[tree_id][from_segment_id]
-        self.tree[tree_id][to_segment_id] = old_segment
+            raise KeyError('Segment ' + str(from_segment_id) + ' not found in tree when trying to duplicate it')
+        if to_segment_id in self.tree[tree_id]:
+            raise KeyError('Segment ' + str(to_segment_id) + ' already exists')
+        # A copy (children lists included), writes to one segment don't show in the other
+        segment = dict((node_id, node if node[4] is None else node[:4] + (list(node[4]),))
+                       for node_id, node in self.get_nodes(tree_id, from_segment_id).items())
+        if self.usage.enabled:
+            self.usage.check(tree_id, self.tree[tree_id], len(segment), segment_bytes(segment))
+        self.tree[tree_id][to_segment_id] = segment
+        self._changed(tree_id, to_segment_id, None, {'op': 'duplicate_segment', 'from_segment_id': from_segment_id})
+        self.usage.replace(tree_id, to_segment_id, segment)
         # TODO: Copy children! (segment_structure is a dict with hierarchical tree of new node ids)
         # TODO: materialised path
         return
 
-    def get_segment_root_node(self, tree_id, segment_id):
+    def get_segment_root_node(self, tree_id, segment_id, nodes=None):
         """Find root node ID in segment"""
         # TODO: Search materialised path first
         # Does the segment exist?
-        if tree_id not in self.tree:
-            raise KeyError('Tree ' + str(tree_id) + ' doesn\'t exist')
-        if segment_id not in self.tree[tree_id]:
-            raise KeyError('Segment ' + str(segment_id) + ' not found')
+        if nodes is None:
+            nodes = self.get_nodes(tree_id, segment_id)
+        if isinstance(nodes, FrozenSegment):
+            return nodes.root_node_id
         # Search for the root
         root_node_id = None
-        nodes = self.tree[tree_id][segment_id]
         for node_id, node in iter(nodes.items()):
             if node[1] == 'root':
                 root_node_id = node_id
@@ -109,112 +175,216 @@ class EpicTree:
 
     # region Retrieval
 
-    def get_level(self, tree_id, segment_id, parent_node_id):
-        """Get Level (children of a parent node)"""
+    def get_level(self, tree_id, segment_id, parent_node_id, nodes=None):
+        """Get Level (children of a parent node), nodes: the segment's nodes if already resolved (see get_nodes)"""
         # TODO: Search materialised path first
         # Does the segment exist?
-        if tree_id not in self.tree:
-            raise KeyError('Tree ' + str(tree_id) + ' doesn\'t exist')
-        if segment_id not in self.tree[tree_id]:
-            raise KeyError('Segment ' + str(segment_id) + ' doesn\'t exist')
-        if parent_node_id not in self.tree[tree_id][segment_id]:
+        if nodes is None:
+            nodes = self.get_nodes(tree_id, segment_id)
+        if isinstance(nodes, FrozenSegment):
+            children = nodes.level(parent_node_id)
+            if children is None:
+                raise KeyError('Parent node ' + str(parent_node_id) + ' doesn\'t exist')
+            return [{'id': child_id, 'child': child} for child_id, child in children]
+        parent_node = nodes.get(parent_node_id)
+        if parent_node is None:
             raise KeyError('Parent node ' + str(parent_node_id) + ' doesn\'t exist')
         # Get the children IDs
-        parent_node = self.tree[tree_id][segment_id][parent_node_id]
         children_ids = parent_node[4]
         # Iterate through the list and build a nice array
-        results = []
-        if children_ids is not None:
-            for child_id in children_ids:
-                results.append({'id': child_id, 'child': self.tree[tree_id][segment_id][child_id]})
-        return results
+        if children_ids is None:
+            return []
+        return [{'id': child_id, 'child': nodes[child_id]} for child_id in children_ids]
 
-    def get_breadcrumbs(self, tree_id, segment_id, node_id):
-        """Get Breadcrumbs (find ancestors)"""
+    def get_breadcrumbs(self, tree_id, segment_id, node_id, nodes=None):
+        """Get Breadcrumbs (find ancestors), nodes: the segment's nodes if already resolved (see get_nodes)"""
         # TODO: Search materialised path first
         # Does the segment exist?
-        if tree_id not in self.tree:
-            raise KeyError('Tree ' + str(tree_id) + ' doesn\'t exist')
-        if segment_id not in self.tree[tree_id]:
-            raise KeyError('Segment ' + str(segment_id) + ' doesn\'t exist')
-        if node_id not in self.tree[tree_id][segment_id]:
+        if nodes is None:
+            nodes = self.get_nodes(tree_id, segment_id)
+        if isinstance(nodes, FrozenSegment):
+            path = nodes.path(node_id)
+            if path is None:
+                raise KeyError('Node ' + str(node_id) + ' doesn\'t exist')
+            return path
+        node = nodes.get(node_id)
+        if node is None:
             raise KeyError('Node ' + str(node_id) + ' doesn\'t exist')
         # Find node by backtracing
-        node = self.tree[tree_id][segment_id][node_id]
+        path = [node_id]
         parent_node_id = node[0]
-        path = deque([node_id])
-        if parent_node_id is not None:
-            path.extendleft(reversed(self.get_breadcrumbs(tree_id, segment_id, parent_node_id)))
-        return list(path)
+        while parent_node_id is not None:
+            path.append(parent_node_id)
+            parent_node_id = nodes[parent_node_id][0]
+        path.reverse()
+        return path
+
+    def is_descendant(self, tree_id, segment_id, node_id, ancestor_node_id, nodes=None):
+        """Is node_id (strictly) under ancestor_node_id? O(1) once the segment is labelled, see intervals.py"""
+        if nodes is None:
+            nodes = self.get_nodes(tree_id, segment_id)
+        return self.intervals.is_descendant(tree_id, segment_id, nodes, node_id, ancestor_node_id)
+
+    def get_subtree(self, tree_id, segment_id, node_id, node_types=None, min_depth=1, max_depth=None, limit=None, nodes=None):
+        """
+        Nodes under node_id, parents before their children (type index + depths, see intervals.py)
+        :param node_types: list of types to return (None: all)
+        :param min_depth: levels below node_id (1: its children, 0: itself included), max_depth: None for no limit
+        :return: [{'id': node_id, 'child': node tuple, 'depth': levels below node_id}]
+        """
+        if nodes is None:
+            nodes = self.get_nodes(tree_id, segment_id)
+        if node_id not in nodes:
+            raise KeyError('Node ' + str(node_id) + ' doesn\'t exist')
+        results = self.intervals.query(tree_id, segment_id, nodes, node_id, node_types, min_depth, max_depth, limit)
+        return [{'id': x[0], 'child': nodes[x[0]], 'depth': x[1]} for x in results]
 
-    def get_tree_from_node(self, tree_id, segment_id, parent_node_id):
+    def get_tree_from_node(self, tree_id, segment_id, parent_node_id, depth=None, nodes=None):
         """
         Get tree (starting from a node) - sorted!
         :param tree_id: int
         :param segment_id: int
         :param parent_node_id: int
-        :return: []
+        :param depth: levels of children to include (None: all), directories below get child_count + expand instead
+        :return: {'id', 'type', 'data', 'sort', 'children': [...]} (children only for directories)
         """
-        # TODO: A lot of pressure is on you my little friend :)  Too many functions depend on you!
-        return
-
-    def get_tree_from_segment(self, tree_id, segment_id):
+        if nodes is None:
+            nodes = self.get_nodes(tree_id, segment_id)
+        if parent_node_id not in nodes:
+            raise KeyError('Node ' + str(parent_node_id) + ' doesn\'t exist')
+        result = _make_tree_node(parent_node_id, nodes[parent_node_id])
+        # Iterative (deep segments would hit the recursion limit): (item, node, levels below parent_node_id)
+        stack = [(result, nodes[parent_node_id], 0)]
+        while len(stack) > 0:
+            item, node, level = stack.pop()
+            children_ids = node[4]
+            if children_ids is None:
+                continue
+            if depth is not None and level >= depth and len(children_ids) > 0:
+                # Not expanded: what the client needs to ask for it later
+                item['child_count'] = len(children_ids)
+                item['expand'] = make_expand_token(segment_id, item['id'])
+                continue
+            if isinstance(nodes, FrozenSegment):
+                children = nodes.level(item['id'])
+            else:
+                children = [(x, nodes[x]) for x in children_ids]
+            children = [(_make_tree_node(x, child), child) for x, child in children]
+            children.sort(key=lambda x: x[0]['sort'])
+            item['children'] = [x[0] for x in children]
+            for child_item, child in children:
+                stack.append((child_item, child, level + 1))
+        return result
+
+    def get_tree_from_segment(self, tree_id, segment_id, depth=None, nodes=None):
         """
         Get tree (full segment) - sorted!
         :param tree_id: int
         :param segment_id: int
-        :return: []
+        :param depth: see get_tree_from_node
+        :param nodes: the segment's nodes if already resolved (or a pinned SegmentView, see pin)
+        :return: {}
         """
         # Does the segment exist?
-        if tree_id not in self.tree:
-            raise KeyError('Tree ' + str(tree_id) + ' doesn\'t exist')
-        if segment_id not in self.tree[tree_id]:
-            raise KeyError('Segment ' + str(segment_id) + ' doesn\'t exist')
-        root_node_id = self.get_segment_root_node(tree_id, segment_id)
-        return self.get_tree_from_node(tree_id, segment_id, root_node_id)
+        if nodes is None:
+            nodes = self.get_nodes(tree_id, segment_id)
+        root_node_id = self.get_segment_root_node(tree_id, segment_id, nodes)
+        return self.get_tree_from_node(tree_id, segment_id, root_node_id, depth, nodes)
 
-    def get_tree_from_segments(self, tree_id, segment_ids):
+    def get_tree_from_segments(self, tree_id, segment_ids, depth=None):
         """Get tree (set of segments) - sorted!"""
         # Does the segment exist?
-        if tree_id not in self.tree:
-            raise KeyError('Tree ' + str(tree_id) + ' doesn\'t exist')
         for segment_id in segment_ids:
-            if segment_id not in self.tree[tree_id]:
-                raise KeyError('Segment ' + str(segment_id) + ' doesn\'t exist')
+            self.get_nodes(tree_id, segment_id)
         # Build structure (array containing trees representing each segment)
         results = {}
         for segment_id in segment_ids:
-            results[segment_id] = self.get_tree_from_segment(tree_id, segment_id)
+            results[segment_id] = self.get_tree_from_segment(tree_id, segment_id, depth)
         return results
 
-    def get_tree(self, tree_id):
+    def get_tree(self, tree_id, depth=None):
         """Get tree"""
         # Does the segment exist?
         if tree_id not in self.tree:
             raise KeyError('Tree ' + str(tree_id) + ' doesn\'t exist')
         segment_ids = self.get_segments(tree_id)
-        return self.get_tree_from_segments(tree_id, segment_ids)
-
-    def get_everything(self):
-        """Get tree (everything)"""
+        return self.get_tree_from_segments(tree_id, segment_ids, depth)
+
+    def get_everything(self, pinned=None):
+        """Get tree (everything), pinned: export a pinned version instead of the live tree (see pin)"""
+        if pinned is not None:
+            results = {}
+            for tree_id, segments in iter(pinned.tree.items()):
+                results[tree_id] = {}
+                for segment_id, nodes in iter(segments.items()):
+                    results[tree_id][segment_id] = self.get_tree_from_segment(tree_id, segment_id, None, nodes)
+            return results
         tree_ids = self.get_trees()
         results = {}
         for tree_id in tree_ids:
             results[tree_id] = self.get_tree(tree_id)
         return results
 
+    def get_nodes_as_of(self, tree_id, segment_id, version=None, timestamp=None):
+        """
+        A segment as it was at a version (of the tree clock) or a unix time, for the readers (nodes=)
+        Raises KeyError if the segment doesn't exist now, timetravel.HistoryExpired if it can't go back that far
+        """
+        nodes = self.get_nodes(tree_id, segment_id)
+        if (version is None or version >= self.version) and (timestamp is None or timestamp >= time.time()):
+            return nodes
+        return self.history.view(tree_id, segment_id, nodes, version, timestamp)
+
+    def diff_segments(self, tree_id, from_segment_id, segment_id):
+        """What changed from one segment to another (e.g. a template and its copy), see merkle.diff"""
+        from_nodes = self.get_nodes(tree_id, from_segment_id)
+        nodes = self.get_nodes(tree_id, segment_id)
+        return diff(from_nodes, self.merkle.hashes(tree_id, from_segment_id, from_nodes),
+                    nodes, self.merkle.hashes(tree_id, segment_id, nodes))
+
+    def diff_as_of(self, tree_id, segment_id, version=None, timestamp=None):
+        """What changed in a segment since a version / unix time (see get_nodes_as_of, merkle.diff)"""
+        nodes = self.get_nodes(tree_id, segment_id)
+        hashes = self.merkle.hashes(tree_id, segment_id, nodes)
+        from_nodes = self.get_nodes_as_of(tree_id, segment_id, version, timestamp)
+        if from_nodes is nodes:
+            return diff(nodes, hashes, nodes, hashes)
+        return diff(from_nodes, ViewHashes(from_nodes, hashes), nodes, hashes)
+
+    def diff_from_nodes(self, from_nodes, tree_id, segment_id):
+        """What changed from a segment dict that isn't in the tree (e.g. loaded from a backup) to a segment"""
+        nodes = self.get_nodes(tree_id, segment_id)
+        return diff(from_nodes, build_hashes(from_nodes), nodes, self.merkle.hashes(tree_id, segment_id, nodes))
+
+    def pin(self, tree_id=None, segment_id=None):
+        """
+        Pin everything (or a tree, or a segment) as it is now, for readers that take their time (or run in another
+        thread): changes made afterwards aren't seen through it. Call on the writers' thread, release when done.
+        :return: mvcc.PinnedTree (pinned.tree: {tree_id: {segment_id: SegmentView}}, usable as nodes=, segments still
+        encoded or frozen are passed through as they are)
+        """
+        if segment_id is not None:
+            tree = {tree_id: {segment_id: self.get_nodes(tree_id, segment_id)}}
+        elif tree_id is not None:
+            if tree_id not in self.tree:
+                raise KeyError('Tree ' + str(tree_id) + ' doesn\'t exist')
+            tree = {tree_id: self.tree[tree_id]}
+        else:
+            tree = self.tree
+        return self.pins.pin(self.version, tree)
+
     # endregion
 
     # region Directories
 
-    def add_directory(self, tree_id, segment_id, parent_node_id, node_id, sort, children):
+    def add_directory(self, tree_id, segment_id, parent_node_id, node_id, sort, children, nodes=None):
         """Directory adding (optional sort which causes re-sorting, otherwise placed at end)"""
-        self.add_node(tree_id, segment_id, parent_node_id, node_id, sort, children, 'dir', None)
+        self.add_node(tree_id, segment_id, parent_node_id, node_id, sort, children, 'dir', None, nodes)
         return
 
-    def remove_directory(self, tree_id, segment_id, node_id):
+    def remove_directory(self, tree_id, segment_id, node_id, nodes=None):
         """Directory removal"""
-        self.remove_node(tree_id, segment_id, node_id)
+        self.remove_node(tree_id, segment_id, node_id, nodes)
         return
 
     def duplicate_directory(self, tree_id, segment_id, node_id):
@@ -232,16 +402,13 @@ class EpicTree:
 
     # region Nodes
 
-    def add_node(self, tree_id, segment_id, parent_node_id, node_id, sort, children, node_type, payload):
+    def add_node(self, tree_id, segment_id, parent_node_id, node_id, sort, children, node_type, payload, nodes=None):
         """Node adding (optional sort which causes re-sorting, otherwise placed at end)"""
-        # Does the segment exist?
-        if tree_id not in self.tree:
-            raise KeyError('Tree ' + str(tree_id) + ' doesn\'t exist')
-        if segment_id not in self.tree[tree_id]:
-            raise KeyError('Segment ' + str(tree_id) + ' doesn\'t exist')
+        # Does the segment exist? (thawed if it was frozen)
+        nodes = self._get_writable_nodes(tree_id, segment_id, nodes)
         # Get parent and level
         re_sort = True
-        parent_node = self.tree[tree_id][segment_id][parent_node_id]
+        parent_node = nodes[parent_node_id]
         level_nodes = parent_node[4]
         # If parent is not dir or root, don't allow addition
         if parent_node[1] != 'root' and parent_node[1] != 'dir':
@@ -254,7 +421,7 @@ class EpicTree:
         # If sort is set, but exceeds maximum current sort in level by more than 1 (or is equal), set to max + 1
         if sort is not None:
             if level_nodes is not None and len(level_nodes) > 1:
-                max_sort = self._get_max_sort_at_level(tree_id, segment_id, level_nodes)
+                max_sort = self._get_max_sort_at_level(tree_id, segment_id, level_nodes, nodes)
                 if sort > (max_sort + 1) or sort == max_sort:
                     sort = max_sort + 1
                     re_sort = False
@@ -267,57 +434,98 @@ class EpicTree:
             if level_nodes is None or len(level_nodes) == 0:
                 sort = 1
             else:
-                max_sort = self._get_max_sort_at_level(tree_id, segment_id, level_nodes)
+                max_sort = self._get_max_sort_at_level(tree_id, segment_id, level_nodes, nodes)
                 if max_sort is not None:
                     sort = max_sort + 1
                 else:
                     sort = 1
             re_sort = False
+        # Quota (see usage.py)
+        node = (parent_node_id, node_type, payload, sort, children)
+        size = added_node_bytes(node, parent_node)
+        self.usage.check(tree_id, self.tree[tree_id], 1, size)
+        # Pinned readers keep seeing the nodes as they were (copy-on-write, see mvcc.py)
+        saved = ()
+        if self.pins.is_pinned(nodes):
+            saved = self._before_write(nodes, [node_id, parent_node_id] + (level_nodes if re_sort and level_nodes else []))
+        # Undo, for time travel (see timetravel.py)
+        if self.history.size > 0:
+            undo = [('node', node_id, nodes.get(node_id, MISSING))]
+            if re_sort:
+                # Siblings with sort >= sort move one up (see _increment_sort_after_item)
+                undo.append(('sort', parent_node_id, sort + 1, 1))
+            if parent_node[4] is None:
+                undo.append(('node', parent_node_id, parent_node))
+            undo.append(('append', parent_node_id, node_id))
+            self.history.record(tree_id, segment_id, self.version + 1, undo)
         # Add child
-        self.tree[tree_id][segment_id][node_id] = (parent_node_id, node_type, payload, sort, children)
+        nodes[node_id] = node
         if re_sort is True:
-            self._increment_sort_after_item(tree_id, segment_id, sort, parent_node_id, node_id)
+            self._increment_sort_after_item(tree_id, segment_id, sort, parent_node_id, node_id, nodes)
         # Add child to parent's list of children
-        parent_node = self.tree[tree_id][segment_id][parent_node_id]
+        parent_node = nodes[parent_node_id]
         new_children = parent_node[4]
         if new_children is None:
             new_children = []
+        elif parent_node_id in saved:
+            new_children = list(new_children)
         new_children.append(node_id)
         parent_node = (parent_node[0], parent_node[1], parent_node[2], parent_node[3], new_children)
-        self.tree[tree_id][segment_id][parent_node_id] = parent_node
+        nodes[parent_node_id] = parent_node
+        self.usage.add(tree_id, segment_id, 1, size)
         # Materialised path
-        breadcrumbs = self.get_breadcrumbs(tree_id, segment_id, node_id)
+        breadcrumbs = self.get_breadcrumbs(tree_id, segment_id, node_id, nodes)
         self.materialised_paths.append(str(tree_id) + '/' + str(segment_id) + '/' + '/'.join(str(x) for x in breadcrumbs))
+        self._changed(tree_id, segment_id, [parent_node_id, node_id], {
+            'op': 'add_node', 'node_id': node_id, 'parent_node_id': parent_node_id, 'type': node_type,
+            'payload': payload, 'sort': sort, 'shifted': re_sort, 'path': breadcrumbs[:-1]
+        })
         # TODO: also have an override sort option (for quick DB import)
         return
 
-    def remove_node(self, tree_id, segment_id, node_id):
+    def remove_node(self, tree_id, segment_id, node_id, nodes=None):
         """Remove node (re-sort level fully, GC, materialise)"""
-        # Does the segment exist?
-        if tree_id not in self.tree:
-            raise KeyError('Tree ' + str(tree_id) + ' doesn\'t exist')
-        if segment_id not in self.tree[tree_id]:
-            raise KeyError('Segment ' + str(tree_id) + ' doesn\'t exist')
+        # Does the segment exist? (thawed if it was frozen)
+        nodes = self._get_writable_nodes(tree_id, segment_id, nodes)
         # This is not the root right?
-        node = self.tree[tree_id][segment_id][node_id]
+        node = nodes[node_id]
         if node[1] == 'root':
             raise Exception('You can\'t remove the root of a segment')
         # Get parent
         parent_node_id = node[0]
-        parent_node = self.tree[tree_id][segment_id][parent_node_id]
+        parent_node = nodes[parent_node_id]
         # Get breadcrumbs (before we delete the node)
-        breadcrumbs = self.get_breadcrumbs(tree_id, segment_id, node_id)
+        breadcrumbs = self.get_breadcrumbs(tree_id, segment_id, node_id, nodes)
+        # Pinned readers keep seeing the nodes as they were (copy-on-write, see mvcc.py)
+        if self.pins.is_pinned(nodes) and parent_node_id in self._before_write(nodes, [node_id, parent_node_id] + parent_node[4]):
+            parent_node = (parent_node[0], parent_node[1], parent_node[2], parent_node[3], list(parent_node[4]))
+        # Undo, for time travel (see timetravel.py): back in the list, the siblings' sorts, the node
+        undo = None
+        if self.history.size > 0:
+            undo = []
+            if node_id in parent_node[4]:
+                undo.append(('remove', parent_node_id, node_id, parent_node[4].index(node_id)))
+            sibling_sorts = [(x, nodes[x][3]) for x in parent_node[4] if x != node_id]
         # Remove child from parent (if found)
         new_children = parent_node[4]
         if node_id in new_children:
             new_children.remove(node_id)
             parent_node = (parent_node[0], parent_node[1], parent_node[2], parent_node[3], new_children)
-            self.tree[tree_id][segment_id][parent_node_id] = parent_node
+            nodes[parent_node_id] = parent_node
         # Re-sort items at parent's level
-        self._re_sort_level(tree_id, segment_id, parent_node_id)
+        self._re_sort_level(tree_id, segment_id, parent_node_id, nodes)
+        if undo is not None:
+            undo.extend(self._get_sort_undo(nodes, parent_node_id, node[3], sibling_sorts))
+            undo.append(('node', node_id, node))
+            self.history.record(tree_id, segment_id, self.version + 1, undo)
         # Non-atomic function, so we use try..except
         try:
-            del self.tree[tree_id][segment_id][node_id]
+            del nodes[node_id]
+            self.usage.add(tree_id, segment_id, -1, -node_bytes(node) - POINTER_BYTES)
+            self._changed(tree_id, segment_id, [parent_node_id, node_id], {
+                'op': 'remove_node', 'node_id': node_id, 'parent_node_id': parent_node_id, 'sort': node[3],
+                'path': breadcrumbs[:-1]
+            })
             # GC (from root node)
             if node[1] == 'dir':
                 self.garbage.append((tree_id, segment_id, node_id))
@@ -332,7 +540,7 @@ class EpicTree:
             if node[1] == 'dir':
                 route_children = str(tree_id) + '/' + str(segment_id) + '/' + material_path_to_node + '/'
                 self.materialised_paths = [x for x in self.materialised_paths if not x.startswith(route_children)]
-        except KeyError:
+        except ValueError:
             # TODO: Log
             pass
         return
@@ -361,10 +569,36 @@ class EpicTree:
             self.tree = {}
             self.garbage = []
             self.materialised_paths = []
+            self.dirty_segments = set()
+            self.write_times = {}
+            self.tree_versions = {}
+            self.segment_versions = {}
+            self.segment_reset_versions = {}
+            self.level_versions = {}
         except KeyError:
             raise KeyError('Error clearing everything')
+        self._changed(None, None, None, {'op': 'clear'})
+        return
+
+    def add_listener(self, listener):
+        """
+        Call listener(tree_id, segment_id, node_ids, change) after every change
+        node_ids None means the whole segment (segment_id None: the whole tree, tree_id None: everything),
+        change describes the mutation: op, version, tree_id, segment_id + the fields of the op (see the _changed calls)
+        """
+        self.listeners.append(listener)
         return
 
+    def get_meta(self):
+        """What is persisted with the tree besides the nodes (snapshot meta / manifest)"""
+        return {'ids': self.ids.get_high_water()}
+
+    def persist_segments(self, directory):
+        """Incremental persistence: only re-write the segments changed since the last call (+ manifest)"""
+        written = write_segments(self.tree, directory, self.dirty_segments, self.get_meta())
+        self.dirty_segments = set()
+        return written
+
     # GC (traverse tree, starting from children that point to deletednode_id, kill all orphans!)
     def gc(self):
         # TODO
@@ -376,6 +610,144 @@ class EpicTree:
 
     # endregion
 
+    # region Versions
+
+    def get_segment_version(self, tree_id, segment_id):
+        """Version of a segment (changes with any node of the segment)"""
+        return max(self._get_base_version(tree_id, segment_id), self.segment_versions.get((tree_id, segment_id), 0))
+
+    def get_level_version(self, tree_id, segment_id, parent_node_id):
+        """Version of a level (changes when children are added/removed/re-sorted under the parent)"""
+        return max(self._get_base_version(tree_id, segment_id), self.level_versions.get((tree_id, segment_id, parent_node_id), 0))
+
+    def get_breadcrumbs_version(self, tree_id, segment_id, node_id):
+        """Version of the breadcrumbs of a node (changes with the levels of its ancestors)"""
+        version = self._get_base_version(tree_id, segment_id)
+        nodes = self.tree.get(tree_id, {}).get(segment_id)
+        if nodes is None or node_id not in nodes:
+            return version
+        parent_node_id = nodes[node_id][0]
+        while parent_node_id is not None and parent_node_id in nodes:
+            version = max(version, self.level_versions.get((tree_id, segment_id, parent_node_id), 0))
+            parent_node_id = nodes[parent_node_id][0]
+        return version
+
+    # endregion
+
+    # region Tiering (frozen segments)
+
+    def freeze_idle(self, idle_seconds, now=None, max_nodes=None):
+        """
+        Freeze the segments not written for idle_seconds (since their last write, or since the first call for the
+        segments not written since they were loaded) into snapshot.FrozenSegment, thawed again by their next write
+        max_nodes: stop once that many nodes were frozen (the rest is left for the next call), at least one segment
+        :return: number of segments frozen
+        """
+        now = time.time() if now is None else now
+        frozen = 0
+        frozen_nodes = 0
+        for tree_id, segments in iter(self.tree.items()):
+            # Segments still encoded (loaded from a snapshot, never used) are left as they are
+            for segment_id, nodes in iter(dict.items(segments)):
+                if type(nodes) is not dict:
+                    continue
+                if now - self.write_times.setdefault((tree_id, segment_id), now) >= idle_seconds:
+                    self._replace_nodes(tree_id, segment_id, nodes, FrozenSegment(nodes))
+                    frozen += 1
+                    frozen_nodes += len(nodes)
+                    if max_nodes is not None and frozen_nodes >= max_nodes:
+                        return frozen
+        return frozen
+
+    def get_frozen_segments(self):
+        """(tree_id, segment_id) of the frozen segments"""
+        return [(tree_id, segment_id) for tree_id, segments in iter(self.tree.items())
+                for segment_id, nodes in iter(dict.items(segments)) if isinstance(nodes, FrozenSegment)]
+
+    # endregion
+
+    # region Usage and quotas
+
+    def get_usage(self, tree_id, segment_details=False):
+        """Approximate nodes / bytes of a tree and its quota (see usage.py), segment_details: per segment too"""
+        if tree_id not in self.tree:
+            raise KeyError('Tree ' + str(tree_id) + ' doesn\'t exist')
+        return self.usage.get_usage(tree_id, self.tree[tree_id], segment_details)
+
+    def set_quotas(self, max_nodes=0, max_bytes=0, tenant_scales=None):
+        """Nodes / bytes per tree (0: no quota), tenant_scales {tree_id: scale}, writes over it raise QuotaExceeded"""
+        self.usage.configure(max_nodes, max_bytes, tenant_scales)
+        return
+
+    # endregion
+
+    # region IDs (unmanaged mode)
+
+    def allocate_node_id(self):
+        """Node ID never used by this tree (from the allocator's current block, see ids.py)"""
+        return self.ids.allocate('node')
+
+    def allocate_segment_id(self):
+        return self.ids.allocate('segment')
+
+    def reserve_ids(self, kind, count):
+        """Reserve count consecutive node / segment IDs for a batch import: (first, last)"""
+        return self.ids.reserve(kind, count)
+
+    # endregion
+
+    # region Private: Change tracking
+
+    def _changed(self, tree_id, segment_id, node_ids, change):
+        """Nodes (or a whole segment / tree) changed: mark the segment for the next incremental persist, notify listeners"""
+        self.version += 1
+        if tree_id is None:
+            self.reset_version = self.version
+        elif segment_id is None:
+            self.tree_versions[tree_id] = self.version
+        else:
+            self.dirty_segments.add((tree_id, segment_id))
+            self.write_times[(tree_id, segment_id)] = time.time()
+            self.segment_versions[(tree_id, segment_id)] = self.version
+            if node_ids is None:
+                self.segment_reset_versions[(tree_id, segment_id)] = self.version
+            else:
+                for node_id in node_ids:
+                    self.level_versions[(tree_id, segment_id, node_id)] = self.version
+        change['version'] = self.version
+        change['tree_id'] = tree_id
+        change['segment_id'] = segment_id
+        for listener in self.listeners:
+            listener(tree_id, segment_id, node_ids, change)
+        return
+
+    def _before_write(self, nodes, node_ids):
+        """These nodes of a pinned segment are about to change (the change will be self.version + 1), see mvcc.py"""
+        return self.pins.before_write(nodes, self.version + 1, node_ids)
+
+    def _get_writable_nodes(self, tree_id, segment_id, nodes=None):
+        """Nodes of a segment about to be written: a frozen segment is thawed back into a dict first"""
+        if nodes is None:
+            nodes = self.get_nodes(tree_id, segment_id)
+        if isinstance(nodes, FrozenSegment):
+            frozen = nodes
+            nodes = frozen.to_dict()
+            self._replace_nodes(tree_id, segment_id, frozen, nodes)
+        return nodes
+
+    def _replace_nodes(self, tree_id, segment_id, old_nodes, nodes):
+        """Same segment, other storage (frozen / thawed): nothing changed, so no versions or listeners"""
+        self.tree[tree_id][segment_id] = nodes
+        self.merkle.replace(tree_id, segment_id, old_nodes, nodes)
+        self.usage.replace(tree_id, segment_id, nodes)
+        return
+
+    def _get_base_version(self, tree_id, segment_id):
+        """Last time the segment was replaced as a whole (or its tree / everything was)"""
+        return max(self.reset_version, self.tree_versions.get(tree_id, 0), self.segment_reset_versions.get((tree_id, segment_id), 0))
+
+    # endregion
+
     # region Private: Tree traversal & search
 
     def _find_node_from_root(self, tree_id, segment_id, search_node_id):
@@ -419,61 +791,79 @@ class EpicTree:
         # Nothing found in children? Let's head back up!
         return None
 
+    def _get_first_free_id(self, kind):
+        """Highest node / segment ID in the tree + 1 (only needed once, when no high-water mark was persisted)"""
+        highest = 0
+        for segments in self.tree.values():
+            for segment_id in segments.keys():
+                if kind == 'segment':
+                    highest = max(highest, segment_id)
+                else:
+                    highest = max([highest] + list(segments[segment_id].keys()))
+        return highest + 1
+
     # endregion
 
     # region Private: Sorting
 
-    def _get_max_sort_at_level(self, tree_id, segment_id, level_node_ids):
+    def _get_max_sort_at_level(self, tree_id, segment_id, level_node_ids, nodes=None):
         """
         Get maximum current sort for a level
         :param tree_id:
         :param segment_id:
         :param level_node_ids:
+        :param nodes: the segment's nodes if already resolved (see get_nodes)
         :return:
         """
+        if nodes is None:
+            nodes = self.get_nodes(tree_id, segment_id)
         max_sort = -1
         for node_id in level_node_ids:
-            node_sort = self.tree[tree_id][segment_id][node_id][3]
+            node_sort = nodes[node_id][3]
             if node_sort > max_sort:
                 max_sort = node_sort
         if max_sort == -1:
             return None
         return max_sort
 
-    def _re_sort_item(self, tree_id, segment_id, modified_node_id):
+    def _re_sort_item(self, tree_id, segment_id, modified_node_id, nodes=None):
         """
         Re-sort (e.g. new node with sort 4 causes all with 4 or greater to increment by 1)
         This is more of something that happens after node insertion or change (like a listener)
         :param tree_id:
         :param segment_id:
         :param modified_node_id:
+        :param nodes: the segment's nodes if already resolved (see _get_writable_nodes)
         :return:
         """
+        nodes = self._get_writable_nodes(tree_id, segment_id, nodes)
         # Get modified node
-        modified_node = self.tree[tree_id][segment_id][modified_node_id]
+        modified_node = nodes[modified_node_id]
         modified_sort_position = modified_node[3]
         # Get parent
-        parent_node = self.tree[tree_id][segment_id][modified_node[0]]
+        parent_node = nodes[modified_node[0]]
         # Get siblings (children of parent)
         sibling_ids = parent_node[4]
         # Find those greater or equal to sort of modified_node_id + increment by 1
         if sibling_ids is not None and len(sibling_ids) > 1:
             for node_id in sibling_ids:
-                node = self.tree[tree_id][segment_id][node_id]
+                node = nodes[node_id]
                 if node[3] >= modified_sort_position and node_id != modified_node_id:
-                    self.tree[tree_id][segment_id][node_id] = (node[0], node[1], node[2], node[3] + 1, node[4])
+                    nodes[node_id] = (node[0], node[1], node[2], node[3] + 1, node[4])
         return
 
-    def _re_sort_level(self, tree_id, segment_id, parent_node_id):
+    def _re_sort_level(self, tree_id, segment_id, parent_node_id, nodes=None):
         """
         Re-sort level fully (check for gaps, duplicates, negatives, etc.) called after node deletion, etc.
         :param tree_id:
         :param segment_id:
         :param parent_node_id:
+        :param nodes: the segment's nodes if already resolved (see _get_writable_nodes)
         :return:
         """
+        nodes = self._get_writable_nodes(tree_id, segment_id, nodes)
         # Get parent
-        parent_node = self.tree[tree_id][segment_id][parent_node_id]
+        parent_node = nodes[parent_node_id]
         # Get level nodes (children of parent)
         level_node_ids = parent_node[4]
         level_nodes = {}
@@ -482,13 +872,13 @@ class EpicTree:
             return
         # Form a dict which we will sort
         for level_node_id in level_node_ids:
-            level_nodes[level_node_id] = self.tree[tree_id][segment_id][level_node_id]
+            level_nodes[level_node_id] = nodes[level_node_id]
         # If only one item, set to 1
         if len(level_node_ids) == 1:
             node_id = level_node_ids[0]
-            node = self.tree[tree_id][segment_id][node_id]
+            node = nodes[node_id]
             if node[3] != 1:
-                self.tree[tree_id][segment_id][node_id] = (node[0], node[1], node[2], 1, node[4])
+                nodes[node_id] = (node[0], node[1], node[2], 1, node[4])
         # If more than one item, restructure
         elif len(level_node_ids) > 1:
             # Get sorted list first
@@ -499,14 +889,14 @@ class EpicTree:
                 min_sort = first_node[3]
                 for node_id, node in iter(level_nodes.items()):
                     new_node_sort = node[3] - min_sort + 1
-                    self.tree[tree_id][segment_id][node_id] = (node[0], node[1], node[2], new_node_sort, node[4])
+                    nodes[node_id] = (node[0], node[1], node[2], new_node_sort, node[4])
             # Starts < 1? Push all forward by ABS(MIN(sort)) + 1
             elif first_node[3] < 1:
                 min_sort = first_node[3]
                 new_min_sort = abs(min_sort) + 1
                 for node_id, node in iter(level_nodes.items()):
                     new_node_sort = node[3] + new_min_sort
-                    self.tree[tree_id][segment_id][node_id] = (node[0], node[1], node[2], new_node_sort, node[4])
+                    nodes[node_id] = (node[0], node[1], node[2], new_node_sort, node[4])
             # Duplicates: higher node ID is pushed afterwards
             duplicates = []
             all_sorts = []
@@ -519,7 +909,7 @@ class EpicTree:
             for duplicate_node_id in duplicates:
                 # TODO: Horrible, can be fixed afterwards as it is O(n^2)
                 # Might also cause issues if more than one duplicate with same sort_number)
-                self._re_sort_item(tree_id, segment_id, duplicate_node_id)
+                self._re_sort_item(tree_id, segment_id, duplicate_node_id, nodes)
             # Gaps: Push all afterwards back by one
             gaps = []
             prev_sort = 0
@@ -537,18 +927,28 @@ class EpicTree:
                     if prev_node_id is not None and (node_id in gaps or started_gap_fixing is True):
                         node = level_nodes[node_id]
                         sort_number = node[3]  # eg. 8
-                        prev_node = self.tree[tree_id][segment_id][prev_node_id] # Has to be from the tree!
+                        prev_node = nodes[prev_node_id] # Has to be from the tree!
                         prev_sort_number = prev_node[3] # eg. 5
                         if sort_number > (prev_sort_number + 1):
                             difference = sort_number - prev_sort_number # eg. 3
                             new_node_sort = sort_number - difference + 1
-                            self.tree[tree_id][segment_id][node_id] = (node[0], node[1], node[2], new_node_sort, node[4])
+                            nodes[node_id] = (node[0], node[1], node[2], new_node_sort, node[4])
                         started_gap_fixing = True
                     prev_node_id = node_id
         level_nodes = None  # GC just in case
         return
 
-    def _increment_sort_after_item(self, tree_id, segment_id, sort_number, parent_node_id, modified_node_id):
+    def _get_sort_undo(self, nodes, parent_node_id, removed_sort, sibling_sorts):
+        """Undo of the re-sort after a removal: one op if the siblings after it just moved down, else their old sorts"""
+        changed = [(x, old_sort) for x, old_sort in sibling_sorts if nodes[x][3] != old_sort]
+        if len(changed) == 0:
+            return []
+        if all(old_sort != removed_sort and nodes[x][3] == (old_sort - 1 if old_sort > removed_sort else old_sort)
+               for x, old_sort in sibling_sorts):
+            return [('sort', parent_node_id, removed_sort, -1)]
+        return [('node', x, nodes[x][:3] + (old_sort, nodes[x][4])) for x, old_sort in changed]
+
+    def _increment_sort_after_item(self, tree_id, segment_id, sort_number, parent_node_id, modified_node_id, nodes=None):
         """
         Looks for a specific sort target (e.g. 4) and increments all greater than that
         allowing insertion of an item '5' now that 5 became 6
@@ -558,18 +958,32 @@ class EpicTree:
         :param sort_number:
         :param parent_node_id:
         :param node_id:
+        :param nodes: the segment's nodes if already resolved (see _get_writable_nodes)
         :return:
         """
+        nodes = self._get_writable_nodes(tree_id, segment_id, nodes)
         # Get parent
-        parent_node = self.tree[tree_id][segment_id][parent_node_id]
+        parent_node = nodes[parent_node_id]
         # Get siblings (children of parent)
         sibling_ids = parent_node[4]
         # Find those greater or equal to sort of modified_node_id + increment by 1
         if sibling_ids is not None and len(sibling_ids) > 1:
             for node_id in sibling_ids:
-                node = self.tree[tree_id][segment_id][node_id]
+                node = nodes[node_id]
                 if node[3] >= sort_number and node_id != modified_node_id:
-                    self.tree[tree_id][segment_id][node_id] = (node[0], node[1], node[2], node[3] + 1, node[4])
+                    nodes[node_id] = (node[0], node[1], node[2], node[3] + 1, node[4])
         return
 
     # endregion
+
+def make_expand_token(segment_id, node_id):
+    """Token of a directory left out of a depth-limited tree (see get_tree_from_node)"""
+    return str(segment_id) + '.' + str(node_id)
+
+def parse_expand_token(token):
+    """(segment_id, node_id) of an expand token, ValueError if it isn't one"""
+    segment_id, node_id = token.split('.')
+    return int(segment_id), int(node_id)
+
+def _make_tree_node(node_id, node):
+    return {'id': node_id, 'type': node[1], 'data': node[2], 'sort': node[3]}
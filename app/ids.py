@@ -0,0 +1,82 @@
+"""
+ID allocation for unmanaged mode: node and segment IDs handed out from pre-reserved blocks
+
+    ids = IdAllocator(scan=lambda kind: highest_existing_id + 1)
+    ids.allocate('node')            # next ID of the current block (a new block is reserved when it runs out)
+    ids.reserve('node', 50000)      # (first, last): a range of its own, for batch imports
+
+The high-water mark (end of the last reserved block, per kind) is what gets persisted with the tree (snapshot meta /
+segments manifest): after a restart allocation starts from it, so an ID is never handed out twice, at the cost of
+the unused end of the last block. IDs the callers supply themselves (managed creates) are recorded from the EpicTree
+changes and skipped. Without a persisted mark (data from before, or a new tree) scan gives the first free ID, once.
+"""
+
+KINDS = ('node', 'segment')
+
+class IdAllocator:
+    """Block allocator per kind of ID (EpicTree listener, see EpicTree.add_listener)"""
+
+    def __init__(self, block_size=1000, scan=None, high_water=None):
+        self.block_size = block_size
+        self.scan = scan
+        # kind => end of the last reserved block (exclusive), next ID and end of the current block
+        self.high_water = {}
+        self.next = {}
+        self.limit = {}
+        self.restore(high_water)
+
+    def restore(self, high_water):
+        """Start from persisted high-water marks ({kind: mark}), the blocks in use before are not reused"""
+        self.next = {}
+        self.limit = {}
+        self.high_water = dict((kind, int(mark)) for kind, mark in iter((high_water or {}).items()))
+        return
+
+    def get_high_water(self):
+        """{kind: mark}, to persist with the tree"""
+        return dict(self.high_water)
+
+    def allocate(self, kind):
+        node_id = self.next.get(kind)
+        if node_id is None or node_id >= self.limit[kind]:
+            node_id, last = self.reserve(kind, self.block_size)
+            self.limit[kind] = last + 1
+        self.next[kind] = node_id + 1
+        return node_id
+
+    def reserve(self, kind, count):
+        """Reserve count consecutive IDs (not handed out by allocate): (first, last)"""
+        if kind not in KINDS:
+            raise ValueError('Kind must be one of ' + ', '.join(KINDS))
+        if count < 1:
+            raise ValueError('Count must be at least 1')
+        first = self._get_high_water(kind)
+        self.high_water[kind] = first + count
+        return first, first + count - 1
+
+    def observe(self, kind, value):
+        """An ID was used without being allocated: never hand it out"""
+        if value is None or kind not in self.high_water:
+            # Not initialised yet: the scan will see it
+            return
+        if value >= self.high_water[kind]:
+            self.high_water[kind] = value + 1
+        elif self.next.get(kind) is not None and self.next[kind] <= value < self.limit[kind]:
+            self.next[kind] = value + 1
+        return
+
+    def record(self, tree_id, segment_id, node_ids, change):
+        op = change['op']
+        if op == 'add_node':
+            self.observe('node', change['node_id'])
+        elif op == 'add_segment':
+            self.observe('segment', segment_id)
+            self.observe('node', change['root_node_id'])
+        elif op == 'duplicate_segment':
+            self.observe('segment', segment_id)
+        return
+
+    def _get_high_water(self, kind):
+        if kind not in self.high_water:
+            self.high_water[kind] = self.scan(kind) if self.scan is not None else 1
+        return self.high_water[kind]
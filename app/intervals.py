@@ -0,0 +1,203 @@
+"""
+Nested-interval labels for ancestor / descendant checks in O(1), and subtree queries by type and depth
+
+Every node of a segment gets an interval [lo, hi] inside its parent's: X is under Y if lo(Y) < lo(X) <= hi(Y).
+Labels are built on the first question about a segment (one walk from the root), then kept up to date from the
+EpicTree changes: a new node takes a slice of the free space left at the end of its parent's interval (gaps are
+huge, Python integers don't overflow), a removed leaf just drops its label. When a parent runs out of space, a
+directory with children is removed, or the segment is replaced, the segment's labels are dropped and rebuilt on
+the next question.
+
+Each segment also keeps (lo, node_id) lists sorted by lo, per node type and per depth: the nodes of a type (or at a
+depth) under Y are one slice of a list, found by bisection, so a subtree query costs what it returns.
+"""
+
+# Standard libraries
+from bisect import bisect_left, insort
+import heapq
+import itertools
+
+# Space between consecutive labels when building: new nodes take 1/SLICE of their parent's free space, so a
+# parent fits ~20000 appends and a chain of ~14 new directories before its segment is rebuilt (bigger gaps
+# allow more, at the cost of bigger integers in memory)
+GAP = 1 << 128
+SLICE = 256
+
+# Label fields
+LO = 0
+HI = 1
+FREE = 2
+DEPTH = 3
+TYPE = 4
+
+class SegmentLabels:
+    """Labels of one segment: node_id => [lo, hi, start of the free space for the next child, depth, type]"""
+
+    def __init__(self):
+        self.labels = {}
+        # type / depth => [(lo, node_id)] sorted
+        self.types = {}
+        self.depths = {}
+
+    def add(self, node_id, lo, hi, depth, node_type):
+        self.labels[node_id] = [lo, hi, lo + 1, depth, node_type]
+        insort(self.types.setdefault(node_type, []), (lo, node_id))
+        insort(self.depths.setdefault(depth, []), (lo, node_id))
+        return
+
+    def remove(self, node_id):
+        """Drop a node's label (returns it, None if it had none)"""
+        label = self.labels.pop(node_id, None)
+        if label is not None:
+            _remove_sorted(self.types, label[TYPE], (label[LO], node_id))
+            _remove_sorted(self.depths, label[DEPTH], (label[LO], node_id))
+        return label
+
+    def query(self, node_id, node_types=None, min_depth=1, max_depth=None):
+        """Node IDs under node_id (min_depth 0: itself included) in label order (parents before their children)"""
+        label = self.labels.get(node_id)
+        if label is None:
+            return iter(())
+        lo, hi, depth = label[LO], label[HI], label[DEPTH]
+        if min_depth == 0:
+            lo -= 1
+        min_depth += depth
+        max_depth = None if max_depth is None else max_depth + depth
+        if node_types is not None:
+            # Per type, filtered on depth
+            ranges = [_range(self.types.get(x, ()), lo, hi) for x in node_types]
+            matches = heapq.merge(*ranges) if len(ranges) > 1 else ranges[0]
+            return (x[1] for x in matches if min_depth <= self.labels[x[1]][DEPTH] and
+                    (max_depth is None or self.labels[x[1]][DEPTH] <= max_depth))
+        # Per depth
+        depths = [x for x in self.depths if x >= min_depth and (max_depth is None or x <= max_depth)]
+        ranges = [_range(self.depths[x], lo, hi) for x in depths]
+        return (x[1] for x in heapq.merge(*ranges))
+
+class IntervalIndex:
+    """Labels per segment (EpicTree listener, see EpicTree.add_listener)"""
+
+    def __init__(self):
+        # (tree_id, segment_id) => SegmentLabels
+        self.segments = {}
+        self.rebuilds = 0
+
+    def labels(self, tree_id, segment_id, nodes):
+        """Labels of a segment, built from its nodes if needed"""
+        labels = self.segments.get((tree_id, segment_id))
+        if labels is None:
+            labels = build_labels(nodes)
+            self.segments[(tree_id, segment_id)] = labels
+            self.rebuilds += 1
+        return labels
+
+    def is_descendant(self, tree_id, segment_id, nodes, node_id, ancestor_node_id):
+        """node_id is (strictly) under ancestor_node_id, False for nodes not connected to the root"""
+        labels = self.labels(tree_id, segment_id, nodes).labels
+        node = labels.get(node_id)
+        ancestor = labels.get(ancestor_node_id)
+        if node is None or ancestor is None:
+            return False
+        return ancestor[LO] < node[LO] <= ancestor[HI]
+
+    def query(self, tree_id, segment_id, nodes, node_id, node_types=None, min_depth=1, max_depth=None, limit=None):
+        """[(node_id, depth below node_id)] under node_id, see SegmentLabels.query"""
+        segment_labels = self.labels(tree_id, segment_id, nodes)
+        if node_id not in segment_labels.labels:
+            return []
+        depth = segment_labels.labels[node_id][DEPTH]
+        node_ids = itertools.islice(segment_labels.query(node_id, node_types, min_depth, max_depth), limit)
+        return [(x, segment_labels.labels[x][DEPTH] - depth) for x in node_ids]
+
+    def record(self, tree_id, segment_id, node_ids, change):
+        if tree_id is None:
+            self.segments = {}
+            return
+        if segment_id is None:
+            for key in [x for x in self.segments if x[0] == tree_id]:
+                del self.segments[key]
+            return
+        key = (tree_id, segment_id)
+        labels = self.segments.get(key)
+        if labels is None:
+            return
+        if change['op'] == 'add_node':
+            if not add_label(labels, change['parent_node_id'], change['node_id'], change['type']):
+                del self.segments[key]
+        elif change['op'] == 'remove_node':
+            label = labels.remove(change['node_id'])
+            # Children (left in the segment) would still be labelled under it
+            if label is None or label[FREE] > label[LO] + 1:
+                del self.segments[key]
+        else:
+            del self.segments[key]
+        return
+
+def build_labels(nodes):
+    """Label every node reachable from the root (depth-first, without recursion)"""
+    segment_labels = SegmentLabels()
+    labels = segment_labels.labels
+    root_node_id = None
+    for node_id, node in iter(nodes.items()):
+        if node[1] == 'root':
+            root_node_id = node_id
+            break
+    if root_node_id is None:
+        return segment_labels
+    counter = 0
+    # (node_id, depth, children visited)
+    stack = [(root_node_id, 0, False)]
+    while len(stack) > 0:
+        node_id, depth, visited = stack.pop()
+        if visited:
+            # Children done: close the interval, leaving a GAP of free space after the last child
+            counter += 1
+            labels[node_id][HI] = counter * GAP - 1
+            continue
+        node = nodes[node_id]
+        lo = counter * GAP
+        labels[node_id] = [lo, None, lo + 1, depth, node[1]]
+        # Visited in lo order: the lists stay sorted
+        segment_labels.types.setdefault(node[1], []).append((lo, node_id))
+        segment_labels.depths.setdefault(depth, []).append((lo, node_id))
+        counter += 1
+        stack.append((node_id, depth, True))
+        if node[4] is not None:
+            for child_id in reversed(node[4]):
+                if child_id in nodes:
+                    stack.append((child_id, depth + 1, False))
+    # Free space of every node starts after its last child
+    for node_id, label in iter(labels.items()):
+        children = nodes[node_id][4]
+        if children is not None:
+            for child_id in children:
+                child = labels.get(child_id)
+                if child is not None and child[HI] + 1 > label[FREE]:
+                    label[FREE] = child[HI] + 1
+    return segment_labels
+
+def add_label(segment_labels, parent_node_id, node_id, node_type):
+    """Give a new node a slice of its parent's free space, False if there is none left"""
+    parent = segment_labels.labels.get(parent_node_id)
+    if parent is None:
+        return False
+    lo = parent[FREE]
+    size = (parent[HI] - lo + 1) // SLICE
+    if size < 2:
+        return False
+    segment_labels.add(node_id, lo, lo + size - 1, parent[DEPTH] + 1, node_type)
+    parent[FREE] = lo + size
+    return True
+
+def _range(entries, lo, hi):
+    """Slice of a sorted [(lo, node_id)] list with lo in ]lo, hi]"""
+    return (entries[x] for x in xrange(bisect_left(entries, (lo + 1,)), bisect_left(entries, (hi + 1,))))
+
+def _remove_sorted(lists, key, entry):
+    entries = lists[key]
+    index = bisect_left(entries, entry)
+    if index < len(entries) and entries[index] == entry:
+        del entries[index]
+        if len(entries) == 0:
+            del lists[key]
+    return
@@ -0,0 +1,308 @@
+"""
+Load test: boots the service (Tornado, production mode) on a generated data file and replays a request mix
+
+    python loadtest.py --nodes 100000 --segments 10 --rate 500 --duration 30 --mix level=60,breadcrumbs=25,add=10,delete=4,persist=1
+    python loadtest.py --protocol rpc --pipeline 8 --rate 5000 --mix level=60,breadcrumbs=25,add=10,delete=5
+
+The same mix can be sent over HTTP or over the binary RPC (see rpc.py, no persist there), with --pipeline requests
+sent at once on each connection.
+
+Requests are sent open-loop at the target rate (latency is measured from the time a request was scheduled, so a
+slow server can't hide its queueing delay), and the report gives throughput, latency percentiles per request kind,
+status codes and error rates.
+"""
+
+# Standard libraries
+import argparse
+import httplib
+import itertools
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Libraries
+from benchmark import generate_tree, percentile, format_seconds
+from rpc import RpcClient, RpcError, CODEC_JSON, CODEC_MSGPACK
+from snapshot import write_snapshot
+
+DEFAULT_MIX = 'level=60,breadcrumbs=25,add=10,delete=4,persist=1'
+DEFAULT_RPC_MIX = 'level=60,breadcrumbs=25,add=10,delete=5'
+TREE_ID = 1
+FANOUT = 10
+
+# region Service
+
+def write_config(directory, data_filename, port, rpc_port):
+    with open(os.path.join(directory, 'config.ini'), 'w') as f:
+        f.write('[Files]\nDataFile=' + data_filename + '\nLogFile=\n\n[Server]\nPort=' + str(port) + '\nEnvironment=production\n' +
+                '\n[RPC]\nPort=' + str(rpc_port) + '\n')
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def boot_service(directory, port, timeout=120):
+    """Start app.py in the given directory (it reads config.ini from there), wait until it answers"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+    log = open(os.path.join(directory, 'service.log'), 'w')
+    process = subprocess.Popen([sys.executable, script], cwd=directory, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('Service exited, see ' + log.name)
+        try:
+            connection = httplib.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/trees')
+            if connection.getresponse().status == 200:
+                return process
+        except (socket.error, httplib.HTTPException):
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('Service did not start within ' + str(timeout) + 's')
+
+# endregion
+
+# region Request mix
+
+def parse_mix(mix):
+    """'level=60,add=10' => [('level', 60), ('add', 10)]"""
+    weights = []
+    for item in mix.split(','):
+        name, weight = item.split('=')
+        if name not in REQUESTS:
+            raise ValueError('Unknown request kind ' + name + ' (known: ' + ', '.join(sorted(REQUESTS)) + ')')
+        weights.append((name, int(weight)))
+    return weights
+
+class Workload:
+    """Knows the generated tree, hands out the next request of a given kind"""
+
+    def __init__(self, node_count, segments):
+        self.segments = range(1, segments + 1)
+        self.per_segment = max(1, node_count // segments)
+        # Breadth-first IDs: nodes with a first child inside the segment are directories
+        self.directories = max(1, (self.per_segment - 2) // FANOUT + 1)
+        self.lock = threading.Lock()
+        self.next_node_id = itertools.count(10 ** 9)
+        self.added = []
+
+    def random_directory(self):
+        return random.choice(self.segments), random.randint(0, self.directories - 1)
+
+    def random_node(self):
+        return random.choice(self.segments), random.randint(0, self.per_segment - 1)
+
+    def added_node(self, segment_id, node_id):
+        with self.lock:
+            self.added.append((segment_id, node_id))
+
+    def take_added_node(self):
+        with self.lock:
+            if len(self.added) == 0:
+                return None
+            return self.added.pop(random.randint(0, len(self.added) - 1))
+
+# Request kinds: workload => (HTTP method, URL, JSON body, RPC call (method, args) or None, called on success)
+
+def request_level(workload):
+    segment_id, node_id = workload.random_directory()
+    return ('GET', '/tree/%d/segment/%d/level/%d' % (TREE_ID, segment_id, node_id), None,
+            ('get_level', (TREE_ID, segment_id, node_id)), None)
+
+def request_breadcrumbs(workload):
+    segment_id, node_id = workload.random_node()
+    return ('GET', '/tree/%d/segment/%d/breadcrumbs/%d' % (TREE_ID, segment_id, node_id), None,
+            ('get_breadcrumbs', (TREE_ID, segment_id, node_id)), None)
+
+def request_add(workload):
+    segment_id, parent_node_id = workload.random_directory()
+    node_id = next(workload.next_node_id)
+    body = {'parent_node_id': parent_node_id, 'node_id': node_id, 'type': 'asset', 'payload': node_id}
+    if random.random() < 0.5:
+        body['position'] = random.randint(1, FANOUT)
+    rpc_call = ('add_node', (TREE_ID, segment_id, parent_node_id, node_id, 'asset', node_id, body.get('position')))
+    return ('POST', '/tree/%d/segment/%d/node' % (TREE_ID, segment_id), body, rpc_call,
+            lambda: workload.added_node(segment_id, node_id))
+
+def request_delete(workload):
+    added = workload.take_added_node()
+    if added is None:
+        # Nothing added yet: read instead
+        return request_level(workload)
+    return ('DELETE', '/tree/%d/segment/%d/node/%d' % (TREE_ID, added[0], added[1]), None,
+            ('remove_node', (TREE_ID, added[0], added[1])), None)
+
+def request_persist(workload):
+    return 'POST', '/persist', None, None, None
+
+REQUESTS = {
+    'level': request_level,
+    'breadcrumbs': request_breadcrumbs,
+    'add': request_add,
+    'delete': request_delete,
+    'persist': request_persist,
+}
+
+# endregion
+
+# region Runner
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.statuses = {}
+        self.errors = {}
+
+    def record(self, kind, latency, status):
+        with self.lock:
+            self.latencies.setdefault(kind, []).append(latency)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if not isinstance(status, int) or status >= 400:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+
+def worker(port, workload, kinds, rate, start, end, tickets, results):
+    """Take the next scheduled slot, wait for it, send the request (keep-alive connection per worker)"""
+    connection = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+    while True:
+        scheduled = start + next(tickets) / float(rate)
+        if scheduled >= end:
+            break
+        delay = scheduled - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        kind = random.choice(kinds)
+        method, url, body, rpc_call, on_success = REQUESTS[kind](workload)
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        try:
+            connection.request(method, url, body, headers)
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+            if status == 200 and on_success is not None:
+                on_success()
+        except (socket.error, httplib.HTTPException) as inst:
+            status = type(inst).__name__
+            connection.close()
+            connection = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+        results.record(kind, time.time() - scheduled, status)
+    connection.close()
+
+def rpc_worker(port, workload, kinds, rate, start, end, tickets, results, pipeline, codec):
+    """Same as worker over the RPC, taking pipeline slots at a time and sending them together"""
+    client = RpcClient(('127.0.0.1', port), codec)
+    while True:
+        slots = [start + next(tickets) / float(rate) for x in range(pipeline)]
+        slots = [x for x in slots if x < end]
+        if len(slots) == 0:
+            break
+        delay = slots[-1] - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        batch = []
+        for scheduled in slots:
+            kind = random.choice(kinds)
+            batch.append((scheduled, kind) + REQUESTS[kind](workload)[3:])
+        try:
+            answers = client.pipeline([x[2] for x in batch])
+        except (socket.error, RpcError) as inst:
+            answers = [(type(inst).__name__, None)] * len(batch)
+            client.close()
+            client = RpcClient(('127.0.0.1', port), codec)
+        now = time.time()
+        for (scheduled, kind, rpc_call, on_success), (status, result) in zip(batch, answers):
+            if status == 200 and on_success is not None:
+                on_success()
+            results.record(kind, now - scheduled, status)
+    client.close()
+
+def run(port, workload, mix, rate, duration, concurrency, protocol='http', pipeline=1, codec=CODEC_JSON):
+    # Weighted choice: repeat each kind as many times as its weight
+    kinds = []
+    for name, weight in mix:
+        kinds.extend([name] * weight)
+    results = Results()
+    tickets = itertools.count()
+    start = time.time() + 0.5
+    end = start + duration
+    threads = []
+    for x in range(concurrency):
+        if protocol == 'rpc':
+            thread = threading.Thread(target=rpc_worker, args=(port, workload, kinds, rate, start, end, tickets, results,
+                                                               pipeline, codec))
+        else:
+            thread = threading.Thread(target=worker, args=(port, workload, kinds, rate, start, end, tickets, results))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results, time.time() - start
+
+def report(results, elapsed):
+    total = sum(len(x) for x in results.latencies.values())
+    errors = sum(results.errors.values())
+    print 'Requests: ' + str(total) + ' in ' + ('%.1fs' % elapsed) + (' (%.0f req/s)' % (total / elapsed))
+    print 'Errors: ' + str(errors) + (' (%.2f%%)' % (100.0 * errors / total if total > 0 else 0))
+    print 'Status codes: ' + ', '.join(str(k) + '=' + str(v) for k, v in sorted(results.statuses.items()))
+    print 'kind'.ljust(14) + 'count'.rjust(8) + 'errors'.rjust(8) + 'p50'.rjust(12) + 'p90'.rjust(12) + 'p99'.rjust(12) + 'max'.rjust(12)
+    for kind in sorted(results.latencies):
+        latencies = sorted(results.latencies[kind])
+        print (kind.ljust(14) + str(len(latencies)).rjust(8) + str(results.errors.get(kind, 0)).rjust(8) +
+               format_seconds(percentile(latencies, 0.5)).rjust(12) + format_seconds(percentile(latencies, 0.9)).rjust(12) +
+               format_seconds(percentile(latencies, 0.99)).rjust(12) + format_seconds(latencies[-1]).rjust(12))
+
+# endregion
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='EpicTree HTTP / RPC load test')
+    parser.add_argument('--nodes', type=int, default=100000, help='nodes in the generated tree')
+    parser.add_argument('--segments', type=int, default=10)
+    parser.add_argument('--rate', type=int, default=200, help='target requests per second')
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--concurrency', type=int, default=16, help='client threads')
+    parser.add_argument('--mix', default=None, help='request kinds and weights (' + ', '.join(sorted(REQUESTS)) + '), default: ' + DEFAULT_MIX)
+    parser.add_argument('--protocol', choices=('http', 'rpc'), default='http')
+    parser.add_argument('--pipeline', type=int, default=1, help='RPC requests sent at once per connection')
+    parser.add_argument('--codec', choices=('json', 'msgpack'), default='json', help='RPC codec')
+    parser.add_argument('--port', type=int, default=0, help='service port (default: a free port)')
+    parser.add_argument('--seed', type=int, default=1234)
+    arguments = parser.parse_args()
+    random.seed(arguments.seed)
+    request_mix = parse_mix(arguments.mix or (DEFAULT_RPC_MIX if arguments.protocol == 'rpc' else DEFAULT_MIX))
+    if arguments.protocol == 'rpc' and 'persist' in [x[0] for x in request_mix]:
+        parser.error('persist is only available over HTTP')
+    # Generated data file + config in a temporary directory
+    directory = tempfile.mkdtemp()
+    port = arguments.port or free_port()
+    rpc_port = free_port()
+    process = None
+    try:
+        data_filename = os.path.join(directory, 'datafile')
+        write_snapshot(generate_tree(arguments.nodes, 1, arguments.segments, FANOUT), data_filename)
+        write_config(directory, data_filename, port, rpc_port)
+        process = boot_service(directory, port)
+        print 'Service started on port ' + str(port) + ' with ' + str(arguments.nodes) + ' nodes'
+        load_results, load_elapsed = run(rpc_port if arguments.protocol == 'rpc' else port,
+                                         Workload(arguments.nodes, arguments.segments), request_mix, arguments.rate,
+                                         arguments.duration, arguments.concurrency, arguments.protocol,
+                                         arguments.pipeline, CODEC_MSGPACK if arguments.codec == 'msgpack' else CODEC_JSON)
+        report(load_results, load_elapsed)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(directory)
@@ -0,0 +1,314 @@
+"""
+Structural diff of two segments (or of a segment and a past version / backup of it), skipping identical subtrees
+
+Every node reachable from the root of a segment gets a subtree hash: the hash of its own content (ID, type, payload)
+plus, for each child, a mix of the child's subtree hash and its sort times a weight of its own. The sum doesn't
+depend on the order of the children list, so a change only has to update the sums of its ancestors: kept up to date
+from the EpicTree changes (O(depth)), built on the first diff of a segment. Sorts are linear in the sum: re-sorting
+a level adds (shift * weight) per sibling moved, without re-hashing them.
+
+Diffing pairs nodes by ID from the roots down and only goes into pairs whose subtree hashes differ: what it costs
+is the size of the difference (and of the levels it touches), not of the segments. A segment as it was at a past
+version (timetravel.AsOfView) reuses the live hashes for everything the changes since didn't touch.
+"""
+
+# Standard libraries
+import json
+
+MASK = (1 << 64) - 1
+# Keeps the children's hashes from cancelling out with the content hashes
+CHILD_SALT = 0x632be59bd9b4e019
+
+# Entry fields
+CONTENT = 0
+SORT = 1
+SUBTREE = 2
+
+class SegmentHashes:
+    """Hashes of one segment dict: node_id => [content hash, sort, subtree hash] for the nodes reachable from the root"""
+
+    def __init__(self, nodes, root_node_id=None):
+        self.nodes = nodes
+        self.root = root_node_id
+        self.entries = {}
+
+    def get(self, node_id):
+        entry = self.entries.get(node_id)
+        return None if entry is None else entry[SUBTREE]
+
+class MerkleIndex:
+    """Subtree hashes per segment (EpicTree listener, see EpicTree.add_listener)"""
+
+    def __init__(self):
+        # (tree_id, segment_id) => SegmentHashes
+        self.segments = {}
+        self.rebuilds = 0
+
+    def hashes(self, tree_id, segment_id, nodes):
+        """Hashes of a segment, built from its nodes if needed"""
+        hashes = self.segments.get((tree_id, segment_id))
+        if hashes is None or hashes.nodes is not nodes:
+            hashes = build_hashes(nodes)
+            self.segments[(tree_id, segment_id)] = hashes
+            self.rebuilds += 1
+        return hashes
+
+    def replace(self, tree_id, segment_id, old_nodes, nodes):
+        """A segment's storage was replaced with the same nodes (frozen / thawed, see EpicTree.freeze_idle)"""
+        hashes = self.segments.get((tree_id, segment_id))
+        if hashes is not None and hashes.nodes is old_nodes:
+            hashes.nodes = nodes
+        return
+
+    def record(self, tree_id, segment_id, node_ids, change):
+        if tree_id is None:
+            self.segments = {}
+            return
+        if segment_id is None:
+            for key in [x for x in self.segments if x[0] == tree_id]:
+                del self.segments[key]
+            return
+        key = (tree_id, segment_id)
+        hashes = self.segments.get(key)
+        if hashes is None:
+            return
+        if change['op'] == 'add_node':
+            updated = add_hash(hashes, change['parent_node_id'], change['node_id'], change['shifted'])
+        elif change['op'] == 'remove_node':
+            updated = remove_hash(hashes, change['parent_node_id'], change['node_id'])
+        else:
+            updated = False
+        if not updated:
+            del self.segments[key]
+        return
+
+def build_hashes(nodes):
+    """Hash every node reachable from the root (children first, without recursion)"""
+    root_node_id = _find_root(nodes)
+    hashes = SegmentHashes(nodes, root_node_id)
+    if root_node_id is None:
+        return hashes
+    entries = hashes.entries
+    stack = [(root_node_id, False)]
+    while len(stack) > 0:
+        node_id, visited = stack.pop()
+        node = nodes[node_id]
+        if visited:
+            entries[node_id] = _make_entry(node_id, node, [entries[x] for x in node[4] or () if x in entries])
+            continue
+        stack.append((node_id, True))
+        for child_id in node[4] or ():
+            if child_id in nodes:
+                stack.append((child_id, False))
+    return hashes
+
+def add_hash(hashes, parent_node_id, node_id, shifted):
+    """A node was added under parent_node_id (shifted: its siblings were re-sorted), False if it has to be rebuilt"""
+    nodes, entries = hashes.nodes, hashes.entries
+    node = nodes[node_id]
+    if parent_node_id not in entries:
+        # Not reachable from the root: not hashed
+        return True
+    if node[4]:
+        return False
+    entry = _make_entry(node_id, node, ())
+    entries[node_id] = entry
+    delta = _child_term(entry)
+    if shifted:
+        delta += _re_sort_delta(hashes, parent_node_id, node_id)
+    _propagate(hashes, parent_node_id, delta)
+    return True
+
+def remove_hash(hashes, parent_node_id, node_id):
+    """A node was removed from parent_node_id (its siblings re-sorted), False if it has to be rebuilt"""
+    entry = hashes.entries.get(node_id)
+    if entry is None or parent_node_id not in hashes.entries:
+        return True
+    if entry[SUBTREE] != _mix(entry[CONTENT]):
+        # Its children stay in the dict without a parent: rebuilding drops their entries
+        return False
+    del hashes.entries[node_id]
+    delta = _re_sort_delta(hashes, parent_node_id, None) - _child_term(entry)
+    _propagate(hashes, parent_node_id, delta)
+    return True
+
+class ViewHashes:
+    """Hashes of a segment in the past (timetravel.AsOfView): the live ones, except above the nodes changed since"""
+
+    def __init__(self, view, hashes):
+        self.view = view
+        self.hashes = hashes
+        self.root = hashes.root
+        self.computed = {}
+        # Ancestors of the changed nodes, then and now
+        self.dirty = set()
+        for nodes in (view, hashes.nodes):
+            seen = set()
+            for node_id in view.state:
+                while node_id is not None and node_id not in seen:
+                    seen.add(node_id)
+                    node = nodes.get(node_id)
+                    node_id = None if node is None else node[0]
+            self.dirty.update(seen)
+
+    def get(self, node_id):
+        known = self._known(node_id)
+        if known is not None or self.view.get(node_id) is None:
+            return known
+        # Children first, without recursion
+        stack = [(node_id, False)]
+        while len(stack) > 0:
+            node_id, visited = stack.pop()
+            node = self.view[node_id]
+            children = [x for x in node[4] or () if x in self.view]
+            if visited:
+                self.computed[node_id] = _make_entry(node_id, node, [self._entry(x) for x in children])
+                continue
+            stack.append((node_id, True))
+            stack.extend((x, False) for x in children if self._known(x) is None)
+        return self.computed[node_id][SUBTREE]
+
+    def _known(self, node_id):
+        entry = self._entry(node_id)
+        return None if entry is None else entry[SUBTREE]
+
+    def _entry(self, node_id):
+        if node_id in self.computed:
+            return self.computed[node_id]
+        if node_id in self.dirty:
+            return None
+        return self.hashes.entries.get(node_id)
+
+def diff(old_nodes, old_hashes, new_nodes, new_hashes):
+    """
+    What changed from old_nodes to new_nodes (nodes paired by ID, the roots with each other)
+    :param old_hashes: old_nodes' subtree hashes (.get(node_id), .root), new_hashes: new_nodes'
+    :return: {'added': [node_id], 'removed': [node_id], 'moved': [{'id', 'from', 'to'}] (parents),
+              'resorted': [{'id', 'from', 'to'}] (sorts, same parent), 'changed': [node_id] (type / payload),
+              'compared': node pairs looked at}
+    """
+    result = {'added': [], 'removed': [], 'moved': [], 'resorted': [], 'changed': [], 'compared': 0}
+    old_root, new_root = old_hashes.root, new_hashes.root
+    if old_root is None or new_root is None:
+        return result
+    old_attached = {old_root: True}
+    new_attached = {new_root: True}
+    paired = set([new_root])
+    pairs = [(old_root, new_root)]
+    while len(pairs) > 0:
+        old_id, new_id = pairs.pop()
+        result['compared'] += 1
+        old_node, new_node = old_nodes[old_id], new_nodes[new_id]
+        # A node's sort is in its parent's hash, not its own
+        if old_node[0] is not None and old_node[0] == new_node[0] and old_node[3] != new_node[3]:
+            result['resorted'].append({'id': new_id, 'from': old_node[3], 'to': new_node[3]})
+        old_hash = old_hashes.get(old_id)
+        if old_id == new_id and old_hash is not None and old_hash == new_hashes.get(new_id):
+            continue
+        if old_node[1] != new_node[1] or old_node[2] != new_node[2]:
+            result['changed'].append(new_id)
+        old_children = [x for x in old_node[4] or () if x in old_nodes]
+        new_children = [x for x in new_node[4] or () if x in new_nodes]
+        old_set, new_set = set(old_children), set(new_children)
+        for child_id in old_children:
+            if child_id in new_set or _is_attached(new_nodes, child_id, new_attached):
+                # Still here (or moved: reported from its new parent)
+                continue
+            # Removed, with what is left of its subtree
+            stack = [child_id]
+            while len(stack) > 0:
+                node_id = stack.pop()
+                if _is_attached(new_nodes, node_id, new_attached):
+                    continue
+                result['removed'].append(node_id)
+                stack.extend(x for x in old_nodes[node_id][4] or () if x in old_nodes)
+        for child_id in new_children:
+            if child_id in old_set:
+                if child_id not in paired:
+                    paired.add(child_id)
+                    pairs.append((child_id, child_id))
+                continue
+            # Added, with its subtree (or moved there, with theirs)
+            stack = [child_id]
+            while len(stack) > 0:
+                node_id = stack.pop()
+                if _is_attached(old_nodes, node_id, old_attached):
+                    result['moved'].append({'id': node_id, 'from': old_nodes[node_id][0], 'to': new_nodes[node_id][0]})
+                    if node_id not in paired:
+                        paired.add(node_id)
+                        pairs.append((node_id, node_id))
+                    continue
+                result['added'].append(node_id)
+                stack.extend(x for x in new_nodes[node_id][4] or () if x in new_nodes)
+    return result
+
+def _find_root(nodes):
+    for node_id, node in iter(nodes.items()):
+        if node[1] == 'root':
+            return node_id
+    return None
+
+def _is_attached(nodes, node_id, attached):
+    """node_id is in nodes and reachable from the root (attached: known answers, the root's included)"""
+    path = []
+    while node_id not in attached:
+        node = nodes.get(node_id)
+        if node is None or node[0] is None:
+            break
+        path.append(node_id)
+        node_id = node[0]
+    result = attached.get(node_id, False)
+    for x in path:
+        attached[x] = result
+    return result
+
+def _content_hash(node_id, node):
+    payload = node[2]
+    if isinstance(payload, (dict, list)):
+        payload = json.dumps(payload, sort_keys=True)
+    return hash((node_id, node[1], payload)) & MASK
+
+def _mix(value):
+    """64-bit finaliser (splitmix64): children's hashes are mixed before they are summed"""
+    value = ((value ^ (value >> 30)) * 0xbf58476d1ce4e5b9) & MASK
+    value = ((value ^ (value >> 27)) * 0x94d049bb133111eb) & MASK
+    return value ^ (value >> 31)
+
+def _mix_child(subtree_hash):
+    return _mix(subtree_hash ^ CHILD_SALT)
+
+def _child_term(entry):
+    """What a child adds to its parent's hash: its subtree hash (mixed) and its sort (weighted by its content)"""
+    return _mix_child(entry[SUBTREE]) + entry[SORT] * (entry[CONTENT] | 1)
+
+def _make_entry(node_id, node, children_entries):
+    content_hash = _content_hash(node_id, node)
+    subtree_hash = _mix(content_hash)
+    for child in children_entries:
+        subtree_hash += _child_term(child)
+    return [content_hash, node[3], subtree_hash & MASK]
+
+def _re_sort_delta(hashes, parent_node_id, skip_node_id):
+    """Siblings whose sort changed: the change of the parent's sum (their own hashes don't depend on it)"""
+    nodes, entries = hashes.nodes, hashes.entries
+    delta = 0
+    for child_id in nodes[parent_node_id][4] or ():
+        entry = entries.get(child_id)
+        if entry is None or child_id == skip_node_id:
+            continue
+        sort = nodes[child_id][3]
+        if sort != entry[SORT]:
+            delta += (sort - entry[SORT]) * (entry[CONTENT] | 1)
+            entry[SORT] = sort
+    return delta
+
+def _propagate(hashes, node_id, delta):
+    """Add delta to node_id's sum, then the change of its hash to its parent's, up to the root"""
+    nodes, entries = hashes.nodes, hashes.entries
+    while node_id is not None and node_id in entries:
+        entry = entries[node_id]
+        old_hash = entry[SUBTREE]
+        entry[SUBTREE] = (old_hash + delta) & MASK
+        delta = _mix_child(entry[SUBTREE]) - _mix_child(old_hash)
+        node_id = nodes[node_id][0]
+    return
@@ -0,0 +1,168 @@
+"""
+Prometheus-style metrics (counters, histograms, gauges) rendered in the text exposition format
+
+Methods are only wrapped once metrics are enabled (see enable_metrics in app.py): while they are disabled,
+the only cost left on the request path is a check of Registry.enabled.
+"""
+
+# Standard libraries
+import bisect
+import functools
+import time
+
+# Latency buckets (seconds)
+LATENCY_BUCKETS = [0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+def _format_labels(names, values):
+    if len(names) == 0:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        pairs.append(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"')
+    return '{' + ','.join(pairs) + '}'
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+class Counter:
+    """Monotonic counter, per label values"""
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.values = {}
+
+    def inc(self, label_values=(), amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = ['# HELP ' + self.name + ' ' + self.description, '# TYPE ' + self.name + ' counter']
+        for label_values in sorted(self.values):
+            lines.append(self.name + _format_labels(self.label_names, label_values) + ' ' + _format_value(self.values[label_values]))
+        return lines
+
+class Histogram:
+    """Histogram with fixed buckets, per label values"""
+
+    def __init__(self, name, description, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = list(buckets)
+        # label values => [count per bucket (+Inf last), sum, count]
+        self.values = {}
+
+    def observe(self, value, label_values=()):
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            self.values[label_values] = entry
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self):
+        lines = ['# HELP ' + self.name + ' ' + self.description, '# TYPE ' + self.name + ' histogram']
+        bucket_label_names = self.label_names + ('le',)
+        for label_values in sorted(self.values):
+            bucket_counts, total, count = self.values[label_values]
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ['+Inf'], bucket_counts):
+                cumulative += bucket_count
+                labels = _format_labels(bucket_label_names, label_values + (bound,))
+                lines.append(self.name + '_bucket' + labels + ' ' + str(cumulative))
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(self.name + '_sum' + labels + ' ' + _format_value(total))
+            lines.append(self.name + '_count' + labels + ' ' + str(count))
+        return lines
+
+class Gauge:
+    """Gauge computed when the metrics are scraped (fn returns a number, or a {label values: number} dict)"""
+
+    def __init__(self, name, description, fn, label_names=()):
+        self.name = name
+        self.description = description
+        self.fn = fn
+        self.label_names = tuple(label_names)
+
+    def render(self):
+        lines = ['# HELP ' + self.name + ' ' + self.description, '# TYPE ' + self.name + ' gauge']
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values in sorted(values):
+            lines.append(self.name + _format_labels(self.label_names, label_values) + ' ' + _format_value(values[label_values]))
+        return lines
+
+class Registry:
+    """All the metrics of the process"""
+
+    def __init__(self):
+        self.enabled = False
+        self.metrics = []
+
+    def counter(self, name, description, label_names=()):
+        metric = Counter(name, description, label_names)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, description, label_names=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, description, label_names, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, description, fn, label_names=()):
+        metric = Gauge(name, description, fn, label_names)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+def instrument_methods(cls, method_names, latency, errors):
+    """
+    Wrap methods of a class to record their latency (and exceptions), labelled by method name
+    Recursive calls (e.g. get_breadcrumbs) are only timed once, at the outermost call
+    :param cls: class
+    :param method_names: list of str
+    :param latency: Histogram (label: method)
+    :param errors: Counter (label: method)
+    :return:
+    """
+    for method_name in method_names:
+        method = getattr(cls, method_name)
+        if getattr(method, 'instrumented', False):
+            continue
+        setattr(cls, method_name, _timed_method(method, method_name, latency, errors))
+    return
+
+def _timed_method(method, method_name, latency, errors):
+    label_values = (method_name,)
+    active = [False]
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if active[0]:
+            return method(*args, **kwargs)
+        active[0] = True
+        start = time.time()
+        try:
+            return method(*args, **kwargs)
+        except Exception:
+            errors.inc(label_values)
+            raise
+        finally:
+            active[0] = False
+            latency.observe(time.time() - start, label_values)
+    wrapper.instrumented = True
+    # For signature checks (see rpc.coerce_arguments)
+    wrapper.wrapped = method
+    return wrapper
@@ -0,0 +1,197 @@
+"""
+Pinned read versions: a reader pins the tree (or a segment) and reads it as it was, however long it takes, while the
+writers keep changing it
+
+    with epic_tree.pin() as pinned:
+        write_snapshot(pinned.tree, filename)       # pinned.tree: {tree_id: {segment_id: SegmentView}}
+
+Writers don't copy anything while nothing is pinned. While a segment is pinned, EpicTree hands every node to
+before_write before replacing or removing it: its old tuple goes to the segment's history (copy-on-write, once per
+node and pin, the children list of a saved node is copied instead of changed in place), and a SegmentView reads a node from the
+history if it changed after the view's version, from the live dict otherwise. Whole segments / trees are replaced,
+never changed in place, so a view keeps its segment's dict. Releasing the last pin of a version drops the history
+nobody can read anymore.
+
+Readers may run in other threads: a node is recorded before it is changed and a view reads the live dict before the
+history, so (with the GIL) it never gets a value newer than its version. Only the writers' thread changes histories.
+"""
+
+# Standard libraries
+from bisect import bisect_right
+import threading
+
+# Value of a node that didn't exist yet
+MISSING = object()
+
+class SegmentHistory:
+    """Old values of the nodes of one segment dict, changed while it was pinned: node_id => [(version, old value)]"""
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.entries = {}
+        # Pinned version => readers
+        self.pins = {}
+        self.trimmed_at = None
+
+    def value(self, node_id, version):
+        """Node at a version: the old value saved by the first change after it (MISSING: not there yet), else None"""
+        entries = self.entries.get(node_id)
+        if entries is None:
+            return None
+        index = bisect_right(entries, (version + 1,))
+        if index == len(entries):
+            return None
+        return entries[index][1]
+
+    def record(self, version, node_id, newest_pin):
+        """node_id is about to be changed by the change of this version: True if its value was saved now"""
+        entries = self.entries.get(node_id)
+        # Already saved since the newest pin: that is what every pin reads (and the live value is the writers' own)
+        if entries is not None and entries[-1][0] > newest_pin:
+            return False
+        value = self.nodes.get(node_id, MISSING)
+        if entries is None:
+            self.entries[node_id] = [(version, value)]
+        else:
+            entries.append((version, value))
+        return True
+
+    def trim(self):
+        """Drop the values saved before the oldest pin (no reader can need them), once per oldest pin"""
+        oldest_pin = min(self.pins)
+        if oldest_pin == self.trimmed_at:
+            return
+        self.trimmed_at = oldest_pin
+        for node_id in list(self.entries.keys()):
+            entries = self.entries[node_id]
+            if entries[0][0] <= oldest_pin:
+                kept = [x for x in entries if x[0] > oldest_pin]
+                if len(kept) > 0:
+                    self.entries[node_id] = kept
+                else:
+                    del self.entries[node_id]
+        return
+
+class SegmentView:
+    """Read-only {node_id: node} of a segment at a version (what EpicTree readers take as nodes=)"""
+
+    def __init__(self, history, version):
+        self.history = history
+        self.version = version
+
+    def get(self, node_id, default=None):
+        # Live dict first, then the history (see module docstring)
+        value = self.history.nodes.get(node_id, MISSING)
+        old = self.history.value(node_id, self.version)
+        if old is not None:
+            value = old
+        return default if value is MISSING else value
+
+    def __getitem__(self, node_id):
+        value = self.get(node_id, MISSING)
+        if value is MISSING:
+            raise KeyError(node_id)
+        return value
+
+    def __contains__(self, node_id):
+        return self.get(node_id, MISSING) is not MISSING
+
+    def keys(self):
+        node_ids = set(self.history.nodes.keys())
+        node_ids.update(self.history.entries.keys())
+        return [x for x in node_ids if x in self]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(x, self[x]) for x in self.keys()]
+
+    def values(self):
+        return [self[x] for x in self.keys()]
+
+class PinnedTree:
+    """{tree_id: {segment_id: SegmentView}} at a version, release() (or with) when done"""
+
+    def __init__(self, store, version, tree, histories):
+        self.store = store
+        self.version = version
+        self.tree = tree
+        self.histories = histories
+
+    def release(self):
+        self.store.release(self)
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+        return False
+
+class VersionStore:
+    """Histories of the pinned segment dicts (keyed by the dict's id, a replaced segment is a different dict)"""
+
+    def __init__(self):
+        self.histories = {}
+        self.lock = threading.Lock()
+
+    def pin(self, version, tree):
+        """
+        Pin {tree_id: {segment_id: nodes}} at a version
+        Segments that aren't dicts (still encoded in a snapshot, frozen) are never changed in place: they are passed
+        through as they are, in a container of the same type (so snapshot.LazySegments still decode them when read,
+        and write_snapshot still copies them without decoding)
+        """
+        pinned = {}
+        histories = []
+        with self.lock:
+            for tree_id, segments in iter(tree.items()):
+                pinned[tree_id] = segments.__class__()
+                for segment_id, nodes in iter(dict.items(segments)):
+                    if not isinstance(nodes, dict):
+                        dict.__setitem__(pinned[tree_id], segment_id, nodes)
+                        continue
+                    history = self.histories.get(id(nodes))
+                    if history is None:
+                        history = SegmentHistory(nodes)
+                        self.histories[id(nodes)] = history
+                    history.pins[version] = history.pins.get(version, 0) + 1
+                    histories.append(history)
+                    pinned[tree_id][segment_id] = SegmentView(history, version)
+        return PinnedTree(self, version, pinned, histories)
+
+    def release(self, pinned):
+        with self.lock:
+            for history in pinned.histories:
+                history.pins[pinned.version] -= 1
+                if history.pins[pinned.version] == 0:
+                    del history.pins[pinned.version]
+                if len(history.pins) == 0:
+                    self.histories.pop(id(history.nodes), None)
+            pinned.histories = []
+        return
+
+    def is_pinned(self, nodes):
+        return len(self.histories) > 0 and id(nodes) in self.histories
+
+    def before_write(self, nodes, version, node_ids):
+        """
+        The change of this version is about to replace / remove / add these nodes of a segment dict
+        :return: set of the node IDs saved now (their children lists must be copied, pinned readers share them)
+        """
+        saved = set()
+        with self.lock:
+            history = self.histories.get(id(nodes))
+            if history is None:
+                return saved
+            history.trim()
+            newest_pin = max(history.pins)
+            for node_id in node_ids:
+                if history.record(version, node_id, newest_pin):
+                    saved.add(node_id)
+        return saved
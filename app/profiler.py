@@ -0,0 +1,97 @@
+"""
+Sampling profiler that can be switched on in a live process
+
+A background thread periodically captures the stack of every other thread (sys._current_frames) and
+counts identical stacks, which gives collapsed stacks ("frame;frame;frame count") ready for flame graphs.
+Nothing runs on the profiled threads themselves, so requests keep being served while profiling.
+"""
+
+# Standard libraries
+import os
+import sys
+import threading
+import time
+
+MAX_DURATION = 300.0
+MIN_INTERVAL = 0.001
+
+def _frame_name(frame):
+    code = frame.f_code
+    return os.path.basename(code.co_filename) + ':' + code.co_name
+
+def collapse_stack(frame):
+    """Stack of a frame as 'outermost;...;innermost'"""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+class SamplingProfiler:
+    """Samples the stacks of the process' threads for a bounded window"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.stacks = {}
+        self.sample_count = 0
+        self.started = None
+        self.duration = 0
+        self.interval = 0
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, duration=10.0, interval=0.005):
+        """Start sampling (previous results are discarded), False if a session is already running"""
+        with self.lock:
+            if self.is_running():
+                return False
+            self.duration = min(float(duration), MAX_DURATION)
+            self.interval = max(float(interval), MIN_INTERVAL)
+            self.stacks = {}
+            self.sample_count = 0
+            self.started = time.time()
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._run, name='epictree-profiler')
+            self.thread.daemon = True
+            self.thread.start()
+        return True
+
+    def stop(self):
+        """Stop sampling early (results are kept)"""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        return
+
+    def _run(self):
+        own_thread_id = threading.current_thread().ident
+        deadline = self.started + self.duration
+        while not self.stop_event.is_set() and time.time() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+                stack = collapse_stack(frame)
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.sample_count += 1
+            self.stop_event.wait(self.interval)
+        return
+
+    def status(self):
+        return {
+            'running': self.is_running(),
+            'started': self.started,
+            'duration': self.duration,
+            'interval': self.interval,
+            'samples': self.sample_count
+        }
+
+    def collapsed(self, limit=None):
+        """Collapsed stacks ('frame;frame count'), hottest first"""
+        stacks = sorted(self.stacks.items(), key=lambda x: x[1], reverse=True)
+        if limit is not None:
+            stacks = stacks[:limit]
+        return [stack + ' ' + str(count) for stack, count in stacks]
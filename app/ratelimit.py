@@ -0,0 +1,127 @@
+"""
+Token-bucket rate limiting per route and tenant (the tree_id of the URL, else get_tenant(): see app.py)
+
+    limiter = TokenBucketLimiter()
+    @app.route('/tree/<int:tree_id>/segments')
+    @limiter.limit("50000/hour")
+
+"N/period" gives every tenant a bucket of N tokens refilled at N per period, so one busy tree can't use up the
+limit of the others. Buckets are plain [tokens, last refill] lists updated without a lock: two threads racing on the
+same bucket can let a request or two more through, which is fine for a limit (and Tornado serves one request at a
+time anyway). The check costs a dict lookup and some arithmetic, nothing is stored outside the process.
+A bucket that has refilled is the same as no bucket: those are dropped every SWEEP_SECONDS (and a tenant's buckets when
+its tree is removed, see forget), so the buckets of clients / trees gone quiet don't pile up.
+"""
+
+# Standard libraries
+from functools import wraps
+import time
+
+SWEEP_SECONDS = 60
+
+PERIODS = {
+    'second': 1,
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400,
+}
+
+def parse_limit(limit):
+    """'200000/hour' => (200000, 3600)"""
+    amount, period = limit.split('/')
+    return int(amount), PERIODS[period.strip()]
+
+def parse_tenant_scales(value):
+    """'154:10,165:0.5' => {154: 10.0, 165: 0.5}"""
+    scales = {}
+    if value is None:
+        return scales
+    for item in value.split(','):
+        if item.strip() == '':
+            continue
+        tenant, scale = item.split(':')
+        scales[int(tenant)] = float(scale)
+    return scales
+
+class TokenBucketLimiter:
+    """Route decorator, on_limited(retry_after_seconds) builds the response of a limited request"""
+
+    def __init__(self, get_tenant=None, on_limited=None, enabled=True, scale=1.0, tenant_scales=None):
+        self.get_tenant = get_tenant
+        self.on_limited = on_limited
+        self.enabled = enabled
+        self.scale = scale
+        self.tenant_scales = tenant_scales or {}
+        # (route, tenant) => [tokens, time of the last refill, time it is full again]
+        self.buckets = {}
+        self.limited = 0
+        self.next_sweep = 0
+
+    def configure(self, enabled=True, scale=1.0, tenant_scales=None):
+        self.enabled = enabled
+        self.scale = scale
+        self.tenant_scales = tenant_scales or {}
+        self.reset()
+        return
+
+    def reset(self):
+        self.buckets = {}
+        return
+
+    def forget(self, tenant):
+        """Drop the buckets of a tenant (its tree was removed)"""
+        for key in [x for x in self.buckets if x[1] == tenant]:
+            del self.buckets[key]
+        return
+
+    def sweep(self, now=None):
+        """Drop the buckets full again (a new one would be the same)"""
+        now = time.time() if now is None else now
+        for key in [x for x, bucket in iter(self.buckets.items()) if bucket[2] <= now]:
+            del self.buckets[key]
+        self.next_sweep = now + SWEEP_SECONDS
+        return
+
+    def consume(self, route, tenant, amount, period, now=None):
+        """Take a token from the bucket of (route, tenant): 0 if allowed, else the seconds until one is available"""
+        capacity = amount * self.scale * self.tenant_scales.get(tenant, 1.0)
+        if capacity <= 0:
+            return float(period)
+        rate = capacity / period
+        if now is None:
+            now = time.time()
+        if now >= self.next_sweep:
+            self.sweep(now)
+        key = (route, tenant)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets.setdefault(key, [capacity, now, now])
+        tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            bucket[2] = now + (capacity - tokens) / rate
+            self.limited += 1
+            return (1 - tokens) / rate
+        bucket[0] = tokens - 1
+        bucket[2] = now + (capacity - bucket[0]) / rate
+        return 0
+
+    def limit(self, limit):
+        amount, period = parse_limit(limit)
+
+        def decorator(f):
+            route = f.__name__
+
+            @wraps(f)
+            def limited(*args, **kwargs):
+                if self.enabled:
+                    tenant = kwargs.get('tree_id')
+                    if tenant is None and self.get_tenant is not None:
+                        tenant = self.get_tenant()
+                    retry_after = self.consume(route, tenant, amount, period)
+                    if retry_after > 0:
+                        return self.on_limited(retry_after)
+                return f(*args, **kwargs)
+            return limited
+        return decorator
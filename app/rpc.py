@@ -0,0 +1,285 @@
+"""
+Binary RPC for internal clients: length-prefixed frames over TCP or a Unix socket, served on the Tornado IOLoop
+
+Frame: 4 bytes payload length (big-endian) + 1 byte codec (0: JSON, 1: MessagePack if installed) + payload
+Request payload: [request_id, method, [args]], response payload: [request_id, code, result or error message]
+Codes are the HTTP API's (200, 400, 404, 409, 500, 507). Clients may send any number of requests without waiting
+(pipelining), responses come back in the same order on the same connection, with the same codec.
+
+    client = RpcClient(('127.0.0.1', 8090))
+    client.call('add_node', 1, 1, 0, 15, 'file', 1512)
+    client.pipeline([('get_level', (1, 1, 0)), ('get_breadcrumbs', (1, 1, 15))])
+"""
+
+# Standard libraries
+import inspect
+import json
+import socket
+import struct
+
+# External libraries
+import tornado.gen
+from tornado.iostream import StreamClosedError
+from tornado.tcpserver import TCPServer
+
+from sharding import shard_for_tree
+from usage import QuotaExceeded
+
+# Optional libraries
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+HEADER = struct.Struct('!IB')
+MAX_FRAME = 16 * 1024 * 1024
+CODEC_JSON = 0
+CODEC_MSGPACK = 1
+
+class RpcError(Exception):
+    """Error answered to the client (code as in the HTTP API)"""
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+# region Codecs
+
+def encode(codec, obj):
+    if codec == CODEC_MSGPACK:
+        return msgpack.packb(obj, use_bin_type=True)
+    return json.dumps(obj, separators=(',', ':'))
+
+def decode(codec, payload):
+    if codec == CODEC_MSGPACK:
+        return msgpack.unpackb(payload, raw=False)
+    return json.loads(payload)
+
+def make_frame(codec, obj):
+    payload = encode(codec, obj)
+    return HEADER.pack(len(payload), codec) + payload
+
+# endregion
+
+# region Methods
+
+def rpc_get_level(epic_tree, tree_id, segment_id, parent_node_id):
+    """Children as [id, type, data, sort]"""
+    children = epic_tree.get_level(tree_id, segment_id, parent_node_id)
+    return [[x['id'], x['child'][1], x['child'][2], x['child'][3]] for x in children]
+
+def rpc_add_tree(epic_tree, tree_id):
+    if tree_id in epic_tree.tree:
+        raise RpcError(409, 'Tree ' + str(tree_id) + ' already exists')
+    epic_tree.add_tree(tree_id)
+    return True
+
+def rpc_add_segment(epic_tree, tree_id, segment_id, root_node_id):
+    if tree_id not in epic_tree.tree:
+        raise KeyError('Tree ' + str(tree_id) + ' not found')
+    if segment_id in epic_tree.tree[tree_id]:
+        raise RpcError(409, 'Segment ' + str(segment_id) + ' already exists')
+    epic_tree.add_segment(tree_id, segment_id, root_node_id)
+    return True
+
+def _add(epic_tree, tree_id, segment_id, parent_node_id, node_id, position):
+    """Validate an addition, returns the segment's nodes (handed to EpicTree, see EpicTree.get_nodes)"""
+    nodes = epic_tree.get_nodes(tree_id, segment_id)
+    if parent_node_id not in nodes:
+        raise KeyError('Parent Node ' + str(parent_node_id) + ' not found')
+    if node_id in nodes:
+        raise RpcError(409, 'Node with Id ' + str(node_id) + ' already exists')
+    if position is not None and position < 1:
+        raise RpcError(400, 'Position can\'t be less than 1')
+    return nodes
+
+def rpc_add_node(epic_tree, tree_id, segment_id, parent_node_id, node_id, node_type, payload, position=None):
+    """Same rules as POST .../node: a non-empty string type, no dir/root (see add_directory), position >= 1"""
+    if not isinstance(node_type, basestring) or node_type == '':
+        raise RpcError(400, 'Node Type must be a non-empty string')
+    if node_type == 'dir' or node_type == 'root':
+        raise RpcError(400, 'Node Type can\'t be root or dir, use add_directory')
+    nodes = _add(epic_tree, tree_id, segment_id, parent_node_id, node_id, position)
+    epic_tree.add_node(tree_id, segment_id, parent_node_id, node_id, position, None, node_type, payload, nodes)
+    return True
+
+def rpc_add_directory(epic_tree, tree_id, segment_id, parent_node_id, node_id, position=None):
+    nodes = _add(epic_tree, tree_id, segment_id, parent_node_id, node_id, position)
+    epic_tree.add_directory(tree_id, segment_id, parent_node_id, node_id, position, None, nodes)
+    return True
+
+def rpc_remove_node(epic_tree, tree_id, segment_id, node_id):
+    nodes = epic_tree.get_nodes(tree_id, segment_id)
+    if node_id not in nodes:
+        raise KeyError('Node ' + str(node_id) + ' doesn\'t exist')
+    epic_tree.remove_node(tree_id, segment_id, node_id, nodes)
+    return True
+
+def _returning_true(method):
+    def rpc_method(epic_tree, *args):
+        getattr(epic_tree, method)(*args)
+        return True
+    # Its arguments are the EpicTree method's (see coerce_arguments)
+    rpc_method.target = method
+    return rpc_method
+
+METHODS = {
+    'get_trees': lambda epic_tree: epic_tree.get_trees(),
+    'get_segments': lambda epic_tree, tree_id: epic_tree.get_segments(tree_id),
+    'get_segment_root_node': lambda epic_tree, tree_id, segment_id: epic_tree.get_segment_root_node(tree_id, segment_id),
+    'get_level': rpc_get_level,
+    'get_breadcrumbs': lambda epic_tree, tree_id, segment_id, node_id: epic_tree.get_breadcrumbs(tree_id, segment_id, node_id),
+    'add_tree': rpc_add_tree,
+    'remove_tree': _returning_true('remove_tree'),
+    'add_segment': rpc_add_segment,
+    'remove_segment': _returning_true('remove_segment'),
+    'add_node': rpc_add_node,
+    'add_directory': rpc_add_directory,
+    'remove_node': rpc_remove_node,
+    'remove_directory': rpc_remove_node,
+}
+
+# Integers like the HTTP API's (int(), e.g. "15" is accepted), position may be None
+ID_ARGUMENTS = ('tree_id', 'segment_id', 'root_node_id', 'parent_node_id', 'node_id')
+
+def coerce_arguments(epic_tree, method, args, shard=None):
+    """
+    The arguments of a call as the method takes them, raises RpcError 400 if args isn't a list the method accepts
+    (count, IDs and position that aren't integers), 421 if the tree belongs to another shard (a TypeError raised by the
+    method itself is a 500)
+    :param shard: (shard index, shard count) if running as a shard, see sharding.py
+    """
+    if not isinstance(args, (list, tuple)):
+        raise RpcError(400, 'Arguments must be a list')
+    function = METHODS[method]
+    if hasattr(function, 'target'):
+        # Unwrapped if instrumented (see metrics.instrument_methods)
+        function = getattr(epic_tree, function.target)
+        function = getattr(function, 'wrapped', function)
+    spec = inspect.getargspec(function)
+    # Without epic_tree / self
+    names = spec.args[1:]
+    minimum = len(names) - len(spec.defaults or ())
+    if len(args) < minimum or (len(args) > len(names) and spec.varargs is None):
+        expected = str(minimum) if minimum == len(names) else str(minimum) + ' to ' + str(len(names))
+        raise RpcError(400, method + ' takes ' + expected + ' arguments (' + str(len(args)) + ' given)')
+    args = list(args)
+    for i, name in enumerate(names[:len(args)]):
+        if name in ID_ARGUMENTS or (name == 'position' and args[i] is not None):
+            try:
+                args[i] = int(args[i])
+            except (TypeError, ValueError):
+                raise RpcError(400, name + ' must be an integer')
+    if shard is not None and 'tree_id' in names:
+        owner = shard_for_tree(args[names.index('tree_id')], shard[1])
+        if owner != shard[0]:
+            raise RpcError(421, 'Tree ' + str(args[names.index('tree_id')]) + ' belongs to shard ' + str(owner))
+    return args
+
+def dispatch(epic_tree, request, shard=None):
+    """[request_id, method, args] => [request_id, code, result or error message], shard: see coerce_arguments"""
+    try:
+        request_id, method, args = request
+    except (TypeError, ValueError):
+        return [None, 400, 'Request must be [request_id, method, [args]]']
+    if not isinstance(method, basestring) or method not in METHODS:
+        return [request_id, 400, 'Unknown method ' + (method if isinstance(method, basestring) else json.dumps(method))]
+    try:
+        args = coerce_arguments(epic_tree, method, args, shard)
+        return [request_id, 200, METHODS[method](epic_tree, *args)]
+    except RpcError as inst:
+        return [request_id, inst.code, str(inst)]
+    except QuotaExceeded as inst:
+        return [request_id, 507, str(inst)]
+    except KeyError as inst:
+        return [request_id, 404, str(inst.args[0]) if len(inst.args) > 0 else 'Not found']
+    except Exception as inst:
+        return [request_id, 500, str(inst)]
+
+# endregion
+
+# region Server
+
+class RpcServer(TCPServer):
+    """Serves the RPC methods on the tree returned by get_epic_tree (the HTTP API's tree), shard: see coerce_arguments"""
+
+    def __init__(self, get_epic_tree, shard=None, **kwargs):
+        TCPServer.__init__(self, **kwargs)
+        self.get_epic_tree = get_epic_tree
+        self.shard = shard
+
+    @tornado.gen.coroutine
+    def handle_stream(self, stream, address):
+        if stream.socket.family != socket.AF_UNIX:
+            # Small answers: don't let Nagle hold them back for the client's delayed ACK
+            stream.set_nodelay(True)
+        try:
+            while True:
+                header = yield stream.read_bytes(HEADER.size)
+                length, codec = HEADER.unpack(header)
+                if length > MAX_FRAME or codec not in (CODEC_JSON, CODEC_MSGPACK) or (codec == CODEC_MSGPACK and msgpack is None):
+                    yield stream.write(make_frame(CODEC_JSON, [None, 400, 'Frame too large or unsupported codec']))
+                    stream.close()
+                    return
+                payload = yield stream.read_bytes(length)
+                try:
+                    request = decode(codec, payload)
+                except Exception:
+                    stream.write(make_frame(codec, [None, 400, 'Payload could not be decoded']))
+                    continue
+                # Written to the stream's buffer right away: pipelined requests are answered in order
+                stream.write(make_frame(codec, dispatch(self.get_epic_tree(), request, self.shard)))
+        except StreamClosedError:
+            pass
+
+# endregion
+
+# region Client
+
+class RpcClient:
+    """Blocking client, address is (host, port) or the path of a Unix socket"""
+
+    def __init__(self, address, codec=CODEC_JSON, timeout=30):
+        if isinstance(address, basestring):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(timeout)
+        self.sock.connect(address)
+        self.reader = self.sock.makefile('rb')
+        self.codec = codec
+        self.next_request_id = 0
+
+    def call(self, method, *args):
+        """Call one method, raises RpcError if the answer isn't a 200"""
+        code, result = self.pipeline([(method, args)])[0]
+        if code != 200:
+            raise RpcError(code, result)
+        return result
+
+    def pipeline(self, calls):
+        """Send every (method, args) call at once, then read the answers: [(code, result)] in the same order"""
+        frames = []
+        for method, args in calls:
+            self.next_request_id += 1
+            frames.append(make_frame(self.codec, [self.next_request_id, method, list(args)]))
+        self.sock.sendall(''.join(frames))
+        results = []
+        for x in range(len(calls)):
+            length, codec = HEADER.unpack(self._read(HEADER.size))
+            request_id, code, result = decode(codec, self._read(length))
+            results.append((code, result))
+        return results
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+    def _read(self, size):
+        data = self.reader.read(size)
+        if len(data) < size:
+            raise RpcError(500, 'Connection closed by the server')
+        return data
+
+# endregion
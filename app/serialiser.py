@@ -0,0 +1,65 @@
+"""
+Response serialisation: JSON (compact in production, indented for development) and optional MessagePack
+
+Output matches what Flask's jsonify produces (sorted keys), but levels are written straight from the node tuples
+instead of going through one dict per node. MessagePack is only offered when the msgpack package is installed.
+"""
+
+# Standard libraries
+import json
+from json.encoder import encode_basestring_ascii
+
+# Optional libraries
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+
+def accepts_msgpack(accept_header):
+    """The client asked for MessagePack (Accept header) and we can produce it"""
+    if msgpack is None or accept_header is None:
+        return False
+    for mimetype in MSGPACK_MIMETYPES:
+        if mimetype in accept_header:
+            return True
+    return False
+
+def encode_json(obj, compact=True):
+    if compact:
+        return json.dumps(obj, sort_keys=True, separators=(',', ':')) + '\n'
+    return json.dumps(obj, sort_keys=True, indent=2, separators=(',', ': ')) + '\n'
+
+def encode_msgpack(obj):
+    return msgpack.packb(obj, use_bin_type=True)
+
+def encode_value(value):
+    """JSON for a scalar (node IDs, types, payloads), json.dumps only for the unusual ones"""
+    if value is None:
+        return 'null'
+    if isinstance(value, basestring):
+        return encode_basestring_ascii(value)
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        return str(value)
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+def encode_level(children):
+    """
+    Compact JSON of a level (what encode_json gives for make_simple_node of every child)
+    :param children: EpicTree.get_level output ([{'id': node_id, 'child': node tuple}])
+    :return: str
+    """
+    items = []
+    for child in children:
+        node = child['child']
+        items.append('{"data":' + encode_value(node[2]) + ',"id":' + encode_value(child['id']) +
+                     ',"sort":' + encode_value(node[3]) + ',"type":' + encode_value(node[1]) + '}')
+    return '[' + ','.join(items) + ']'
+
+def encode_envelope(response_json, code='200', message='OK'):
+    """Compact JSON envelope around an already encoded response"""
+    return ('{"meta":{"code":' + encode_value(code) + ',"message":' + encode_value(message) + '},"response":' +
+            response_json + '}\n')
@@ -0,0 +1,320 @@
+# Standard libraries
+import json
+import logging
+import signal
+import subprocess
+import sys
+import zlib
+
+# Libraries
+from changefeed import MAX_TIMEOUT
+
+# External libraries
+import tornado.gen
+import tornado.web
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+
+logger = logging.getLogger(__name__)
+
+# region Partitioning
+
+def shard_for_tree(tree_id, shard_count):
+    """Find the shard that owns a tree (stable across processes and restarts)"""
+    if shard_count <= 1:
+        return 0
+    return (zlib.crc32(str(int(tree_id))) & 0xffffffff) % shard_count
+
+def shard_data_filename(data_filename, shard_index):
+    """Each shard persists to its own data file (e.g. datafile.shard2)"""
+    return data_filename + '.shard' + str(shard_index)
+
+def shard_port(port, shard_index):
+    """Shards listen on the ports right after the router's port"""
+    return port + 1 + shard_index
+
+def get_shard_argument(argv):
+    """Read the shard index from the command line (--shard N), None if not running as a shard"""
+    if '--shard' not in argv:
+        return None
+    position = argv.index('--shard')
+    if position + 1 >= len(argv) or not argv[position + 1].isdigit():
+        raise ValueError('--shard expects a shard index')
+    return int(argv[position + 1])
+
+# endregion
+
+# region Aggregation
+
+def merge_trees(responses):
+    """Merge the /trees responses of every shard into one sorted list of tree IDs"""
+    results = []
+    for response in responses:
+        results.extend(response)
+    return sorted(results)
+
+def merge_everything(responses):
+    """Merge the /tree (everything) responses of every shard into one dict"""
+    results = {}
+    for response in responses:
+        results.update(response)
+    return results
+
+def merge_booleans(responses):
+    """Broadcast operations (/clear, /persist) only succeed if they succeeded on every shard"""
+    return all(bool(response) for response in responses)
+
+def merge_usage(responses):
+    """Merge the /admin/usage responses of every shard: the trees of all of them (largest first) and the totals"""
+    trees = []
+    for response in responses:
+        trees.extend(response['trees'])
+    trees.sort(key=lambda x: x['bytes'], reverse=True)
+    return {
+        'nodes': sum(x['nodes'] for x in responses),
+        'bytes': sum(x['bytes'] for x in responses),
+        'trees': trees
+    }
+
+# endregion
+
+# region Router
+
+# Headers that only concern one connection (RFC 2616 13.5.1), never forwarded, + the ones the proxy sets itself
+HOP_BY_HOP_HEADERS = frozenset(x.lower() for x in (
+    'Connection', 'Keep-Alive', 'Proxy-Authenticate', 'Proxy-Authorization', 'TE', 'Trailer', 'Trailers',
+    'Transfer-Encoding', 'Upgrade', 'Host', 'Content-Length'
+))
+
+# Requests in flight per shard (tornado's default is 10 for the whole process, the rest queue behind them)
+CONNECTIONS_PER_SHARD = 100
+# Change feed long-polls held open at once (their own HTTP client: they never take the other requests' connections)
+MAX_LONG_POLLS = 10000
+
+class ShardRouterHandler(tornado.web.RequestHandler):
+    """Base handler, knows where the shards live and how to answer in the API's envelope"""
+
+    SUPPORTED_METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+
+    def initialize(self, shard_urls, clients, connections_per_shard):
+        self.shard_urls = shard_urls
+        self.clients = clients
+        self.connections_per_shard = connections_per_shard
+
+    def get_client(self):
+        """HTTP client for the current request: the long-polls' own one for the change feed, else the shards' one"""
+        if self.request.path.endswith('/changes'):
+            name, max_clients = 'long_poll', MAX_LONG_POLLS
+        else:
+            name, max_clients = 'shards', len(self.shard_urls) * self.connections_per_shard
+        if name not in self.clients:
+            self.clients[name] = AsyncHTTPClient(force_instance=True, max_clients=max_clients)
+        return self.clients[name]
+
+    def write_envelope(self, obj, code=200, message='OK'):
+        self.set_status(code)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({'meta': {'code': '200' if code == 200 else code, 'message': message}, 'response': obj}))
+
+    def fetch_shard(self, shard_index, uri=None, body=None):
+        """Forward the current request (or a rewritten one) to a shard"""
+        if body is None:
+            body = self.request.body or None
+        headers = {}
+        for name, value in self.request.headers.get_all():
+            if name.lower() not in HOP_BY_HOP_HEADERS:
+                headers[name] = value
+        # The shards see the client's address (rate limits of the routes without a tree, see ratelimit.py)
+        forwarded_for = self.request.headers.get('X-Forwarded-For')
+        headers['X-Forwarded-For'] = (forwarded_for + ', ' if forwarded_for else '') + self.request.remote_ip
+        shard_request = HTTPRequest(
+            self.shard_urls[shard_index] + (uri or self.request.uri),
+            method=self.request.method,
+            headers=headers,
+            body=body,
+            allow_nonstandard_methods=True,
+            # Long enough for the change feed's long-polls
+            request_timeout=MAX_TIMEOUT + 10
+        )
+        return self.get_client().fetch(shard_request, raise_error=False)
+
+    def relay(self, shard_response):
+        """Send a shard's response back to the client untouched"""
+        if shard_response.code == 599:
+            self.write_envelope(None, 503, 'Shard unavailable: ' + str(shard_response.error))
+            return
+        # With the shard's reason: 429 / 507 are unknown to httplib (tornado refuses them without one)
+        self.set_status(shard_response.code, shard_response.reason or 'Unknown')
+        # ETag, Retry-After, Content-Type, ... (the router's own Server / Date are kept)
+        relayed = set()
+        for name, value in shard_response.headers.get_all():
+            if name.lower() in HOP_BY_HOP_HEADERS or name in ('Server', 'Date'):
+                continue
+            if name in relayed:
+                self.add_header(name, value)
+            else:
+                self.set_header(name, value)
+                relayed.add(name)
+        if shard_response.code == 304:
+            return
+        self.write(shard_response.body or '')
+
+    @tornado.gen.coroutine
+    def forward_to_body_tree(self, missing_message):
+        """Forward the request to the shard owning the tree_id of its JSON body"""
+        try:
+            tree_id = int(json.loads(self.request.body)['tree_id'])
+        except (ValueError, KeyError, TypeError):
+            self.write_envelope(None, 400, missing_message)
+            return
+        shard_response = yield self.fetch_shard(shard_for_tree(tree_id, len(self.shard_urls)))
+        self.relay(shard_response)
+
+    @tornado.gen.coroutine
+    def broadcast(self, merge, bodies=None):
+        """Send the request to every shard and merge the 'response' parts"""
+        futures = []
+        for shard_index in range(len(self.shard_urls)):
+            body = None if bodies is None else bodies[shard_index]
+            futures.append(self.fetch_shard(shard_index, body=body))
+        shard_responses = yield futures
+        responses = []
+        for shard_index, shard_response in enumerate(shard_responses):
+            if shard_response.code != 200:
+                self.write_envelope(None, 502, 'Shard ' + str(shard_index) + ' answered ' + str(shard_response.code))
+                return
+            responses.append(json.loads(shard_response.body)['response'])
+        self.write_envelope(merge(responses))
+
+class TreesHandler(ShardRouterHandler):
+    """/trees: list of trees across all shards"""
+
+    @tornado.gen.coroutine
+    def get(self):
+        yield self.broadcast(merge_trees)
+
+class TreeHandler(ShardRouterHandler):
+    """/tree: create/delete are routed by the tree_id in the body, GET returns everything"""
+
+    @tornado.gen.coroutine
+    def get(self):
+        yield self.broadcast(merge_everything)
+
+    @tornado.gen.coroutine
+    def post(self):
+        yield self.forward_to_body_tree('Tree ID (tree_id) not sent (or incorrect format)')
+
+    delete = post
+
+class IdsHandler(ShardRouterHandler):
+    """/ids: every shard has its own IDs, reserved on the shard owning the tree_id in the body"""
+
+    @tornado.gen.coroutine
+    def post(self):
+        yield self.forward_to_body_tree('Tree ID (tree_id) not sent (or incorrect format), IDs are reserved per shard')
+
+class TreeProxyHandler(ShardRouterHandler):
+    """/tree/<id>/...: forwarded to the shard that owns the tree"""
+
+    @tornado.gen.coroutine
+    def get(self, tree_id, path):
+        shard_response = yield self.fetch_shard(shard_for_tree(tree_id, len(self.shard_urls)))
+        self.relay(shard_response)
+
+    post = put = delete = get
+
+class BroadcastHandler(ShardRouterHandler):
+    """/clear and /persist: sent to every shard (persist filenames get a per-shard suffix)"""
+
+    @tornado.gen.coroutine
+    def post(self, operation):
+        bodies = None
+        content = None
+        if len(self.request.body) > 0:
+            try:
+                content = json.loads(self.request.body)
+            except ValueError:
+                content = None
+        if operation == 'persist' and isinstance(content, dict) and 'filename' in content:
+            bodies = []
+            for shard_index in range(len(self.shard_urls)):
+                shard_content = dict(content)
+                shard_content['filename'] = shard_data_filename(content['filename'], shard_index)
+                bodies.append(json.dumps(shard_content))
+        yield self.broadcast(merge_booleans, bodies)
+
+class UsageHandler(ShardRouterHandler):
+    """/admin/usage: the owning shard for one tree (?tree_id=), else merged over all shards"""
+
+    @tornado.gen.coroutine
+    def get(self):
+        tree_id = self.get_argument('tree_id', None)
+        if tree_id is None:
+            yield self.broadcast(merge_usage)
+            return
+        if not tree_id.isdigit():
+            self.write_envelope(None, 400, 'Tree ID (tree_id) must be an integer')
+            return
+        shard_response = yield self.fetch_shard(shard_for_tree(tree_id, len(self.shard_urls)))
+        self.relay(shard_response)
+
+class ShardProxyHandler(ShardRouterHandler):
+    """/shard/<index>/...: forwarded as-is to one shard (the per-process endpoints: metrics, profiler)"""
+
+    @tornado.gen.coroutine
+    def get(self, shard_index, path):
+        shard_index = int(shard_index)
+        if shard_index >= len(self.shard_urls):
+            self.write_envelope(None, 404, 'Shard ' + str(shard_index) + ' not found (' + str(len(self.shard_urls)) + ' shards)')
+            return
+        uri = (path or '/') + ('?' + self.request.query if self.request.query else '')
+        shard_response = yield self.fetch_shard(shard_index, uri)
+        self.relay(shard_response)
+
+    post = put = delete = get
+
+class PerShardHandler(ShardRouterHandler):
+    """/metrics, /admin/profile: each shard has its own, asked for through /shard/<index>/..."""
+
+    def get(self, path):
+        self.write_envelope(None, 400, '/' + path + ' is per shard process with sharding: use /shard/{0..' +
+                            str(len(self.shard_urls) - 1) + '}/' + path)
+
+    post = put = delete = get
+
+def make_router(shard_urls, connections_per_shard=CONNECTIONS_PER_SHARD):
+    """Tornado application forwarding requests to the shards (at most shards * connections_per_shard in flight)"""
+    # Created on the router's IOLoop, on first use (see ShardRouterHandler.get_client)
+    settings = dict(shard_urls=shard_urls, clients={}, connections_per_shard=connections_per_shard)
+    return tornado.web.Application([
+        (r'/trees', TreesHandler, settings),
+        (r'/tree', TreeHandler, settings),
+        (r'/tree/([0-9]+)(/.*)?', TreeProxyHandler, settings),
+        (r'/(clear|persist)', BroadcastHandler, settings),
+        (r'/ids', IdsHandler, settings),
+        (r'/admin/usage', UsageHandler, settings),
+        (r'/shard/([0-9]+)(/.*)?', ShardProxyHandler, settings),
+        (r'/(metrics|admin/profile)', PerShardHandler, settings),
+    ])
+
+def run_router(port, shard_count, script, connections_per_shard=CONNECTIONS_PER_SHARD):
+    """Spawn one EpicTree process per shard and run the router in front of them"""
+    workers = []
+    for shard_index in range(shard_count):
+        workers.append(subprocess.Popen([sys.executable, script, '--shard', str(shard_index)]))
+        logger.info('Started shard ' + str(shard_index) + ' on port ' + str(shard_port(port, shard_index)))
+    # Stop the router (and the shards with it) on SIGTERM, e.g. docker stop
+    signal.signal(signal.SIGTERM, lambda signum, frame: IOLoop.instance().add_callback_from_signal(IOLoop.instance().stop))
+    # Router
+    shard_urls = ['http://127.0.0.1:' + str(shard_port(port, x)) for x in range(shard_count)]
+    http_server = HTTPServer(make_router(shard_urls, connections_per_shard))
+    http_server.listen(port)
+    try:
+        IOLoop.instance().start()
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+
+# endregion
@@ -0,0 +1,808 @@
+"""
+Flat, immutable snapshot of an EpicTree (one file, can be mmap'ed by many processes)
+
+Layout (little-endian, every section padded to 8 bytes):
+    FILE_HEADER                 magic, format version
+    segment block * N           one block per segment, written sequentially
+    directory                   tree IDs, (tree_id, segment_id, offset, length) per segment, JSON meta
+    FILE_TRAILER                directory offset, segment count, tree count, magic
+
+Segment block:
+    SEGMENT_HEADER              node count, type count, root index, blob size
+    type table                  (length, utf-8) per type, nodes refer to it with a type code
+    columns                     ids (sorted, so a node is found by bisection), parent id, sort, payload value,
+                                parent index, first child index, next sibling index, child count (-1 = None),
+                                payload length, type code, payload kind
+    blob                        string / JSON payloads
+
+Siblings are chained in the order of the parent's children list, so levels come out exactly as EpicTree returns them.
+"""
+
+# Standard libraries
+from array import array
+from bisect import bisect_left
+import errno
+import json
+import mmap
+import os
+import shutil
+import struct
+
+MAGIC = b'EPICTREE'
+FORMAT_VERSION = 1
+
+FILE_HEADER = struct.Struct('<8sII')
+FILE_TRAILER = struct.Struct('<QQQ8s')
+SEGMENT_HEADER = struct.Struct('<QIiQ')
+DIRECTORY_ENTRY = struct.Struct('<qqQQ')
+TYPE_LENGTH = struct.Struct('<H')
+META_LENGTH = struct.Struct('<Q')
+
+# Payload kinds
+PAYLOAD_NONE = 0
+PAYLOAD_INT = 1
+PAYLOAD_STRING = 2
+PAYLOAD_JSON = 3
+
+# Columns: (name, struct code, size)
+COLUMNS = [
+    ('id', 'q', 8),
+    ('parent_id', 'q', 8),
+    ('sort', 'q', 8),
+    ('payload_value', 'q', 8),
+    ('parent', 'i', 4),
+    ('first_child', 'i', 4),
+    ('next_sibling', 'i', 4),
+    ('child_count', 'i', 4),
+    ('payload_length', 'I', 4),
+    ('type', 'H', 2),
+    ('payload_kind', 'B', 1),
+]
+
+NO_PARENT = -2 ** 63
+CHUNK_SIZE = 65536
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+def _padding(size):
+    return b'\0' * ((8 - size % 8) % 8)
+
+def _column_offsets(node_count):
+    """Offset (relative to the first column) of each column in a segment block"""
+    offsets = {}
+    position = 0
+    for name, code, size in COLUMNS:
+        offsets[name] = position
+        position += node_count * size
+        position += (8 - position % 8) % 8
+    return offsets, position
+
+# region Writing
+
+def is_snapshot_file(filename):
+    """Does this file start with the snapshot magic?"""
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def _encode_payload(payload):
+    """Payload kind, int value and blob bytes for a payload"""
+    if payload is None:
+        return PAYLOAD_NONE, 0, b''
+    if isinstance(payload, bool):
+        return PAYLOAD_JSON, 0, json.dumps(payload).encode('utf-8')
+    if isinstance(payload, (int, long)) and INT64_MIN <= payload <= INT64_MAX:
+        return PAYLOAD_INT, payload, b''
+    if isinstance(payload, basestring):
+        if isinstance(payload, unicode):
+            return PAYLOAD_STRING, 0, payload.encode('utf-8')
+        return PAYLOAD_STRING, 0, payload
+    return PAYLOAD_JSON, 0, json.dumps(payload).encode('utf-8')
+
+def _write_column(f, code, values):
+    """Pack a column in chunks, so big segments never need one huge temporary string"""
+    for start in range(0, len(values), CHUNK_SIZE):
+        chunk = values[start:start + CHUNK_SIZE]
+        f.write(struct.pack('<' + str(len(chunk)) + code, *chunk))
+
+def write_segment(f, nodes):
+    """Write one segment block ({node_id: (parent, type, payload, sort, children)}), returns its length"""
+    ids = sorted(int(x) for x in nodes)
+    index = dict((node_id, i) for i, node_id in enumerate(ids))
+    node_count = len(ids)
+    columns = dict((name, [0] * node_count) for name, code, size in COLUMNS)
+    columns['parent'] = [-1] * node_count
+    columns['first_child'] = [-1] * node_count
+    columns['next_sibling'] = [-1] * node_count
+    types = []
+    type_codes = {}
+    blob = []
+    blob_size = 0
+    root_index = -1
+    for i, node_id in enumerate(ids):
+        node = nodes[node_id]
+        parent_id, node_type, payload, sort, children = node[0], node[1], node[2], node[3], node[4]
+        columns['id'][i] = node_id
+        columns['parent_id'][i] = NO_PARENT if parent_id is None else int(parent_id)
+        columns['parent'][i] = index.get(parent_id, -1)
+        columns['sort'][i] = int(sort)
+        if node_type not in type_codes:
+            type_codes[node_type] = len(types)
+            types.append(node_type)
+        columns['type'][i] = type_codes[node_type]
+        if node_type == 'root' and root_index == -1:
+            root_index = i
+        kind, value, data = _encode_payload(payload)
+        columns['payload_kind'][i] = kind
+        if len(data) > 0:
+            value = blob_size
+            blob.append(data)
+            blob_size += len(data)
+        columns['payload_value'][i] = value
+        columns['payload_length'][i] = len(data)
+        # Chain children in list order
+        if children is None:
+            columns['child_count'][i] = -1
+            continue
+        previous = -1
+        count = 0
+        for child_id in children:
+            child = index.get(child_id)
+            if child is None:
+                continue
+            if previous == -1:
+                columns['first_child'][i] = child
+            else:
+                columns['next_sibling'][previous] = child
+            previous = child
+            count += 1
+        columns['child_count'][i] = count
+    # Header + type table
+    length = 0
+    header = SEGMENT_HEADER.pack(node_count, len(types), root_index, blob_size)
+    f.write(header)
+    length += len(header)
+    type_table = b''
+    for node_type in types:
+        encoded = (node_type if node_type is not None else '').encode('utf-8')
+        type_table += TYPE_LENGTH.pack(len(encoded)) + encoded
+    type_table += _padding(len(type_table))
+    f.write(type_table)
+    length += len(type_table)
+    # Columns
+    for name, code, size in COLUMNS:
+        _write_column(f, code, columns[name])
+        columns[name] = None
+        column_size = node_count * size
+        f.write(_padding(column_size))
+        length += column_size + len(_padding(column_size))
+    # Blob
+    for data in blob:
+        f.write(data)
+    f.write(_padding(blob_size))
+    length += blob_size + len(_padding(blob_size))
+    return length
+
+def write_snapshot(tree, filename, meta=None):
+    """
+    Write a snapshot of a tree dict ({tree_id: {segment_id: {node_id: node}}}) with sequential I/O
+    Written to a temporary file first and renamed, so readers never see a half-written snapshot
+    :param tree: dict
+    :param filename: str
+    :param meta: dict (JSON serialisable, stored as-is)
+    :return:
+    """
+    temp_filename = filename + '.tmp'
+    entries = []
+    with open(temp_filename, 'wb') as f:
+        f.write(FILE_HEADER.pack(MAGIC, FORMAT_VERSION, 0))
+        offset = FILE_HEADER.size
+        for tree_id, segments in iter(tree.items()):
+            # Segments that were loaded but never decoded are copied as they are
+            for segment_id, nodes in iter(dict.items(segments)):
+                if isinstance(nodes, (SnapshotSegment, SegmentFile)):
+                    data = nodes.raw()
+                    f.write(data)
+                    length = len(data)
+                else:
+                    length = write_segment(f, nodes)
+                entries.append((int(tree_id), int(segment_id), offset, length))
+                offset += length
+        # Directory
+        directory_offset = offset
+        tree_ids = [int(x) for x in tree]
+        f.write(struct.pack('<' + str(len(tree_ids)) + 'q', *tree_ids))
+        for entry in entries:
+            f.write(DIRECTORY_ENTRY.pack(*entry))
+        encoded_meta = json.dumps(meta or {}).encode('utf-8')
+        f.write(META_LENGTH.pack(len(encoded_meta)) + encoded_meta + _padding(len(encoded_meta)))
+        f.write(FILE_TRAILER.pack(directory_offset, len(entries), len(tree_ids), MAGIC))
+    try:
+        os.rename(temp_filename, filename)
+    except OSError as inst:
+        if inst.errno not in (errno.EBUSY, errno.EXDEV):
+            raise
+        # Target can't be replaced (e.g. a file bind-mounted by docker): overwrite it in place,
+        # after decoding every segment that may still be mapped from it
+        for segments in tree.values():
+            if isinstance(segments, LazySegments):
+                segments.items()
+        with open(temp_filename, 'rb') as source:
+            with open(filename, 'wb') as target:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+        os.remove(temp_filename)
+    return
+
+# endregion
+
+# region Reading
+
+class SnapshotSegment:
+    """One segment of a snapshot, read straight from the mapped buffer (nothing is decoded up-front)"""
+
+    def __init__(self, buf, offset, length):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+        self.node_count, type_count, self.root_index, self.blob_size = SEGMENT_HEADER.unpack_from(buf, offset)
+        position = offset + SEGMENT_HEADER.size
+        self.types = []
+        type_table_start = position
+        for x in range(type_count):
+            (length,) = TYPE_LENGTH.unpack_from(buf, position)
+            position += TYPE_LENGTH.size
+            self.types.append(buf[position:position + length].decode('utf-8'))
+            position += length
+        position += (8 - (position - type_table_start) % 8) % 8
+        offsets, columns_size = _column_offsets(self.node_count)
+        self.columns = dict((name, position + offsets[name]) for name in offsets)
+        self.blob_offset = position + columns_size
+
+    def _value(self, column, code, size, index):
+        return struct.unpack_from('<' + code, self.buf, self.columns[column] + index * size)[0]
+
+    def find(self, node_id):
+        """Index of a node (binary search on the sorted ID column), -1 if not found"""
+        low = 0
+        high = self.node_count - 1
+        ids_offset = self.columns['id']
+        while low <= high:
+            middle = (low + high) // 2
+            (middle_id,) = struct.unpack_from('<q', self.buf, ids_offset + middle * 8)
+            if middle_id < node_id:
+                low = middle + 1
+            elif middle_id > node_id:
+                high = middle - 1
+            else:
+                return middle
+        return -1
+
+    def node_id(self, index):
+        return self._value('id', 'q', 8, index)
+
+    def parent_index(self, index):
+        return self._value('parent', 'i', 4, index)
+
+    def children_indexes(self, index):
+        """Indexes of a node's children (in order), None if the node has no children list"""
+        if self._value('child_count', 'i', 4, index) == -1:
+            return None
+        results = []
+        child = self._value('first_child', 'i', 4, index)
+        while child != -1:
+            results.append(child)
+            child = self._value('next_sibling', 'i', 4, child)
+        return results
+
+    def payload(self, index):
+        kind = self._value('payload_kind', 'B', 1, index)
+        if kind == PAYLOAD_NONE:
+            return None
+        value = self._value('payload_value', 'q', 8, index)
+        if kind == PAYLOAD_INT:
+            return value
+        length = self._value('payload_length', 'I', 4, index)
+        data = self.buf[self.blob_offset + value:self.blob_offset + value + length].decode('utf-8')
+        if kind == PAYLOAD_STRING:
+            return data
+        return json.loads(data)
+
+    def node(self, index):
+        """Node tuple in the EpicTree format (parent, type, payload, sort, children)"""
+        parent_id = self._value('parent_id', 'q', 8, index)
+        children = self.children_indexes(index)
+        if children is not None:
+            children = [self.node_id(x) for x in children]
+        return (
+            None if parent_id == NO_PARENT else parent_id,
+            self.types[self._value('type', 'H', 2, index)],
+            self.payload(index),
+            self._value('sort', 'q', 8, index),
+            children
+        )
+
+    def column(self, name):
+        """Decode a whole column at once (one unpack call instead of one per node)"""
+        for column_name, code, size in COLUMNS:
+            if column_name == name:
+                return struct.unpack_from('<' + str(self.node_count) + code, self.buf, self.columns[name])
+        raise KeyError('Column ' + name + ' doesn\'t exist')
+
+    def to_dict(self):
+        """Decode the whole segment into the EpicTree dict format"""
+        ids = self.column('id')
+        parent_ids = self.column('parent_id')
+        sorts = self.column('sort')
+        type_codes = self.column('type')
+        payload_kinds = self.column('payload_kind')
+        payload_values = self.column('payload_value')
+        first_children = self.column('first_child')
+        next_siblings = self.column('next_sibling')
+        child_counts = self.column('child_count')
+        types = self.types
+        nodes = {}
+        for x in range(self.node_count):
+            # Children (in list order)
+            children = None
+            if child_counts[x] != -1:
+                children = []
+                child = first_children[x]
+                while child != -1:
+                    children.append(ids[child])
+                    child = next_siblings[child]
+            # Payload
+            kind = payload_kinds[x]
+            if kind == PAYLOAD_INT:
+                payload = payload_values[x]
+            elif kind == PAYLOAD_NONE:
+                payload = None
+            else:
+                payload = self.payload(x)
+            parent_id = parent_ids[x]
+            nodes[ids[x]] = (None if parent_id == NO_PARENT else parent_id, types[type_codes[x]], payload, sorts[x], children)
+        return nodes
+
+    def raw(self):
+        """Encoded block, copied as-is when re-writing a segment that was never decoded"""
+        return self.buf[self.offset:self.offset + self.length]
+
+class Snapshot:
+    """Read-only view of a snapshot file, mmap'ed (pages are shared between every process reading it)"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        stat = os.fstat(self.file.fileno())
+        self.identity = (stat.st_ino, stat.st_mtime, stat.st_size)
+        self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        header_magic, self.format_version, flags = FILE_HEADER.unpack_from(self.buf, 0)
+        if header_magic != MAGIC:
+            raise ValueError('Not an EpicTree snapshot: ' + filename)
+        if self.format_version > FORMAT_VERSION:
+            raise ValueError('Unsupported snapshot format version ' + str(self.format_version))
+        directory_offset, segment_count, tree_count, trailer_magic = FILE_TRAILER.unpack_from(
+            self.buf, len(self.buf) - FILE_TRAILER.size)
+        if trailer_magic != MAGIC:
+            raise ValueError('Snapshot is truncated: ' + filename)
+        # Directory
+        self.tree_ids = list(struct.unpack_from('<' + str(tree_count) + 'q', self.buf, directory_offset))
+        position = directory_offset + tree_count * 8
+        self.offsets = {}
+        self.lengths = {}
+        self.segment_ids = dict((x, []) for x in self.tree_ids)
+        for x in range(segment_count):
+            tree_id, segment_id, offset, length = DIRECTORY_ENTRY.unpack_from(self.buf, position)
+            position += DIRECTORY_ENTRY.size
+            self.offsets[(tree_id, segment_id)] = offset
+            self.lengths[(tree_id, segment_id)] = length
+            self.segment_ids[tree_id].append(segment_id)
+        (meta_length,) = META_LENGTH.unpack_from(self.buf, position)
+        position += META_LENGTH.size
+        self.meta = json.loads(self.buf[position:position + meta_length].decode('utf-8'))
+        self.segments = {}
+
+    def close(self):
+        self.segments = {}
+        self.buf.close()
+        self.file.close()
+
+    def segment(self, tree_id, segment_id):
+        """Segment reader (created on first use)"""
+        key = (tree_id, segment_id)
+        if key not in self.segments:
+            if tree_id not in self.segment_ids:
+                raise KeyError('Tree ' + str(tree_id) + ' doesn\'t exist')
+            if key not in self.offsets:
+                raise KeyError('Segment ' + str(segment_id) + ' doesn\'t exist')
+            self.segments[key] = SnapshotSegment(self.buf, self.offsets[key], self.lengths[key])
+        return self.segments[key]
+
+    def get_trees(self):
+        """Get list of tree IDs"""
+        return list(self.tree_ids)
+
+    def get_segments(self, tree_id):
+        """Get the segments that belong to a tree"""
+        if tree_id not in self.segment_ids:
+            raise KeyError('Tree ' + str(tree_id) + ' doesn\'t exist')
+        return list(self.segment_ids[tree_id])
+
+    def get_segment_root_node(self, tree_id, segment_id):
+        """Find root node ID in segment"""
+        segment = self.segment(tree_id, segment_id)
+        if segment.root_index == -1:
+            return None
+        return segment.node_id(segment.root_index)
+
+    def get_level(self, tree_id, segment_id, parent_node_id):
+        """Get Level (children of a parent node), same format as EpicTree.get_level"""
+        segment = self.segment(tree_id, segment_id)
+        parent = segment.find(parent_node_id)
+        if parent == -1:
+            raise KeyError('Parent node ' + str(parent_node_id) + ' doesn\'t exist')
+        results = []
+        children = segment.children_indexes(parent)
+        if children is not None:
+            for child in children:
+                results.append({'id': segment.node_id(child), 'child': segment.node(child)})
+        return results
+
+    def get_breadcrumbs(self, tree_id, segment_id, node_id):
+        """Get Breadcrumbs (find ancestors), following parent indexes"""
+        segment = self.segment(tree_id, segment_id)
+        index = segment.find(node_id)
+        if index == -1:
+            raise KeyError('Node ' + str(node_id) + ' doesn\'t exist')
+        path = []
+        while index != -1:
+            path.append(segment.node_id(index))
+            index = segment.parent_index(index)
+        path.reverse()
+        return path
+
+class LazySegments(dict):
+    """
+    Segments of a tree loaded from a snapshot: {segment_id: nodes}
+    Each segment stays encoded in the mapped file until it is first accessed
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        # Segments decoded since usage accounting last looked (see usage.UsageAccounting)
+        self.decoded = []
+
+    def __getitem__(self, segment_id):
+        nodes = dict.__getitem__(self, segment_id)
+        if isinstance(nodes, (SnapshotSegment, SegmentFile)):
+            nodes = nodes.to_dict()
+            dict.__setitem__(self, segment_id, nodes)
+            self.decoded.append(segment_id)
+        return nodes
+
+    def get(self, segment_id, default=None):
+        if segment_id not in self:
+            return default
+        return self[segment_id]
+
+    def values(self):
+        return [self[x] for x in self.keys()]
+
+    def items(self):
+        return [(x, self[x]) for x in self.keys()]
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def pop(self, segment_id, *default):
+        if segment_id not in self:
+            return dict.pop(self, segment_id, *default)
+        nodes = self[segment_id]
+        dict.__delitem__(self, segment_id)
+        return nodes
+
+    def copy(self):
+        return dict(self.items())
+
+def segment_node_count(nodes):
+    """Number of nodes in a segment, without decoding it if it is still encoded"""
+    if isinstance(nodes, (SnapshotSegment, SegmentFile)):
+        return nodes.node_count
+    return len(nodes)
+
+def load_snapshot(filename):
+    """Load a snapshot file as a tree dict (segments are decoded lazily, on first access)"""
+    snapshot = Snapshot(filename)
+    tree = {}
+    for tree_id in snapshot.get_trees():
+        segments = LazySegments()
+        for segment_id in snapshot.get_segments(tree_id):
+            dict.__setitem__(segments, segment_id, snapshot.segment(tree_id, segment_id))
+        tree[tree_id] = segments
+    return tree
+
+# region Frozen segments (in memory)
+
+class FrozenSegment:
+    """
+    Read-only segment packed into arrays (what EpicTree freezes idle segments into, see EpicTree.freeze_idle)
+    Same columns as a snapshot segment block, as arrays: ~50 bytes per node (plus the payload blob) instead of a dict
+    entry, a tuple and a children list. Reads go through the same {node_id: node} interface as the segment dicts
+    (the node tuples are built when they are read), writes need the dict back (to_dict).
+    """
+
+    def __init__(self, nodes):
+        ids = sorted(nodes)
+        node_count = len(ids)
+        self.ids = array('l', ids)
+        self.parent_ids = array('l', [0]) * node_count
+        self.sorts = array('l', [0]) * node_count
+        self.type_codes = array('H', [0]) * node_count
+        self.payload_kinds = array('B', [0]) * node_count
+        self.payload_values = array('l', [0]) * node_count
+        self.payload_lengths = array('I', [0]) * node_count
+        self.child_counts = array('i', [-1]) * node_count
+        self.child_starts = array('i', [0]) * node_count
+        self.child_ids = array('l')
+        # Positions of the parents / children, so levels and breadcrumbs are read without searching the IDs
+        self.parent_indexes = array('i', [-1]) * node_count
+        self.child_indexes = array('i')
+        index = dict((node_id, i) for i, node_id in enumerate(ids))
+        self.types = []
+        self.root_node_id = None
+        type_codes = {}
+        blob = []
+        blob_size = 0
+        for i, node_id in enumerate(ids):
+            parent_id, node_type, payload, sort, children = nodes[node_id]
+            self.parent_ids[i] = NO_PARENT if parent_id is None else parent_id
+            self.parent_indexes[i] = index.get(parent_id, -1)
+            self.sorts[i] = sort
+            if node_type not in type_codes:
+                type_codes[node_type] = len(self.types)
+                self.types.append(node_type)
+            self.type_codes[i] = type_codes[node_type]
+            if node_type == 'root' and self.root_node_id is None:
+                self.root_node_id = node_id
+            kind, value, data = _encode_payload(payload)
+            self.payload_kinds[i] = kind
+            if len(data) > 0:
+                value = blob_size
+                blob.append(data)
+                blob_size += len(data)
+            self.payload_values[i] = value
+            self.payload_lengths[i] = len(data)
+            if children is not None:
+                self.child_counts[i] = len(children)
+                self.child_starts[i] = len(self.child_ids)
+                self.child_ids.extend(children)
+                self.child_indexes.extend(index.get(x, -1) for x in children)
+        self.blob = b''.join(blob)
+
+    def index(self, node_id):
+        """Position of a node in the columns, -1 if not found"""
+        i = bisect_left(self.ids, node_id)
+        if i < len(self.ids) and self.ids[i] == node_id:
+            return i
+        return -1
+
+    def node(self, i):
+        """Node tuple in the EpicTree format (parent, type, payload, sort, children)"""
+        parent_id = self.parent_ids[i]
+        kind = self.payload_kinds[i]
+        if kind == PAYLOAD_INT:
+            payload = self.payload_values[i]
+        elif kind == PAYLOAD_NONE:
+            payload = None
+        else:
+            start = self.payload_values[i]
+            payload = self.blob[start:start + self.payload_lengths[i]].decode('utf-8')
+            if kind == PAYLOAD_JSON:
+                payload = json.loads(payload)
+        count = self.child_counts[i]
+        children = None
+        if count != -1:
+            start = self.child_starts[i]
+            children = self.child_ids[start:start + count].tolist()
+        return (None if parent_id == NO_PARENT else parent_id, self.types[self.type_codes[i]], payload, self.sorts[i], children)
+
+    def level(self, node_id):
+        """[(child_id, child node)] of a node, in the order of its children list (None if it isn't there)"""
+        i = self.index(node_id)
+        if i == -1:
+            return None
+        count = self.child_counts[i]
+        if count <= 0:
+            return []
+        start = self.child_starts[i]
+        children = []
+        for x in xrange(start, start + count):
+            if self.child_indexes[x] == -1:
+                raise KeyError(self.child_ids[x])
+            children.append((self.child_ids[x], self.node(self.child_indexes[x])))
+        return children
+
+    def path(self, node_id):
+        """IDs from the root down to node_id (None if it isn't there), see EpicTree.get_breadcrumbs"""
+        i = self.index(node_id)
+        if i == -1:
+            return None
+        path = []
+        while i != -1:
+            path.append(self.ids[i])
+            if self.parent_indexes[i] == -1 and self.parent_ids[i] != NO_PARENT:
+                raise KeyError(self.parent_ids[i])
+            i = self.parent_indexes[i]
+        path.reverse()
+        return path
+
+    def get(self, node_id, default=None):
+        i = self.index(node_id)
+        return default if i == -1 else self.node(i)
+
+    def __getitem__(self, node_id):
+        i = self.index(node_id)
+        if i == -1:
+            raise KeyError(node_id)
+        return self.node(i)
+
+    def __contains__(self, node_id):
+        return self.index(node_id) != -1
+
+    def keys(self):
+        return self.ids.tolist()
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def items(self):
+        return ((node_id, self.node(i)) for i, node_id in enumerate(self.ids))
+
+    def values(self):
+        return (self.node(i) for i in xrange(len(self.ids)))
+
+    def get_size(self):
+        """Bytes of the columns and the payload blob"""
+        return sum(x.itemsize * len(x) for x in vars(self).values() if isinstance(x, array)) + len(self.blob)
+
+    def to_dict(self):
+        """The segment dict back (thawing)"""
+        return dict(self.items())
+
+# endregion
+
+# region Incremental persistence (one file per segment + manifest)
+
+MANIFEST_FILENAME = 'manifest.json'
+MANIFEST_VERSION = 1
+
+def segment_filename(tree_id, segment_id):
+    return 'segment_' + str(tree_id) + '_' + str(segment_id) + '.snapshot'
+
+class SegmentFile:
+    """Segment persisted in its own snapshot file, only opened when it is decoded or copied"""
+
+    def __init__(self, filename, tree_id, segment_id):
+        self.filename = filename
+        self.tree_id = tree_id
+        self.segment_id = segment_id
+        self._node_count = None
+
+    @property
+    def node_count(self):
+        if self._node_count is None:
+            self._node_count = self._read(lambda segment: segment.node_count)
+        return self._node_count
+
+    def _read(self, fn):
+        snapshot = Snapshot(self.filename)
+        try:
+            return fn(snapshot.segment(self.tree_id, self.segment_id))
+        finally:
+            snapshot.close()
+
+    def to_dict(self):
+        return self._read(lambda segment: segment.to_dict())
+
+    def raw(self):
+        return self._read(lambda segment: segment.raw())
+
+def read_manifest(directory):
+    """Manifest of a segments directory ({tree_id: [segment_ids]}), None if nothing was persisted yet"""
+    filename = os.path.join(directory, MANIFEST_FILENAME)
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, 'rb') as f:
+        manifest = json.loads(f.read().decode('utf-8'))
+    if manifest['format_version'] > MANIFEST_VERSION:
+        raise ValueError('Unsupported manifest format version ' + str(manifest['format_version']))
+    return dict((int(tree_id), [int(x) for x in segment_ids]) for tree_id, segment_ids in manifest['trees'].items())
+
+def write_segments(tree, directory, dirty_segments, meta=None):
+    """
+    Incremental persistence: re-write the dirty segments (and segments missing from the manifest),
+    then the manifest, then remove the files of segments that no longer exist
+    :param tree: dict
+    :param directory: str
+    :param dirty_segments: set of (tree_id, segment_id)
+    :param meta: dict (JSON serialisable, stored in the manifest)
+    :return: int (number of segment files written)
+    """
+    persisted = set()
+    for tree_id, segment_ids in iter((read_manifest(directory) or {}).items()):
+        for segment_id in segment_ids:
+            persisted.add((tree_id, segment_id))
+    existing = set()
+    manifest = {}
+    written = 0
+    for tree_id, segments in iter(tree.items()):
+        manifest[str(tree_id)] = []
+        for segment_id in segments.keys():
+            key = (tree_id, segment_id)
+            existing.add(key)
+            manifest[str(tree_id)].append(segment_id)
+            if key in dirty_segments or key not in persisted:
+                # Segments that were never decoded are copied without decoding them
+                nodes = dict.__getitem__(segments, segment_id)
+                write_snapshot({tree_id: {segment_id: nodes}}, os.path.join(directory, segment_filename(tree_id, segment_id)))
+                written += 1
+    # Manifest (replaced atomically, it is what makes the new segment files visible)
+    filename = os.path.join(directory, MANIFEST_FILENAME)
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(json.dumps({'format_version': MANIFEST_VERSION, 'trees': manifest, 'meta': meta or {}}).encode('utf-8'))
+    os.rename(filename + '.tmp', filename)
+    # Segments that were removed since the last time
+    for tree_id, segment_id in persisted - existing:
+        removed_filename = os.path.join(directory, segment_filename(tree_id, segment_id))
+        if os.path.isfile(removed_filename):
+            os.remove(removed_filename)
+    return written
+
+def read_meta(filename):
+    """Meta stored with a snapshot file or in a segments directory's manifest ({} if there is none)"""
+    if os.path.isdir(filename):
+        manifest_filename = os.path.join(filename, MANIFEST_FILENAME)
+        if not os.path.isfile(manifest_filename):
+            return {}
+        with open(manifest_filename, 'rb') as f:
+            return json.loads(f.read().decode('utf-8')).get('meta', {})
+    snapshot = Snapshot(filename)
+    try:
+        return snapshot.meta
+    finally:
+        snapshot.close()
+
+def load_segments(directory):
+    """Load a segments directory as a tree dict (each segment file is only read when the segment is used)"""
+    tree = {}
+    for tree_id, segment_ids in iter((read_manifest(directory) or {}).items()):
+        segments = LazySegments()
+        for segment_id in segment_ids:
+            filename = os.path.join(directory, segment_filename(tree_id, segment_id))
+            dict.__setitem__(segments, segment_id, SegmentFile(filename, tree_id, segment_id))
+        tree[tree_id] = segments
+    return tree
+
+# endregion
+
+class SnapshotReader:
+    """Keeps a snapshot open and re-maps it when the writer publishes a new one"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.snapshot = None
+
+    def current(self):
+        """Latest published snapshot (cheap stat() if nothing changed)"""
+        stat = os.stat(self.filename)
+        identity = (stat.st_ino, stat.st_mtime, stat.st_size)
+        if self.snapshot is None or self.snapshot.identity != identity:
+            # Old mapping stays valid for whoever still holds it, it is released once unreferenced
+            self.snapshot = Snapshot(self.filename)
+        return self.snapshot
+
+# endregion
@@ -1,8 +1,29 @@
 import unittest
 import app
+import sharding
+import snapshot
+import cache
+import serialiser
+import rpc
+import ratelimit
+import epictree
+import merkle
+import usage
+import pickle
+import shutil
+import tempfile
 import os
 import json
 import logging
+import threading
+import random
+import time
+import urllib2
+import tornado.web
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+from tornado.wsgi import WSGIContainer
 
 
 class TreeTest(unittest.TestCase):
@@ -199,6 +220,25 @@ class TreeTest(unittest.TestCase):
         self.assertEqual(int(result['meta']['code']), 200)
         self.assertEqual(len(result['response']), 1)  # 1 directory
 
+    def test_serialiser(self):
+        """
+        Endpoint: /tree/{ID}/segment/{ID}/level/{PARENT_NODE_ID} (compact JSON written from the node tuples)
+        Methods: ['GET']
+        Responses: 200
+        """
+        segment_url = '/tree/' + str(self.TREE_ID) + '/segment/' + str(self.SEGMENT_ID)
+        for node_id, payload in [(210, u'caf\xe9 "x"'), (211, 12), (212, {'b': [1, None], 'a': 1.5})]:
+            post_data = json.dumps(dict(parent_node_id=self.ROOT_ID, node_id=node_id, type='file', payload=payload))
+            self.app.post(segment_url + '/node', data=post_data, content_type='application/json')
+        http_response = self.app.get(segment_url + '/level/' + str(self.ROOT_ID), follow_redirects=True)
+        # Same bytes as serialising the simple node dicts
+        children = app.epicTree.get_level(self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID)
+        nodes = [app.make_simple_node(child['id'], child['child']) for child in children]
+        expected = serialiser.encode_json({'meta': {'code': '200', 'message': 'OK'}, 'response': nodes})
+        self.assertEqual(http_response.data, expected)
+        self.assertEqual(json.loads(http_response.data)['response'][1]['data'], u'caf\xe9 "x"')
+        self.assertTrue('\n' not in http_response.data.rstrip('\n'))
+
     def test_breadcrumbs(self):
         """
         Endpoint: /tree/{ID}/segment/{ID}/breadcrumbs/{NODE_ID}
@@ -220,23 +260,315 @@ class TreeTest(unittest.TestCase):
         self.assertEqual(len(result['response']), 3)
         self.assertEqual(result['response'], [self.ROOT_ID, self.FIRST_DIR_ID, subdir])
 
+    def test_segment_resolution(self):
+        """
+        Endpoint: /tree/{ID}/segment/{ID}/level/{PARENT_NODE_ID} (tree => segment resolved once, nodes handed to EpicTree)
+        Methods: ['GET']
+        Responses: 200, 404
+        """
+        nodes = app.epicTree.get_nodes(self.TREE_ID, self.SEGMENT_ID)
+        self.assertTrue(nodes is app.epicTree.tree[self.TREE_ID][self.SEGMENT_ID])
+        self.assertEqual(app.epicTree.get_level(self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID, nodes),
+                         app.epicTree.get_level(self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID))
+        self.assertRaises(KeyError, app.epicTree.get_nodes, self.TREE_ID, 999)
+        self.assertRaises(KeyError, app.epicTree.get_breadcrumbs, self.TREE_ID, self.SEGMENT_ID, 999, nodes)
+        for url, message in [('/tree/999/segment/1/level/1', 'Tree 999 not found'),
+                             ('/tree/' + str(self.TREE_ID) + '/segment/999/level/1', 'Segment 999 not found')]:
+            http_response = self.app.get(url, follow_redirects=True)
+            self.assertEqual(http_response.status_code, 404)
+            self.assertEqual(json.loads(http_response.data)['meta']['message'], message)
+
+    def test_descendants(self):
+        """
+        Endpoint: /tree/{ID}/segment/{ID}/descendants
+        Methods: ['POST']
+        Params: pairs ([[node_id, ancestor_node_id], ...])
+        Responses: 200, 400, 404
+        """
+        segment_url = '/tree/' + str(self.TREE_ID) + '/segment/' + str(self.SEGMENT_ID)
+        post_data = json.dumps(dict(parent_node_id=self.FIRST_DIR_ID, node_id=210))
+        self.app.post(segment_url + '/directory', data=post_data, content_type='application/json')
+        pairs = [[210, self.FIRST_DIR_ID], [210, self.ROOT_ID], [self.FIRST_DIR_ID, 210], [210, 210], [999, self.ROOT_ID]]
+        http_response = self.app.post(segment_url + '/descendants', data=json.dumps(dict(pairs=pairs)),
+                                      content_type='application/json')
+        self.assertEqual(json.loads(http_response.data)['response'], [True, True, False, False, False])
+        # Labels follow the changes (without rebuilding the segment)
+        rebuilds = app.epicTree.intervals.rebuilds
+        for x in range(10):
+            post_data = json.dumps(dict(parent_node_id=210 + x, node_id=211 + x))
+            self.app.post(segment_url + '/directory', data=post_data, content_type='application/json')
+        self.assertTrue(app.epicTree.is_descendant(self.TREE_ID, self.SEGMENT_ID, 220, 210))
+        self.assertTrue(app.epicTree.is_descendant(self.TREE_ID, self.SEGMENT_ID, 220, self.FIRST_DIR_ID))
+        self.assertFalse(app.epicTree.is_descendant(self.TREE_ID, self.SEGMENT_ID, 215, 218))
+        self.assertEqual(app.epicTree.intervals.rebuilds, rebuilds)
+        self.app.delete(segment_url + '/node/220', follow_redirects=True)
+        self.assertFalse(app.epicTree.is_descendant(self.TREE_ID, self.SEGMENT_ID, 220, 210))
+        # Removing a directory drops the labels of the segment, its (orphaned) children aren't under anything anymore
+        self.app.delete(segment_url + '/directory/215', follow_redirects=True)
+        self.assertFalse(app.epicTree.is_descendant(self.TREE_ID, self.SEGMENT_ID, 218, 210))
+        self.assertEqual(app.epicTree.intervals.rebuilds, rebuilds + 1)
+        # Same answers as the breadcrumbs
+        for node_id in [210, 212, 214]:
+            crumbs = app.epicTree.get_breadcrumbs(self.TREE_ID, self.SEGMENT_ID, node_id)
+            for ancestor_node_id in range(200, 222):
+                self.assertEqual(app.epicTree.is_descendant(self.TREE_ID, self.SEGMENT_ID, node_id, ancestor_node_id),
+                                 ancestor_node_id in crumbs[:-1])
+        # Bad input
+        http_response = self.app.post(segment_url + '/descendants', data=json.dumps(dict(pairs=[[1]])),
+                                      content_type='application/json')
+        self.assertEqual(http_response.status_code, 400)
+        http_response = self.app.post('/tree/999/segment/1/descendants', data=json.dumps(dict(pairs=[])),
+                                      content_type='application/json')
+        self.assertEqual(http_response.status_code, 404)
+
+    def test_subtree(self):
+        """
+        Endpoint: /tree/{ID}/segment/{ID}/subtree/{NODE_ID}
+        Methods: ['GET']
+        Params: type?, min_depth?, max_depth?, limit?
+        Responses: 200, 400, 404
+        """
+        segment_url = '/tree/' + str(self.TREE_ID) + '/segment/' + str(self.SEGMENT_ID)
+        # FIRST_DIR / 210 / 211 (smartview), FIRST_DIR / 212 (file), FIRST_DIR / 210 / 213 (file)
+        self.app.post(segment_url + '/directory', data=json.dumps(dict(parent_node_id=self.FIRST_DIR_ID, node_id=210)),
+                      content_type='application/json')
+        for parent_node_id, node_id, node_type in [(210, 211, 'smartview'), (self.FIRST_DIR_ID, 212, 'file'), (210, 213, 'file')]:
+            post_data = json.dumps(dict(parent_node_id=parent_node_id, node_id=node_id, type=node_type, payload=node_id))
+            self.app.post(segment_url + '/node', data=post_data, content_type='application/json')
+        get_url = segment_url + '/subtree/' + str(self.FIRST_DIR_ID)
+        result = json.loads(self.app.get(get_url, follow_redirects=True).data)['response']
+        self.assertEqual([(x['id'], x['depth'], x['parent']) for x in result],
+                         [(210, 1, self.FIRST_DIR_ID), (211, 2, 210), (213, 2, 210), (212, 1, self.FIRST_DIR_ID)])
+        result = json.loads(self.app.get(get_url + '?type=file', follow_redirects=True).data)['response']
+        self.assertEqual([x['id'] for x in result], [213, 212])
+        result = json.loads(self.app.get(get_url + '?type=file,smartview&max_depth=1', follow_redirects=True).data)['response']
+        self.assertEqual([x['id'] for x in result], [212])
+        result = json.loads(self.app.get(get_url + '?min_depth=2&limit=1', follow_redirects=True).data)['response']
+        self.assertEqual([x['id'] for x in result], [211])
+        result = json.loads(self.app.get(segment_url + '/subtree/210?min_depth=0&type=dir', follow_redirects=True).data)
+        self.assertEqual([x['id'] for x in result['response']], [210])
+        # Kept up to date: removed nodes are gone, new ones show up
+        self.app.delete(segment_url + '/node/211', follow_redirects=True)
+        post_data = json.dumps(dict(parent_node_id=210, node_id=214, type='smartview', payload=1))
+        self.app.post(segment_url + '/node', data=post_data, content_type='application/json')
+        self.assertEqual([x['id'] for x in app.epicTree.get_subtree(self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID, ['smartview'])],
+                         [214])
+        # Bad input
+        self.assertEqual(self.app.get(get_url + '?min_depth=2&max_depth=1', follow_redirects=True).status_code, 400)
+        self.assertEqual(self.app.get(get_url + '?limit=0', follow_redirects=True).status_code, 400)
+        self.assertEqual(self.app.get(segment_url + '/subtree/999', follow_redirects=True).status_code, 404)
+
+    def test_response_cache(self):
+        """
+        Endpoint: /tree/{ID}/segment/{ID}/level/{PARENT_NODE_ID}, /tree/{ID}/segment/{ID}/breadcrumbs/{NODE_ID}
+        Methods: ['GET'] (cached), ['POST', 'DELETE'] (invalidation)
+        Responses: 200, 404
+        """
+        subdir = 210
+        segment_url = '/tree/' + str(self.TREE_ID) + '/segment/' + str(self.SEGMENT_ID)
+        post_data = json.dumps(dict(parent_node_id=self.FIRST_DIR_ID, node_id=subdir))
+        self.app.post(segment_url + '/directory', data=post_data, content_type='application/json')
+        # Cached on first read (the root was already read in setUp), same body afterwards
+        level = self.app.get(segment_url + '/level/' + str(self.ROOT_ID), follow_redirects=True).data
+        crumbs = self.app.get(segment_url + '/breadcrumbs/' + str(subdir), follow_redirects=True).data
+        self.assertEqual(len(app.response_cache), 3)
+        self.assertEqual(self.app.get(segment_url + '/level/' + str(self.ROOT_ID), follow_redirects=True).data, level)
+        self.assertEqual(self.app.get(segment_url + '/breadcrumbs/' + str(subdir), follow_redirects=True).data, crumbs)
+        # Adding under the subdirectory touches neither the root level nor the subdirectory's breadcrumbs
+        post_data = json.dumps(dict(parent_node_id=subdir, node_id=211))
+        self.app.post(segment_url + '/directory', data=post_data, content_type='application/json')
+        self.assertEqual(len(app.response_cache), 3)
+        # Adding under the root drops its level
+        post_data = json.dumps(dict(parent_node_id=self.ROOT_ID, node_id=212))
+        self.app.post(segment_url + '/directory', data=post_data, content_type='application/json')
+        result = json.loads(self.app.get(segment_url + '/level/' + str(self.ROOT_ID), follow_redirects=True).data)
+        self.assertEqual(len(result['response']), 2)
+        # Removing a directory drops the breadcrumbs going through it
+        self.app.delete(segment_url + '/directory/' + str(self.FIRST_DIR_ID), follow_redirects=True)
+        http_response = self.app.get(segment_url + '/breadcrumbs/' + str(subdir), follow_redirects=True)
+        self.assertEqual(http_response.status_code, 404)
+        # LRU eviction
+        response_cache = cache.ResponseCache(2)
+        response_cache.put((1, 1, 1, 'level'), 'a', [1])
+        response_cache.put((1, 1, 2, 'level'), 'b', [2])
+        response_cache.get((1, 1, 1, 'level'))
+        response_cache.put((1, 1, 3, 'level'), 'c', [3])
+        self.assertEqual(response_cache.get((1, 1, 2, 'level')), None)
+        self.assertEqual(response_cache.get((1, 1, 1, 'level')), 'a')
+        response_cache.invalidate(1, 1, [1])
+        self.assertEqual(len(response_cache), 1)
+
+    def test_etag(self):
+        """
+        Endpoint: /tree/{ID}/segment/{ID}/level/{PARENT_NODE_ID}, /tree/{ID}/segment/{ID}/breadcrumbs/{NODE_ID}
+        Methods: ['GET'] (If-None-Match)
+        Responses: 200, 304
+        """
+        segment_url = '/tree/' + str(self.TREE_ID) + '/segment/' + str(self.SEGMENT_ID)
+        level_url = segment_url + '/level/' + str(self.ROOT_ID)
+        crumbs_url = segment_url + '/breadcrumbs/' + str(self.FIRST_DIR_ID)
+        level_etag = self.app.get(level_url, follow_redirects=True).headers['ETag']
+        crumbs_etag = self.app.get(crumbs_url, follow_redirects=True).headers['ETag']
+        # Nothing changed: 304 without a body
+        http_response = self.app.get(level_url, headers={'If-None-Match': level_etag})
+        self.assertEqual(http_response.status_code, 304)
+        self.assertEqual(http_response.data, '')
+        # Adding under the first directory changes neither the root level nor its breadcrumbs
+        post_data = json.dumps(dict(parent_node_id=self.FIRST_DIR_ID, node_id=210))
+        self.app.post(segment_url + '/directory', data=post_data, content_type='application/json')
+        self.assertEqual(self.app.get(level_url, headers={'If-None-Match': level_etag}).status_code, 304)
+        self.assertEqual(self.app.get(crumbs_url, headers={'If-None-Match': crumbs_etag}).status_code, 304)
+        # Adding under the root changes its level
+        post_data = json.dumps(dict(parent_node_id=self.ROOT_ID, node_id=211))
+        self.app.post(segment_url + '/directory', data=post_data, content_type='application/json')
+        http_response = self.app.get(level_url, headers={'If-None-Match': level_etag})
+        self.assertEqual(http_response.status_code, 200)
+        self.assertNotEqual(http_response.headers['ETag'], level_etag)
+        # Versions only move forward, also when everything is cleared
+        version = app.epicTree.get_level_version(self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID)
+        self.app.post('/clear', data=(), content_type='application/json')
+        self.assertTrue(app.epicTree.get_level_version(self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID) > version)
+
+    def test_changes(self):
+        """
+        Endpoint: /tree/{ID}/segment/{ID}/changes
+        Methods: ['GET']
+        Params: since?, subtree?, epoch?
+        Responses: 200, 404, 410
+        """
+        segment_url = '/tree/' + str(self.TREE_ID) + '/segment/' + str(self.SEGMENT_ID)
+        # Subscribe: nothing changed since now
+        result = json.loads(self.app.get(segment_url + '/changes', follow_redirects=True).data)['response']
+        self.assertEqual(result['changes'], [])
+        since = result['version']
+        # Mutations show up, in order
+        post_data = json.dumps(dict(parent_node_id=self.FIRST_DIR_ID, node_id=210))
+        self.app.post(segment_url + '/directory', data=post_data, content_type='application/json')
+        post_data = json.dumps(dict(parent_node_id=self.ROOT_ID, node_id=212, type='file', payload=5))
+        self.app.post(segment_url + '/node', data=post_data, content_type='application/json')
+        post_data = json.dumps(dict(parent_node_id=self.ROOT_ID, node_id=211, type='file', payload=5, position=1))
+        self.app.post(segment_url + '/node', data=post_data, content_type='application/json')
+        self.app.delete(segment_url + '/directory/210', follow_redirects=True)
+        get_url = segment_url + '/changes?since=' + str(since) + '&epoch=' + result['epoch']
+        result = json.loads(self.app.get(get_url, follow_redirects=True).data)['response']
+        self.assertEqual([x['op'] for x in result['changes']], ['add_node', 'add_node', 'add_node', 'remove_node'])
+        self.assertEqual(result['changes'][0]['path'], [self.ROOT_ID, self.FIRST_DIR_ID])
+        self.assertEqual(result['changes'][2]['shifted'], True)
+        # Only a subtree
+        result = json.loads(self.app.get(get_url + '&subtree=' + str(self.FIRST_DIR_ID), follow_redirects=True).data)
+        self.assertEqual([x['node_id'] for x in result['response']['changes']], [210, 210])
+        # Wrong epoch (restarted service) or dropped changes: 410
+        http_response = self.app.get(segment_url + '/changes?since=' + str(since) + '&epoch=x', follow_redirects=True)
+        self.assertEqual(http_response.status_code, 410)
+        app.change_feed.size = 2
+        app.change_feed.clear()
+        for x in range(3):
+            post_data = json.dumps(dict(parent_node_id=self.ROOT_ID, node_id=220 + x))
+            self.app.post(segment_url + '/directory', data=post_data, content_type='application/json')
+        http_response = self.app.get(segment_url + '/changes?since=' + str(since), follow_redirects=True)
+        app.change_feed.size = 1000
+        self.assertEqual(http_response.status_code, 410)
+        http_response = self.app.get('/tree/' + str(self.TREE_ID) + '/segment/1/changes', follow_redirects=True)
+        self.assertEqual(http_response.status_code, 404)
+
+    def test_lookup(self):
+        """
+        Endpoint: /tree/{ID}/lookup
+        Methods: ['POST']
+        Params: lookups ([[segment_id, node_id, kind], ...], kind: level, breadcrumbs, root or path)
+        Responses: 200, 400, 404
+        """
+        tree_url = '/tree/' + str(self.TREE_ID)
+        post_data = json.dumps(dict(parent_node_id=self.FIRST_DIR_ID, node_id=210))
+        self.app.post(tree_url + '/segment/' + str(self.SEGMENT_ID) + '/directory', data=post_data,
+                      content_type='application/json')
+        lookups = [[self.SEGMENT_ID, 210, 'breadcrumbs'], [self.SEGMENT_ID, self.FIRST_DIR_ID, 'level'],
+                   [self.SEGMENT_ID, None, 'root'], [self.SEGMENT_ID, 210, 'path'], [self.SEGMENT_ID, 999, 'level'],
+                   [999, 1, 'level']]
+        http_response = self.app.post(tree_url + '/lookup', data=json.dumps(dict(lookups=lookups)),
+                                      content_type='application/json')
+        self.assertEqual(http_response.status_code, 200)
+        response = json.loads(http_response.data)['response']
+        self.assertEqual(response['version'], app.epicTree.version)
+        results = response['results']
+        self.assertEqual(results[0], {'code': 200, 'response': [self.ROOT_ID, self.FIRST_DIR_ID, 210]})
+        self.assertEqual([x['id'] for x in results[1]['response']], [210])
+        self.assertEqual(results[2]['response'], self.ROOT_ID)
+        self.assertEqual([x['id'] for x in results[3]['response']], [self.ROOT_ID, self.FIRST_DIR_ID, 210])
+        self.assertEqual([x['id'] for x in results[3]['response'][1]['children']], [210])
+        self.assertEqual(results[3]['response'][2]['children'], [])
+        self.assertEqual([x['code'] for x in results[4:]], [404, 404])
+        # Same answers as the single routes
+        single = self.app.get(tree_url + '/segment/' + str(self.SEGMENT_ID) + '/level/' + str(self.FIRST_DIR_ID),
+                              follow_redirects=True)
+        self.assertEqual(json.loads(single.data)['response'], results[1]['response'])
+        # Bad input
+        for lookups in [[[self.SEGMENT_ID, 210]], [[self.SEGMENT_ID, 210, 'children']], [[self.SEGMENT_ID, None, 'level']]]:
+            http_response = self.app.post(tree_url + '/lookup', data=json.dumps(dict(lookups=lookups)),
+                                          content_type='application/json')
+            self.assertEqual(http_response.status_code, 400)
+        http_response = self.app.post('/tree/999/lookup', data=json.dumps(dict(lookups=[])),
+                                      content_type='application/json')
+        self.assertEqual(http_response.status_code, 404)
+
     def test_tree_segment_get(self):
         """
         Endpoint: /tree/{ID}/segment/{ID}
         Methods: ['GET']
+        Params: depth?, node?
         Responses: 200, 400, 404, 500
         """
-        # TODO
-        self.assertEqual(1, 1)
+        segment_url = '/tree/' + str(self.TREE_ID) + '/segment/' + str(self.SEGMENT_ID)
+        # ROOT / FIRST_DIR / 210 / 211, ROOT / 212 (file, sorted before FIRST_DIR)
+        self.app.post(segment_url + '/directory', data=json.dumps(dict(parent_node_id=self.FIRST_DIR_ID, node_id=210)),
+                      content_type='application/json')
+        self.app.post(segment_url + '/directory', data=json.dumps(dict(parent_node_id=210, node_id=211)),
+                      content_type='application/json')
+        post_data = json.dumps(dict(parent_node_id=self.ROOT_ID, node_id=212, type='file', payload=5))
+        self.app.post(segment_url + '/node', data=post_data, content_type='application/json')
+        app.epicTree.tree[self.TREE_ID][self.SEGMENT_ID][212] = (self.ROOT_ID, 'file', 5, 0, None)
+        # Whole segment, sorted
+        result = json.loads(self.app.get(segment_url, follow_redirects=True).data)['response']
+        self.assertEqual(result['id'], self.ROOT_ID)
+        self.assertEqual([x['id'] for x in result['children']], [212, self.FIRST_DIR_ID])
+        self.assertTrue('children' not in result['children'][0])
+        self.assertEqual(result['children'][1]['children'][0]['children'][0]['id'], 211)
+        # Two levels: the directories below get a child count and an expand token
+        result = json.loads(self.app.get(segment_url + '?depth=2', follow_redirects=True).data)['response']
+        directory = result['children'][1]['children'][0]
+        self.assertEqual(directory['id'], 210)
+        self.assertTrue('children' not in directory)
+        self.assertEqual(directory['child_count'], 1)
+        self.assertEqual(directory['expand'], str(self.SEGMENT_ID) + '.210')
+        # From a node
+        result = json.loads(self.app.get(segment_url + '?node=210&depth=0', follow_redirects=True).data)['response']
+        self.assertEqual((result['id'], result['child_count']), (210, 1))
+        # Bad input
+        self.assertEqual(self.app.get(segment_url + '?depth=x', follow_redirects=True).status_code, 400)
+        self.assertEqual(self.app.get(segment_url + '?node=999', follow_redirects=True).status_code, 404)
+        self.assertEqual(self.app.get('/tree/' + str(self.TREE_ID) + '/segment/999', follow_redirects=True).status_code, 404)
 
     def test_tree_get(self):
         """
         Endpoint: /tree/{ID}
         Methods: ['GET']
+        Params: depth?, expand?
         Responses: 200, 400, 404, 500
         """
-        # TODO
-        self.assertEqual(1, 1)
+        tree_url = '/tree/' + str(self.TREE_ID)
+        post_data = json.dumps(dict(parent_node_id=self.FIRST_DIR_ID, node_id=210))
+        self.app.post(tree_url + '/segment/' + str(self.SEGMENT_ID) + '/directory', data=post_data,
+                      content_type='application/json')
+        result = json.loads(self.app.get(tree_url + '?depth=1', follow_redirects=True).data)['response']
+        first_dir = result[str(self.SEGMENT_ID)]['children'][0]
+        self.assertEqual((first_dir['id'], first_dir['child_count']), (self.FIRST_DIR_ID, 1))
+        # Expand what was left out
+        result = json.loads(self.app.get(tree_url + '?depth=1&expand=' + first_dir['expand'], follow_redirects=True).data)
+        self.assertEqual([x['id'] for x in result['response']['children']], [210])
+        # Bad input
+        self.assertEqual(self.app.get(tree_url + '?expand=x', follow_redirects=True).status_code, 400)
+        self.assertEqual(self.app.get(tree_url + '?expand=1.1', follow_redirects=True).status_code, 404)
+        self.assertEqual(self.app.get('/tree/999', follow_redirects=True).status_code, 404)
 
     def test_everything_get(self):
         """
@@ -397,6 +729,29 @@ class TreeTest(unittest.TestCase):
         # Remove temporary file
         os.remove(test_file)
 
+    def test_persist_node_type(self):
+        test_file = "test.data"
+        post_url = '/tree/' + str(self.TREE_ID) + '/segment/' + str(self.SEGMENT_ID) + '/node'
+        # Types are stored as strings: anything else is refused (HTTP and RPC)
+        for node_type in [7, '', None, ['asset']]:
+            post_data = json.dumps(dict(parent_node_id=self.ROOT_ID, node_id=210, type=node_type, payload=1))
+            http_response = self.app.post(post_url, data=post_data, content_type='application/json')
+            self.assertEqual(http_response.status_code, 400)
+            request = [1, 'add_node', [self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID, 210, node_type, 1]]
+            self.assertEqual(rpc.dispatch(app.epicTree, request)[1], 400)
+        post_data = json.dumps(dict(parent_node_id=self.ROOT_ID, node_id=210, type=u'caf\xe9', payload=1))
+        http_response = self.app.post(post_url, data=post_data, content_type='application/json')
+        self.assertEqual(http_response.status_code, 200)
+        # Persist + reload
+        post_data = json.dumps(dict(filename=test_file))
+        http_response = self.app.post('/persist', data=post_data, content_type='application/json')
+        self.assertEqual(http_response.status_code, 200)
+        try:
+            app.init_from_filesystem(test_file)
+            self.assertEqual(app.epicTree.get_level(self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID)[1]['child'][1], u'caf\xe9')
+        finally:
+            os.remove(test_file)
+
     # endregion
 
     # region Load
@@ -422,6 +777,766 @@ class TreeTest(unittest.TestCase):
         # Remove temporary file
         os.remove(test_file)
 
+    def test_tree_load_snapshot(self):
+        test_file = "test.data"
+        # Persist example tree
+        app.load_example_tree()
+        expected = app.epicTree.get_level(154, 12, 0)
+        post_data = json.dumps(dict(filename=test_file))
+        http_response = self.app.post('/persist', data=post_data, content_type='application/json')
+        self.assertEqual(http_response.status_code, 200)
+        self.assertTrue(snapshot.is_snapshot_file(test_file))
+        try:
+            # Segments are only decoded once they are used
+            app.init_from_filesystem(test_file)
+            self.assertTrue(isinstance(dict.__getitem__(app.epicTree.tree[154], 12), snapshot.SnapshotSegment))
+            self.assertEqual(app.epicTree.get_level(154, 12, 0), expected)
+            self.assertEqual(app.epicTree.get_segments(154), [12, 15])
+            self.assertEqual(app.epicTree.get_trees(), [154, 165])
+            # Legacy pickled data files can still be loaded
+            pickle.dump(app.epicTree.tree[154].copy(), open(test_file, 'wb'), pickle.HIGHEST_PROTOCOL)
+            self.assertEqual(epictree.EpicTree(test_file).tree[12][0], (None, 'root', None, 1, [1251, 241, 4612]))
+        finally:
+            os.remove(test_file)
+        # Only plain file names are accepted
+        post_data = json.dumps(dict(filename='../test.data'))
+        http_response = self.app.post('/persist', data=post_data, content_type='application/json')
+        self.assertEqual(http_response.status_code, 400)
+
+    def test_persist_segments(self):
+        directory = tempfile.mkdtemp()
+        try:
+            # First persist writes every segment
+            app.load_example_tree()
+            self.assertEqual(app.epicTree.persist_segments(directory), 2)
+            self.assertEqual(app.epicTree.persist_segments(directory), 0)
+            # Only the changed segment is re-written
+            app.epicTree.add_node(154, 15, 0, 20, None, None, 'asset', 'new')
+            self.assertEqual(app.epicTree.dirty_segments, set([(154, 15)]))
+            self.assertEqual(app.epicTree.persist_segments(directory), 1)
+            # Removed segments are removed from the directory
+            app.epicTree.remove_segment(154, 12)
+            self.assertEqual(app.epicTree.persist_segments(directory), 0)
+            self.assertEqual(sorted(os.listdir(directory)), ['manifest.json', 'segment_154_15.snapshot'])
+            # Reload
+            loaded = epictree.EpicTree(directory)
+            self.assertEqual(loaded.get_trees(), [154, 165])
+            self.assertEqual(loaded.get_segments(154), [15])
+            self.assertEqual(loaded.get_level(154, 15, 0), app.epicTree.get_level(154, 15, 0))
+        finally:
+            shutil.rmtree(directory)
+
+    # endregion
+
+    # region IDs
+
+    def test_ids(self):
+        """
+        Endpoint: /ids (+ unmanaged creates: /tree/{ID}/segment, .../directory, .../node without IDs)
+        Methods: ['POST']
+        Params: kind (node, segment), count
+        Responses: 200, 400
+        """
+        tree_url = '/tree/' + str(self.TREE_ID)
+        app.unmanaged = True
+        try:
+            # Allocation starts after the highest existing ID (scanned once)
+            http_response = self.app.post(tree_url + '/segment', data=json.dumps(dict()), content_type='application/json')
+            result = json.loads(http_response.data)['response']
+            segment_id, root_node_id = result['segment_id'], result['root_node_id']
+            self.assertEqual(segment_id, self.SEGMENT_ID + 1)
+            self.assertEqual(root_node_id, self.FIRST_DIR_ID + 1)
+            self.assertEqual(app.epicTree.get_segment_root_node(self.TREE_ID, segment_id), root_node_id)
+            segment_url = tree_url + '/segment/' + str(segment_id)
+            post_data = json.dumps(dict(parent_node_id=root_node_id))
+            http_response = self.app.post(segment_url + '/directory', data=post_data, content_type='application/json')
+            directory_id = json.loads(http_response.data)['response']
+            self.assertEqual(directory_id, root_node_id + 1)
+            # IDs sent by callers are skipped
+            post_data = json.dumps(dict(parent_node_id=directory_id, node_id=directory_id + 1, type='file', payload=1))
+            self.app.post(segment_url + '/node', data=post_data, content_type='application/json')
+            post_data = json.dumps(dict(parent_node_id=directory_id, type='file', payload=2))
+            http_response = self.app.post(segment_url + '/node', data=post_data, content_type='application/json')
+            self.assertEqual(json.loads(http_response.data)['response'], directory_id + 2)
+        finally:
+            app.unmanaged = False
+        # Managed mode still requires the IDs
+        http_response = self.app.post(tree_url + '/segment', data=json.dumps(dict()), content_type='application/json')
+        self.assertEqual(http_response.status_code, 400)
+        # Bulk reservation, outside the current block
+        http_response = self.app.post('/ids', data=json.dumps(dict(kind='node', count=5000)), content_type='application/json')
+        reserved = json.loads(http_response.data)['response']
+        self.assertEqual(reserved['last'] - reserved['first'], 4999)
+        self.assertTrue(reserved['first'] > directory_id + 2)
+        self.assertEqual(app.epicTree.allocate_node_id(), directory_id + 3)
+        for count in [0, 'x', app.MAX_RESERVED_IDS + 1]:
+            http_response = self.app.post('/ids', data=json.dumps(dict(count=count)), content_type='application/json')
+            self.assertEqual(http_response.status_code, 400)
+        # The high-water mark is persisted with the tree: IDs aren't handed out again after a restart
+        handle, test_file = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            snapshot.write_snapshot(app.epicTree.tree, test_file, app.epicTree.get_meta())
+            loaded = epictree.EpicTree(test_file)
+            self.assertEqual(loaded.allocate_node_id(), reserved['last'] + 1)
+            self.assertEqual(loaded.allocate_segment_id(), app.epicTree.ids.get_high_water()['segment'])
+        finally:
+            os.remove(test_file)
+        # Sharded: per shard, for a tree it owns
+        owners = [sharding.shard_for_tree(tree_id, 3) for tree_id in range(10)]
+        app.shard_index, app.shard_count = 1, 3
+        try:
+            for content, code in [(dict(count=5), 400), (dict(count=5, tree_id=owners.index(0)), 421),
+                                  (dict(count=5, tree_id=owners.index(1)), 200)]:
+                http_response = self.app.post('/ids', data=json.dumps(content), content_type='application/json')
+                self.assertEqual(http_response.status_code, code)
+        finally:
+            app.shard_index, app.shard_count = None, 0
+
+    # endregion
+
+    # region Metrics
+
+    def test_metrics(self):
+        """
+        Endpoint: /metrics
+        Methods: ['GET']
+        Responses: 200, 404
+        """
+        app.enable_metrics()
+        try:
+            get_url = '/tree/' + str(self.TREE_ID) + '/segment/' + str(self.SEGMENT_ID) + '/breadcrumbs/' + str(self.FIRST_DIR_ID)
+            self.app.get(get_url, follow_redirects=True)
+            self.app.get(get_url + '0', follow_redirects=True)
+            http_response = self.app.get('/metrics', follow_redirects=True)
+            self.assertEqual(http_response.status_code, 200)
+            lines = http_response.data.split('\n')
+            self.assertTrue('epictree_http_responses_total{route="breadcrumbs",code="200"} 1' in lines)
+            self.assertTrue('epictree_http_responses_total{route="breadcrumbs",code="404"} 1' in lines)
+            self.assertTrue('epictree_method_duration_seconds_count{method="get_breadcrumbs"} 1' in lines)
+            self.assertTrue('epictree_nodes 2' in lines)
+            self.assertTrue('epictree_trees 1' in lines)
+        finally:
+            app.registry.enabled = False
+
+    # endregion
+
+    # region Rate limiting
+
+    def test_rate_limit(self):
+        """
+        Endpoint: /tree/{ID}/segments (limited per tree)
+        Methods: ['GET']
+        Responses: 200, 429
+        """
+        self.assertEqual(ratelimit.parse_limit('200000/hour'), (200000, 3600))
+        self.assertEqual(ratelimit.parse_tenant_scales('154:10, 165:0.5'), {154: 10.0, 165: 0.5})
+        # Buckets refill over time
+        limiter = ratelimit.TokenBucketLimiter()
+        self.assertEqual([limiter.consume('route', 1, 2, 60, 100.0) for x in range(3)], [0, 0, 30.0])
+        self.assertEqual(limiter.consume('route', 1, 2, 60, 130.0), 0)
+        # Each tree has its own bucket
+        app.epicTree.add_tree(self.TREE_ID + 1)
+        app.limiter.configure(True, 1.0 / 50000, {self.TREE_ID + 1: 2})
+        try:
+            url = '/tree/' + str(self.TREE_ID) + '/segments'
+            self.assertEqual(self.app.get(url, follow_redirects=True).status_code, 200)
+            http_response = self.app.get(url, follow_redirects=True)
+            self.assertEqual(http_response.status_code, 429)
+            self.assertEqual(int(json.loads(http_response.data)['meta']['code']), 429)
+            self.assertEqual(http_response.headers['Retry-After'], '3600')
+            url = '/tree/' + str(self.TREE_ID + 1) + '/segments'
+            self.assertEqual([self.app.get(url, follow_redirects=True).status_code for x in range(3)], [200, 200, 429])
+            # A removed tree's buckets go with it
+            self.assertTrue(('segments', self.TREE_ID + 1) in app.limiter.buckets)
+            app.epicTree.remove_tree(self.TREE_ID + 1)
+            self.assertFalse(('segments', self.TREE_ID + 1) in app.limiter.buckets)
+            # Routes without a tree in the URL: the tree_id of the body, else the client (behind the router too)
+            app.limiter.configure(True, 1.0 / 5000)
+            post_ids = lambda content, headers={}: self.app.post('/ids', data=json.dumps(content), headers=headers,
+                                                                 content_type='application/json').status_code
+            self.assertEqual([post_ids(dict(count=1, tree_id=x)) for x in (1, 1, 2)], [200, 429, 200])
+            self.assertEqual([post_ids(dict(count=1), {'X-Forwarded-For': x}) for x in ('10.0.0.1', '10.0.0.1', '10.0.0.2')],
+                             [200, 429, 200])
+            # Refilled buckets are dropped
+            self.assertEqual([limiter.consume('route', 2, 2, 60, 100.0), len(limiter.buckets)], [0, 2])
+            limiter.sweep(200.0)
+            self.assertEqual(limiter.buckets, {})
+        finally:
+            app.limiter.configure()
+
+    # endregion
+
+    # region Admin
+
+    def test_profile(self):
+        """
+        Endpoint: /admin/profile
+        Methods: ['POST', 'GET', 'DELETE']
+        Params: duration, interval
+        Responses: 200, 400, 409
+        """
+        post_data = json.dumps(dict(duration=5, interval=0.001))
+        http_response = self.app.post('/admin/profile', data=post_data, content_type='application/json')
+        self.assertEqual(http_response.status_code, 200)
+        # Only one session at a time
+        http_response = self.app.post('/admin/profile', data=post_data, content_type='application/json')
+        self.assertEqual(http_response.status_code, 409)
+        # Do some work while sampling
+        get_url = '/tree/' + str(self.TREE_ID) + '/segment/' + str(self.SEGMENT_ID) + '/level/' + str(self.ROOT_ID)
+        for x in range(200):
+            self.app.get(get_url, follow_redirects=True)
+        http_response = self.app.delete('/admin/profile', follow_redirects=True)
+        result = json.loads(http_response.data)
+        self.assertEqual(result['response']['running'], False)
+        self.assertTrue(result['response']['samples'] > 0)
+        # Collapsed stacks
+        http_response = self.app.get('/admin/profile?format=collapsed', follow_redirects=True)
+        self.assertTrue('test.py:test_profile' in http_response.data)
+        # Bad input
+        http_response = self.app.post('/admin/profile', data=json.dumps(dict(duration='x')), content_type='application/json')
+        self.assertEqual(http_response.status_code, 400)
+
+    # endregion
+
+    # region Sharding
+
+    def test_sharding(self):
+        """
+        Endpoint: /tree (as shard 1 of 3)
+        Methods: ['POST']
+        Responses: 200, 421
+        """
+        # Partitioning is stable and covers every shard
+        owners = [sharding.shard_for_tree(tree_id, 3) for tree_id in range(1000)]
+        self.assertEqual(owners, [sharding.shard_for_tree(tree_id, 3) for tree_id in range(1000)])
+        self.assertEqual(sorted(set(owners)), [0, 1, 2])
+        self.assertEqual(sharding.shard_data_filename('datafile', 2), 'datafile.shard2')
+        self.assertEqual(sharding.merge_trees([[5, 1], [3]]), [1, 3, 5])
+        # A shard only accepts the trees it owns
+        app.shard_index, app.shard_count = 1, 3
+        try:
+            for tree_id in [owners.index(0), owners.index(1)]:
+                post_data = json.dumps(dict(tree_id=tree_id))
+                http_response = self.app.post('/tree', data=post_data, content_type='application/json')
+                result = json.loads(http_response.data)
+                self.assertEqual(int(result['meta']['code']), 200 if owners[tree_id] == 1 else 421)
+        finally:
+            app.shard_index, app.shard_count = None, 0
+
+    # endregion
+
+    # region RPC
+
+    def test_rpc(self):
+        """
+        RPC (rpc.py) on the app's tree: calls, pipelining, error codes
+        """
+        sock, port = bind_unused_port()
+        io_loop = IOLoop()
+
+        def serve():
+            io_loop.make_current()
+            rpc.RpcServer(lambda: app.epicTree).add_socket(sock)
+            io_loop.start()
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        client = rpc.RpcClient(('127.0.0.1', port))
+        try:
+            client.call('add_node', self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID, 210, 'file', u'caf\xe9')
+            self.assertEqual(client.call('get_level', self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID),
+                             [[self.FIRST_DIR_ID, 'dir', None, 1], [210, 'file', u'caf\xe9', 2]])
+            # Answers come back in order, errors with the HTTP API's codes
+            results = client.pipeline([('get_breadcrumbs', (self.TREE_ID, self.SEGMENT_ID, 210)),
+                                       ('add_directory', (self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID, 210)),
+                                       ('get_level', (self.TREE_ID, self.SEGMENT_ID, 999)),
+                                       ('add_node', (self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID, 211, 'dir', None)),
+                                       ('get_level', (self.TREE_ID,)),
+                                       ('nope', ()),
+                                       ('remove_node', (self.TREE_ID, self.SEGMENT_ID, 210))])
+            self.assertEqual([x[0] for x in results], [200, 409, 404, 400, 400, 400, 200])
+            self.assertEqual(results[0][1], [self.ROOT_ID, 210])
+            self.assertRaises(rpc.RpcError, client.call, 'get_segments', 999)
+            # Wrong argument counts are the client's (EpicTree's signature behind remove_tree), TypeErrors inside a method aren't
+            self.assertEqual(rpc.dispatch(app.epicTree, [1, 'remove_tree', [self.TREE_ID, 1]])[1], 400)
+            self.assertEqual(rpc.dispatch(app.epicTree, [1, 'add_directory', [self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID, 212, 2, 3]])[1], 400)
+            self.assertEqual(rpc.dispatch(app.epicTree, [1, 'get_segments', 5])[1], 400)
+            broken = type('BrokenTree', (), {'get_trees': lambda tree: sorted(None)})()
+            self.assertEqual(rpc.dispatch(broken, [1, 'get_trees', []])[1], 500)
+            # IDs are integers as in the HTTP API, the method a string
+            self.assertEqual(rpc.dispatch(app.epicTree, [1, 'add_tree', ['301']]), [1, 200, True])
+            self.assertEqual(app.epicTree.get_trees(), [self.TREE_ID, 301])
+            self.assertEqual(rpc.dispatch(app.epicTree, [1, 'add_node', [self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID, 'x', 'file', 1]])[1], 400)
+            self.assertEqual(rpc.dispatch(app.epicTree, [1, 'add_directory', [self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID, 212, 'x']])[1], 400)
+            self.assertEqual(rpc.dispatch(app.epicTree, [1, 'get_breadcrumbs', [self.TREE_ID, self.SEGMENT_ID, [1]]])[1], 400)
+            self.assertEqual(rpc.dispatch(app.epicTree, [1, [], []]), [1, 400, 'Unknown method []'])
+            self.assertEqual(client.call('get_level', str(self.TREE_ID), self.SEGMENT_ID, self.ROOT_ID)[0][0], self.FIRST_DIR_ID)
+            # Sharded: trees of the other shards are refused, as by POST /tree
+            owner = sharding.shard_for_tree(302, 2)
+            self.assertEqual(rpc.dispatch(app.epicTree, [1, 'add_tree', [302]], (1 - owner, 2))[1], 421)
+            self.assertEqual(rpc.dispatch(app.epicTree, [1, 'get_trees', []], (1 - owner, 2))[1], 200)
+            self.assertEqual(rpc.dispatch(app.epicTree, [1, 'add_tree', [302]], (owner, 2)), [1, 200, True])
+            # Same tree as the HTTP API (and its change listeners)
+            self.assertEqual(app.epicTree.get_level(self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID)[0]['id'], self.FIRST_DIR_ID)
+        finally:
+            client.close()
+            io_loop.add_callback(io_loop.stop)
+            thread.join()
+            io_loop.close(all_fds=True)
+
+    def test_router(self):
+        """
+        Sharded router (sharding.make_router) in front of a shard: headers, global endpoints
+        """
+        shard_sock, shard_port = bind_unused_port()
+        router_sock, router_port = bind_unused_port()
+        io_loop = IOLoop()
+
+        def serve():
+            io_loop.make_current()
+            # As in production: the change feed's long-polls on Tornado, the rest on Flask
+            HTTPServer(tornado.web.Application([
+                (r'/tree/([0-9]+)/segment/([0-9]+)/changes', app.ChangesHandler, dict(feed=app.change_feed, read_changes=app.read_changes)),
+                (r'.*', tornado.web.FallbackHandler, dict(fallback=WSGIContainer(app.app))),
+            ])).add_socket(shard_sock)
+            HTTPServer(sharding.make_router(['http://127.0.0.1:' + str(shard_port)])).add_socket(router_sock)
+            io_loop.start()
+
+        def fetch(path, method='GET', body=None, timeout=10):
+            request = urllib2.Request('http://127.0.0.1:' + str(router_port) + path, body, {'Content-Type': 'application/json'})
+            request.get_method = lambda: method
+            try:
+                response = urllib2.urlopen(request, timeout=timeout)
+            except urllib2.HTTPError as inst:
+                response = inst
+            return response.getcode(), response.info(), response.read()
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        level_url = '/tree/' + str(self.TREE_ID) + '/segment/' + str(self.SEGMENT_ID) + '/level/' + str(self.ROOT_ID)
+        try:
+            code, headers, body = fetch(level_url)
+            self.assertEqual(code, 200)
+            self.assertEqual(headers['ETag'], self.app.get(level_url).headers['ETag'])
+            self.assertEqual(headers['Content-Type'], 'application/json')
+            # Every header of the shard is relayed (Retry-After of a rate limited request)
+            app.limiter.configure(True, 1.0 / 200000)
+            code, headers, body = fetch(level_url)
+            self.assertEqual(code, 429, body)
+            self.assertTrue(int(headers['Retry-After']) > 0)
+            app.limiter.configure()
+            # Global endpoints: merged, per shard, or rejected with where to ask
+            code, headers, body = fetch('/admin/usage')
+            self.assertEqual(json.loads(body)['response']['trees'][0]['tree_id'], self.TREE_ID)
+            code, headers, body = fetch('/admin/usage?tree_id=' + str(self.TREE_ID))
+            self.assertEqual(json.loads(body)['response']['nodes'], 2)
+            self.assertEqual(fetch('/metrics')[0], 400)
+            self.assertEqual(fetch('/admin/profile')[0], 400)
+            self.assertEqual(fetch('/shard/0/admin/profile')[0], 200)
+            self.assertEqual(fetch('/shard/1/admin/profile')[0], 404)
+            # IDs: reserved on the shard owning the tree
+            code, headers, body = fetch('/ids', 'POST', json.dumps(dict(tree_id=self.TREE_ID, count=10)))
+            self.assertEqual(code, 200)
+            self.assertEqual(fetch('/ids', 'POST', json.dumps(dict(count=10)))[0], 400)
+            # More long-polls than tornado's default 10 connections: the other requests still get through
+            segment_url = '/tree/' + str(self.TREE_ID) + '/segment/' + str(self.SEGMENT_ID)
+            changes_url = segment_url + '/changes?timeout=30&since=' + str(app.epicTree.version)
+            results = []
+            long_polls = [threading.Thread(target=lambda: results.append(fetch(changes_url, timeout=30))) for x in range(15)]
+            for long_poll in long_polls:
+                long_poll.start()
+            key = (self.TREE_ID, self.SEGMENT_ID)
+            for x in range(100):
+                if len(app.change_feed.waiters.get(key, [])) == len(long_polls):
+                    break
+                time.sleep(0.05)
+            self.assertEqual(len(app.change_feed.waiters.get(key, [])), len(long_polls))
+            self.assertEqual(fetch(level_url, timeout=5)[0], 200)
+            post_data = json.dumps(dict(parent_node_id=self.ROOT_ID, node_id=210, type='file', payload=1))
+            self.assertEqual(fetch(segment_url + '/node', 'POST', post_data, timeout=5)[0], 200)
+            for long_poll in long_polls:
+                long_poll.join()
+            self.assertEqual([json.loads(x[2])['response']['changes'][0]['node_id'] for x in results], [210] * len(long_polls))
+        finally:
+            app.limiter.configure()
+            io_loop.add_callback(io_loop.stop)
+            thread.join()
+            io_loop.close(all_fds=True)
+
+    # endregion
+
+    # region Snapshot
+
+    def test_snapshot(self):
+        test_file = "test.snapshot"
+        # Add a sub-directory with a node (string payload)
+        post_url = '/tree/' + str(self.TREE_ID) + '/segment/' + str(self.SEGMENT_ID) + '/'
+        post_data = json.dumps(dict(parent_node_id=self.FIRST_DIR_ID, node_id=210))
+        self.app.post(post_url + 'directory', data=post_data, content_type='application/json')
+        post_data = json.dumps(dict(parent_node_id=210, node_id=211, payload='lol', type='asset'))
+        self.app.post(post_url + 'node', data=post_data, content_type='application/json')
+        post_data = json.dumps(dict(parent_node_id=210, node_id=212, payload=15, type='asset', position=1))
+        self.app.post(post_url + 'node', data=post_data, content_type='application/json')
+        # Write + read back
+        snapshot.write_snapshot(app.epicTree.tree, test_file)
+        try:
+            view = snapshot.SnapshotReader(test_file).current()
+            self.assertEqual(view.get_trees(), [self.TREE_ID])
+            self.assertEqual(view.get_segments(self.TREE_ID), [self.SEGMENT_ID])
+            self.assertEqual(view.get_segment_root_node(self.TREE_ID, self.SEGMENT_ID), self.ROOT_ID)
+            for node_id in [self.ROOT_ID, self.FIRST_DIR_ID, 210]:
+                self.assertEqual(view.get_level(self.TREE_ID, self.SEGMENT_ID, node_id),
+                                 app.epicTree.get_level(self.TREE_ID, self.SEGMENT_ID, node_id))
+            self.assertEqual(view.get_breadcrumbs(self.TREE_ID, self.SEGMENT_ID, 211), [self.ROOT_ID, self.FIRST_DIR_ID, 210, 211])
+            self.assertEqual(view.segment(self.TREE_ID, self.SEGMENT_ID).to_dict(), app.epicTree.tree[self.TREE_ID][self.SEGMENT_ID])
+            self.assertRaises(KeyError, view.get_level, self.TREE_ID, self.SEGMENT_ID, 999)
+            view.close()
+        finally:
+            os.remove(test_file)
+
+    def test_as_of(self):
+        """
+        Endpoint: /tree/{ID}/segment/{ID}/level/{ID}, /tree/{ID}/segment/{ID}
+        Methods: ['GET']
+        Params: as_of (version) or as_of_time (unix time)
+        Responses: 200, 400, 404, 410
+        """
+        tree = app.epicTree
+        segment_url = '/tree/' + str(self.TREE_ID) + '/segment/' + str(self.SEGMENT_ID)
+        # Every version along a mix of appends, inserts (shifting sorts) and removals
+        exports = [(tree.version, tree.get_tree_from_segment(self.TREE_ID, self.SEGMENT_ID))]
+        random.seed(7)
+        for x in range(200):
+            nodes = tree.tree[self.TREE_ID][self.SEGMENT_ID]
+            directories = [k for k, v in nodes.items() if v[1] in ('root', 'dir')]
+            # Leaves only (removed directories leave their children behind)
+            others = [k for k, v in nodes.items() if v[1] != 'root' and not v[4]]
+            if len(others) > 3 and random.random() < 0.3:
+                tree.remove_node(self.TREE_ID, self.SEGMENT_ID, random.choice(others))
+            else:
+                node_type = random.choice(['dir', 'file'])
+                position = random.choice([None, 1, 2])
+                tree.add_node(self.TREE_ID, self.SEGMENT_ID, random.choice(directories), 1000 + x, position, None,
+                              node_type, None if node_type == 'dir' else x)
+            exports.append((tree.version, tree.get_tree_from_segment(self.TREE_ID, self.SEGMENT_ID)))
+        for version, export in exports:
+            nodes = tree.get_nodes_as_of(self.TREE_ID, self.SEGMENT_ID, version)
+            self.assertEqual(tree.get_tree_from_segment(self.TREE_ID, self.SEGMENT_ID, None, nodes), export)
+        # Routes
+        version = exports[0][0]
+        http_response = self.app.get(segment_url + '/level/' + str(self.FIRST_DIR_ID) + '?as_of=' + str(version),
+                                     follow_redirects=True)
+        self.assertEqual(json.loads(http_response.data)['response'], [])
+        http_response = self.app.get(segment_url + '?as_of=' + str(version), follow_redirects=True)
+        self.assertEqual(json.loads(http_response.data)['response'], exports[0][1])
+        http_response = self.app.get(segment_url + '?as_of_time=' + str(time.time() + 1), follow_redirects=True)
+        self.assertEqual(json.loads(http_response.data)['response'], exports[-1][1])
+        http_response = self.app.get(segment_url + '?as_of=x', follow_redirects=True)
+        self.assertEqual(http_response.status_code, 400)
+        # Older than what is kept (or than the segment)
+        tree.history.size = 10
+        tree.add_node(self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID, 2000, None, None, 'file', 1)
+        http_response = self.app.get(segment_url + '?as_of=' + str(version), follow_redirects=True)
+        self.assertEqual(http_response.status_code, 410)
+        tree.remove_segment(self.TREE_ID, self.SEGMENT_ID)
+        tree.add_segment(self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID)
+        http_response = self.app.get(segment_url + '?as_of=' + str(tree.version - 1), follow_redirects=True)
+        self.assertEqual(http_response.status_code, 410)
+        # History disabled ([History] Size=0): no past at all, nor before the changes made meanwhile once re-enabled
+        tree.history.size = 0
+        version = tree.version
+        tree.add_node(self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID, 2001, None, None, 'file', 1)
+        http_response = self.app.get(segment_url + '?as_of=' + str(version), follow_redirects=True)
+        self.assertEqual(http_response.status_code, 410)
+        http_response = self.app.get(segment_url + '?as_of_time=' + str(time.time() - 1), follow_redirects=True)
+        self.assertEqual(http_response.status_code, 410)
+        tree.history.size = 10
+        tree.add_node(self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID, 2002, None, None, 'file', 1)
+        http_response = self.app.get(segment_url + '?as_of=' + str(version), follow_redirects=True)
+        self.assertEqual(http_response.status_code, 410)
+        http_response = self.app.get(segment_url + '?as_of=' + str(tree.version - 1), follow_redirects=True)
+        self.assertEqual(http_response.status_code, 200)
+        self.assertFalse(2002 in [x['id'] for x in json.loads(http_response.data)['response']['children']])
+
+    def test_diff(self):
+        """
+        Endpoint: /tree/{ID}/segment/{ID}/diff
+        Methods: ['GET']
+        Params: from (segment ID), as_of / as_of_time, or file (+ from_segment)
+        Responses: 200, 400, 404, 410
+        """
+        tree = app.epicTree
+        segment_url = '/tree/' + str(self.TREE_ID) + '/segment/' + str(self.SEGMENT_ID)
+        # A template and its copy (same node IDs)
+        copy_id = 301
+        tree.add_segment(self.TREE_ID, copy_id, self.ROOT_ID)
+        tree.add_directory(self.TREE_ID, copy_id, self.ROOT_ID, self.FIRST_DIR_ID, None, None)
+        for segment_id in (self.SEGMENT_ID, copy_id):
+            for x in range(5):
+                tree.add_node(self.TREE_ID, segment_id, self.FIRST_DIR_ID, 210 + x, None, None, 'file', x)
+            tree.add_directory(self.TREE_ID, segment_id, self.ROOT_ID, 220, None, None)
+            tree.add_node(self.TREE_ID, segment_id, 220, 221, None, None, 'file', 'a')
+        result = tree.diff_segments(self.TREE_ID, self.SEGMENT_ID, copy_id)
+        self.assertEqual(result, {'added': [], 'removed': [], 'moved': [], 'resorted': [], 'changed': [], 'compared': 1})
+        version = tree.version
+        # Added, removed, inserted (re-sorting the level), moved (re-added elsewhere), changed (re-added)
+        tree.add_node(self.TREE_ID, copy_id, 220, 222, None, None, 'file', 'b')
+        tree.remove_node(self.TREE_ID, copy_id, 214)
+        tree.add_node(self.TREE_ID, copy_id, self.FIRST_DIR_ID, 215, 1, None, 'file', 'c')
+        tree.remove_node(self.TREE_ID, copy_id, 213)
+        tree.add_node(self.TREE_ID, copy_id, 220, 213, None, None, 'file', 3)
+        tree.remove_node(self.TREE_ID, copy_id, 221)
+        tree.add_node(self.TREE_ID, copy_id, 220, 221, 1, None, 'file', 'd')
+        result = tree.diff_segments(self.TREE_ID, self.SEGMENT_ID, copy_id)
+        self.assertEqual(sorted(result['added']), [215, 222])
+        self.assertEqual(result['removed'], [214])
+        self.assertEqual(result['moved'], [{'id': 213, 'from': self.FIRST_DIR_ID, 'to': 220}])
+        self.assertEqual(sorted((x['id'], x['from'], x['to']) for x in result['resorted']),
+                         [(210, 1, 2), (211, 2, 3), (212, 3, 4)])
+        self.assertEqual(result['changed'], [221])
+        # The hashes kept up to date are the ones a rebuild gives
+        nodes = tree.get_nodes(self.TREE_ID, copy_id)
+        self.assertEqual(tree.merkle.rebuilds, 2)
+        self.assertEqual(tree.merkle.hashes(self.TREE_ID, copy_id, nodes).entries, merkle.build_hashes(nodes).entries)
+        # Identical subtrees are skipped
+        for x in range(100):
+            tree.add_node(self.TREE_ID, copy_id, self.FIRST_DIR_ID, 1000 + x, None, None, 'file', x)
+            tree.add_node(self.TREE_ID, self.SEGMENT_ID, self.FIRST_DIR_ID, 1000 + x, None, None, 'file', x)
+        tree.add_node(self.TREE_ID, copy_id, 220, 223, None, None, 'file', 'e')
+        # The root, its children, the children 220 already had (not the 100 files under FIRST_DIR_ID)
+        self.assertEqual(tree.diff_as_of(self.TREE_ID, copy_id, tree.version - 1)['compared'], 6)
+        # Routes: since another segment, a version, a backup file
+        http_response = self.app.get(segment_url + '/diff?from=' + str(copy_id), follow_redirects=True)
+        self.assertEqual(sorted(json.loads(http_response.data)['response']['removed']), [215, 222, 223])
+        http_response = self.app.get('/tree/' + str(self.TREE_ID) + '/segment/' + str(copy_id) + '/diff?as_of=' +
+                                     str(version), follow_redirects=True)
+        self.assertEqual(sorted(json.loads(http_response.data)['response']['added']), [215, 222, 223] + list(range(1000, 1100)))
+        test_file = 'test.data'
+        self.app.post('/persist', data=json.dumps(dict(filename=test_file)), content_type='application/json')
+        try:
+            tree.remove_node(self.TREE_ID, self.SEGMENT_ID, 220)
+            http_response = self.app.get(segment_url + '/diff?file=' + test_file, follow_redirects=True)
+            self.assertEqual(sorted(json.loads(http_response.data)['response']['removed']), [220, 221])
+            http_response = self.app.get(segment_url + '/diff?file=' + test_file + '&from_segment=' + str(copy_id),
+                                         follow_redirects=True)
+            result = json.loads(http_response.data)['response']
+            self.assertEqual(sorted(result['removed']), [215, 220, 221, 222, 223])
+            self.assertEqual(result['moved'], [{'id': 213, 'from': 220, 'to': self.FIRST_DIR_ID}])
+        finally:
+            os.remove(test_file)
+        # Errors
+        for query, code in [('', 400), ('?from=1&as_of=1', 400), ('?file=../test.data', 400), ('?from=999', 404),
+                            ('?file=missing.data', 404)]:
+            http_response = self.app.get(segment_url + '/diff' + query, follow_redirects=True)
+            self.assertEqual(http_response.status_code, code)
+        tree.history.size = 1
+        tree.add_node(self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID, 2000, None, None, 'file', 1)
+        tree.add_node(self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID, 2001, None, None, 'file', 1)
+        http_response = self.app.get(segment_url + '/diff?as_of=' + str(version), follow_redirects=True)
+        self.assertEqual(http_response.status_code, 410)
+
+    def test_tiering(self):
+        tree = app.epicTree
+        segment_url = '/tree/' + str(self.TREE_ID) + '/segment/' + str(self.SEGMENT_ID)
+        tree.add_directory(self.TREE_ID, self.SEGMENT_ID, self.FIRST_DIR_ID, 210, None, None)
+        for x, payload in enumerate([1, 'text', {'a': [1, 2]}, None, True]):
+            tree.add_node(self.TREE_ID, self.SEGMENT_ID, 210, 220 + x, 1, None, 'file', payload)
+        before = tree.get_everything()
+        version = tree.version
+        level = self.app.get(segment_url + '/level/210', follow_redirects=True).data
+        # Only the segments idle for long enough are frozen
+        self.assertEqual(tree.freeze_idle(3600), 0)
+        self.assertEqual(tree.freeze_idle(3600, time.time() + 3600), 1)
+        nodes = tree.get_nodes(self.TREE_ID, self.SEGMENT_ID)
+        self.assertTrue(isinstance(nodes, snapshot.FrozenSegment))
+        self.assertEqual(tree.get_frozen_segments(), [(self.TREE_ID, self.SEGMENT_ID)])
+        # Read as before, without thawing
+        self.assertEqual(tree.get_everything(), before)
+        self.assertEqual(self.app.get(segment_url + '/level/210', follow_redirects=True).data, level)
+        self.assertEqual(tree.get_breadcrumbs(self.TREE_ID, self.SEGMENT_ID, 222), [self.ROOT_ID, self.FIRST_DIR_ID, 210, 222])
+        self.assertTrue(tree.is_descendant(self.TREE_ID, self.SEGMENT_ID, 224, self.FIRST_DIR_ID))
+        self.assertRaises(KeyError, tree.get_level, self.TREE_ID, self.SEGMENT_ID, 999)
+        test_file = 'test.data'
+        try:
+            snapshot.write_snapshot(tree.tree, test_file)
+            self.assertEqual(epictree.EpicTree(test_file).get_everything(), before)
+        finally:
+            os.remove(test_file)
+        self.assertTrue(tree.get_nodes(self.TREE_ID, self.SEGMENT_ID) is nodes)
+        # Thawed by the next write
+        post_data = json.dumps(dict(parent_node_id=210, node_id=230, type='file', payload='new'))
+        http_response = self.app.post(segment_url + '/node', data=post_data, content_type='application/json')
+        self.assertEqual(http_response.status_code, 200)
+        self.assertEqual(type(tree.get_nodes(self.TREE_ID, self.SEGMENT_ID)), dict)
+        self.assertEqual(tree.get_frozen_segments(), [])
+        self.assertEqual(tree.version, version + 1)
+        self.assertEqual(tree.get_level(self.TREE_ID, self.SEGMENT_ID, 210)[-1], {'id': 230, 'child': (210, 'file', 'new', 6, None)})
+        self.assertEqual(tree.get_tree_from_segment(self.TREE_ID, self.SEGMENT_ID, None, tree.get_nodes_as_of(self.TREE_ID, self.SEGMENT_ID, version)),
+                         before[self.TREE_ID][self.SEGMENT_ID])
+        # A batch per call: at least one segment, then up to max_nodes
+        for segment_id in (1, 2, 3):
+            tree.add_segment(self.TREE_ID, segment_id, 1)
+        self.assertEqual([tree.freeze_idle(0, max_nodes=1) for x in range(3)], [1, 1, 1])
+        self.assertEqual(tree.freeze_idle(0), 1)
+        self.assertEqual(len(tree.get_frozen_segments()), 4)
+        # The sort helpers resolve the segment as the writes do (thawed, never the frozen storage)
+        tree._re_sort_level(self.TREE_ID, self.SEGMENT_ID, 210)
+        self.assertEqual(type(tree.get_nodes(self.TREE_ID, self.SEGMENT_ID)), dict)
+        self.assertEqual(tree._get_max_sort_at_level(self.TREE_ID, self.SEGMENT_ID, [230]), 6)
+
+    def test_usage(self):
+        """
+        Endpoint: /admin/usage
+        Methods: ['GET']
+        Params: tree_id (optional)
+        Responses: 200, 404 (507 from the writes over a quota)
+        """
+        tree = app.epicTree
+        segment_url = '/tree/' + str(self.TREE_ID) + '/segment/' + str(self.SEGMENT_ID)
+        recount = lambda: usage.UsageAccounting().get_usage(self.TREE_ID, tree.tree[self.TREE_ID])
+        # Counted once, then kept up to date by the writes (same as counting again)
+        self.assertEqual(tree.get_usage(self.TREE_ID)['nodes'], 2)
+        tree.add_directory(self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID, 210, None, None)
+        for x, payload in enumerate([1, 'text', {'a': [1, 2]}, None]):
+            tree.add_node(self.TREE_ID, self.SEGMENT_ID, 210, 220 + x, 1, None, 'file', payload)
+        tree.remove_node(self.TREE_ID, self.SEGMENT_ID, 221)
+        tree.add_segment(self.TREE_ID, 1, 1)
+        tree.duplicate_segment(self.TREE_ID, self.SEGMENT_ID, 2, None)
+        tree.remove_segment(self.TREE_ID, 1)
+        self.assertEqual(tree.usage.trees[self.TREE_ID][:2], [recount()['nodes'], recount()['bytes']])
+        self.assertEqual(tree.get_usage(self.TREE_ID), recount())
+        self.assertEqual(tree.get_usage(self.TREE_ID)['nodes'], 12)
+        # Frozen: its arrays are counted instead
+        tree.freeze_idle(0)
+        result = tree.get_usage(self.TREE_ID, True)
+        self.assertEqual(result['nodes'], 12)
+        self.assertEqual(result['segments'][self.SEGMENT_ID]['form'], 'frozen')
+        frozen = tree.get_nodes(self.TREE_ID, self.SEGMENT_ID)
+        self.assertEqual(result['segments'][self.SEGMENT_ID]['bytes'], frozen.get_size())
+        self.assertTrue(frozen.get_size() < usage.segment_bytes(frozen.to_dict()))
+        # Quotas: the write over it is rejected, the tree is left as it was
+        tree.set_quotas(13)
+        tree.add_node(self.TREE_ID, self.SEGMENT_ID, 210, 230, None, None, 'file', 1)
+        before = tree.get_everything()
+        version = tree.version
+        post_data = json.dumps(dict(parent_node_id=210, node_id=231, type='file', payload=1))
+        http_response = self.app.post(segment_url + '/node', data=post_data, content_type='application/json')
+        self.assertEqual(http_response.status_code, 507)
+        self.assertEqual(json.loads(http_response.data)['meta']['code'], 507)
+        post_data = json.dumps(dict(segment_id=3, root_node_id=1))
+        http_response = self.app.post('/tree/' + str(self.TREE_ID) + '/segment', data=post_data, content_type='application/json')
+        self.assertEqual(http_response.status_code, 507)
+        post_data = json.dumps(dict(parent_node_id=210, node_id=231))
+        http_response = self.app.post(segment_url + '/directory', data=post_data, content_type='application/json')
+        self.assertEqual(http_response.status_code, 507)
+        post_data = json.dumps(dict(to_segment_id=3))
+        http_response = self.app.post(segment_url + '/duplicate', data=post_data, content_type='application/json')
+        self.assertEqual(http_response.status_code, 507)
+        self.assertEqual(rpc.dispatch(tree, [1, 'add_node', [self.TREE_ID, self.SEGMENT_ID, 210, 231, 'file', 1]])[1], 507)
+        self.assertEqual(tree.get_everything(), before)
+        self.assertEqual(tree.version, version)
+        # Removing makes room, tenant scales and memory quotas
+        tree.remove_node(self.TREE_ID, self.SEGMENT_ID, 230)
+        tree.add_node(self.TREE_ID, self.SEGMENT_ID, 210, 231, None, None, 'file', 1)
+        tree.set_quotas(13, 0, {self.TREE_ID: 2})
+        tree.add_node(self.TREE_ID, self.SEGMENT_ID, 210, 232, None, None, 'file', 1)
+        self.assertEqual(tree.get_usage(self.TREE_ID)['max_nodes'], 26)
+        tree.set_quotas(0, tree.get_usage(self.TREE_ID)['bytes'] + 300)
+        self.assertRaises(usage.QuotaExceeded, tree.add_node, self.TREE_ID, self.SEGMENT_ID, 210, 233, None, None, 'file', 'x' * 100)
+        tree.add_node(self.TREE_ID, self.SEGMENT_ID, 210, 233, None, None, 'file', None)
+        # Admin endpoint: every tree (largest first), or one tree with its segments
+        tree.add_tree(1)
+        result = json.loads(self.app.get('/admin/usage').data)['response']
+        self.assertEqual([x['tree_id'] for x in result['trees']], [self.TREE_ID, 1])
+        self.assertEqual(result['nodes'], 15)
+        self.assertEqual(result['trees'][0], dict(tree_id=self.TREE_ID, **tree.get_usage(self.TREE_ID)))
+        result = json.loads(self.app.get('/admin/usage?tree_id=' + str(self.TREE_ID)).data)['response']
+        self.assertEqual([x['segment_id'] for x in result['segments']], [2, self.SEGMENT_ID])
+        self.assertEqual(self.app.get('/admin/usage?tree_id=999').status_code, 404)
+
+    def test_usage_snapshot(self):
+        # Segments loaded from a snapshot count 0 bytes until they are decoded, then as what they are
+        tree = app.epicTree
+        for x in range(20):
+            tree.add_node(self.TREE_ID, self.SEGMENT_ID, self.FIRST_DIR_ID, 210 + x, None, None, 'file', 'payload ' + str(x))
+        tree.duplicate_segment(self.TREE_ID, self.SEGMENT_ID, 1, None)
+        test_file = 'test.data'
+        try:
+            snapshot.write_snapshot(tree.tree, test_file)
+            loaded = epictree.EpicTree(test_file)
+            loaded.set_quotas(0, 10 ** 9)
+            self.assertEqual(loaded.get_usage(self.TREE_ID)['bytes'], 0)
+            loaded.get_level(self.TREE_ID, 1, self.FIRST_DIR_ID)
+            loaded.add_node(self.TREE_ID, self.SEGMENT_ID, self.FIRST_DIR_ID, 230, None, None, 'file', 1)
+            fresh = usage.UsageAccounting().get_usage(self.TREE_ID, loaded.tree[self.TREE_ID])
+            self.assertEqual(loaded.usage.trees[self.TREE_ID][:2], [fresh['nodes'], fresh['bytes']])
+            # The memory quota sees the decoded segments
+            loaded.set_quotas(0, fresh['bytes'] + 100)
+            self.assertRaises(usage.QuotaExceeded, loaded.add_node, self.TREE_ID, self.SEGMENT_ID, self.FIRST_DIR_ID, 231, None, None, 'file', 1)
+        finally:
+            os.remove(test_file)
+
+    def test_pin_snapshot(self):
+        # Segments still encoded (loaded from a snapshot) are pinned as they are, nothing is decoded
+        tree = app.epicTree
+        tree.add_node(self.TREE_ID, self.SEGMENT_ID, self.FIRST_DIR_ID, 210, None, None, 'file', 'a')
+        test_file = 'test.data'
+        copy_file = 'test_copy.data'
+        try:
+            snapshot.write_snapshot(tree.tree, test_file)
+            loaded = epictree.EpicTree(test_file)
+            with loaded.pin() as pinned:
+                encoded = dict.__getitem__(loaded.tree[self.TREE_ID], self.SEGMENT_ID)
+                self.assertTrue(isinstance(encoded, snapshot.SnapshotSegment))
+                self.assertTrue(dict.__getitem__(pinned.tree[self.TREE_ID], self.SEGMENT_ID) is encoded)
+                snapshot.write_snapshot(pinned.tree, copy_file)
+                self.assertTrue(dict.__getitem__(loaded.tree[self.TREE_ID], self.SEGMENT_ID) is encoded)
+                self.assertEqual(loaded.get_everything(pinned), tree.get_everything())
+            self.assertEqual(epictree.EpicTree(copy_file).get_everything(), tree.get_everything())
+        finally:
+            os.remove(test_file)
+            if os.path.exists(copy_file):
+                os.remove(copy_file)
+
+    def test_pin(self):
+        tree = app.epicTree
+        for x in range(5):
+            tree.add_node(self.TREE_ID, self.SEGMENT_ID, self.FIRST_DIR_ID, 210 + x, None, None, 'file', x)
+        before = tree.get_everything()
+        level = tree.get_level(self.TREE_ID, self.SEGMENT_ID, self.FIRST_DIR_ID)
+        pinned = tree.pin()
+        nodes = pinned.tree[self.TREE_ID][self.SEGMENT_ID]
+        # Adds (shifting the sort of the level), removals, a removed segment: none of it is seen through the pin
+        tree.add_node(self.TREE_ID, self.SEGMENT_ID, self.FIRST_DIR_ID, 220, 1, None, 'file', 'new')
+        tree.remove_node(self.TREE_ID, self.SEGMENT_ID, 212)
+        tree.add_directory(self.TREE_ID, self.SEGMENT_ID, self.ROOT_ID, 221, None, None)
+        self.assertEqual(tree.get_level(self.TREE_ID, self.SEGMENT_ID, self.FIRST_DIR_ID, nodes), level)
+        self.assertEqual(tree.get_everything(pinned), before)
+        self.assertFalse(221 in nodes)
+        self.assertEqual(sorted(nodes.keys()), [self.ROOT_ID, self.FIRST_DIR_ID] + list(range(210, 215)))
+        tree.remove_segment(self.TREE_ID, self.SEGMENT_ID)
+        self.assertEqual(tree.get_everything(pinned), before)
+        # A second pin sees the tree as it was when it was pinned
+        tree.add_segment(self.TREE_ID, 1, 1)
+        second = tree.pin(self.TREE_ID)
+        tree.add_node(self.TREE_ID, 1, 1, 2, None, None, 'file', 'new')
+        self.assertEqual(dict(second.tree[self.TREE_ID][1].items()), {1: (None, 'root', None, 1, None)})
+        # Released: the histories are dropped
+        pinned.release()
+        second.release()
+        self.assertEqual(tree.pins.histories, {})
+        # Exported in another thread while the tree changes
+        before = tree.get_tree_from_segment(self.TREE_ID, 1)
+        with tree.pin(self.TREE_ID, 1) as pinned:
+            exported = []
+            thread = threading.Thread(target=lambda: exported.append(tree.get_everything(pinned)))
+            thread.start()
+            for x in range(3, 500):
+                tree.add_node(self.TREE_ID, 1, 1, x, 1, None, 'file', x)
+            thread.join()
+        self.assertEqual(exported[0], {self.TREE_ID: {1: before}})
+
     # endregion
 
 if __name__ == '__main__':
@@ -0,0 +1,171 @@
+"""
+Time travel: reads of a segment as it was at a past version (of the tree clock) or time
+
+EpicTree hands every add_node / remove_node its undo: the old values of the nodes it replaces (MISSING: added), what it
+does to the parent's children list (append / remove at an index) and to the siblings' sorts (moved by one from a sort
+on, or their old sorts when a re-sort did more than that).
+A segment at a past version is the live segment with the undos of the changes since, newest first, applied to an
+overlay: reading it costs the changes since that version (plus a copy of the children lists they touched), not a
+reload. The live segment is the base, so no full copies are kept.
+
+History is bounded per segment (Size changes, Seconds old): a version older than what is kept, or than the last time
+the segment was replaced as a whole (added, removed, duplicated onto, cleared...), or than the last change made while
+history was disabled (Size 0), raises HistoryExpired. With history disabled, every read of the past does.
+"""
+
+# Standard libraries
+from collections import deque
+import time
+
+# Value of a node that didn't exist yet
+MISSING = object()
+
+class HistoryExpired(Exception):
+    """The changes since that version / time are no longer kept"""
+
+class ChangeHistory:
+    """Undo log per segment (record from EpicTree, record_change as its listener for whole-segment changes)"""
+
+    def __init__(self, size=1000, max_age=86400):
+        self.size = size
+        self.max_age = max_age
+        # (tree_id, segment_id) => deque of (version, time, undo ops), oldest first
+        self.entries = {}
+        # Can't go back before: (version, time) per segment, per tree, everything
+        self.horizons = {}
+        self.tree_horizons = {}
+        self.horizon = (0, time.time())
+
+    def record(self, tree_id, segment_id, version, ops):
+        """
+        Undo of the change of this version, ops applied last to first:
+        ('node', node_id, old value), ('append', parent, child), ('remove', parent, child, index),
+        ('sort', parent, threshold, delta): the children with sort >= threshold (now) were moved by delta
+        """
+        if self.size <= 0:
+            return
+        now = time.time()
+        key = (tree_id, segment_id)
+        entries = self.entries.get(key)
+        if entries is None:
+            entries = deque()
+            self.entries[key] = entries
+        while len(entries) > 0 and (len(entries) >= self.size or entries[0][1] < now - self.max_age):
+            dropped = entries.popleft()
+            self.horizons[key] = (dropped[0], dropped[1])
+        entries.append((version, now, ops))
+        return
+
+    def record_change(self, tree_id, segment_id, node_ids, change):
+        """EpicTree listener: segments replaced as a whole (or any change while disabled) can't be rebuilt from before"""
+        horizon = (change['version'], time.time())
+        if self.size <= 0:
+            # Not recorded: nothing before it can be rebuilt (if history is turned back on)
+            self.horizon = horizon
+        if tree_id is None:
+            self.entries = {}
+            self.horizons = {}
+            self.tree_horizons = {}
+            self.horizon = horizon
+        elif segment_id is None:
+            self.tree_horizons[tree_id] = horizon
+            for key in [x for x in self.entries if x[0] == tree_id]:
+                del self.entries[key]
+        elif change['op'] in ('add_segment', 'remove_segment', 'duplicate_segment'):
+            self.entries.pop((tree_id, segment_id), None)
+            self.horizons[(tree_id, segment_id)] = horizon
+        return
+
+    def view(self, tree_id, segment_id, nodes, version=None, timestamp=None):
+        """The segment (nodes: its live dict) at a version or a time: AsOfView, usable as nodes= by the readers"""
+        if self.size <= 0:
+            raise HistoryExpired('History is disabled')
+        key = (tree_id, segment_id)
+        horizons = [self.horizon, self.tree_horizons.get(tree_id, (0, 0)), self.horizons.get(key, (0, 0))]
+        for horizon_version, horizon_time in horizons:
+            if (version is not None and version < horizon_version) or (timestamp is not None and timestamp < horizon_time):
+                raise HistoryExpired('Segment ' + str(segment_id) + ' history doesn\'t go back that far')
+        state = {}
+        owned = set()
+        for entry_version, entry_time, ops in reversed(self.entries.get(key, ())):
+            if (version is not None and entry_version <= version) or (timestamp is not None and entry_time <= timestamp):
+                break
+            for op in reversed(ops):
+                _undo(state, owned, nodes, op)
+        return AsOfView(nodes, state)
+
+class AsOfView:
+    """Read-only {node_id: node} of a segment in the past: the nodes changed since from the overlay, others live"""
+
+    def __init__(self, nodes, state):
+        self.nodes = nodes
+        self.state = state
+
+    def get(self, node_id, default=None):
+        value = self.state[node_id] if node_id in self.state else self.nodes.get(node_id, MISSING)
+        return default if value is MISSING else value
+
+    def __getitem__(self, node_id):
+        value = self.get(node_id, MISSING)
+        if value is MISSING:
+            raise KeyError(node_id)
+        return value
+
+    def __contains__(self, node_id):
+        return self.get(node_id, MISSING) is not MISSING
+
+    def keys(self):
+        node_ids = set(self.nodes.keys())
+        node_ids.update(self.state.keys())
+        return [x for x in node_ids if x in self]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(x, self[x]) for x in self.keys()]
+
+def _current(state, nodes, node_id):
+    return state[node_id] if node_id in state else nodes.get(node_id, MISSING)
+
+def _own_children(state, owned, nodes, node_id):
+    """Children list of node_id in the overlay, copied the first time it is changed"""
+    node = _current(state, nodes, node_id)
+    if node_id not in owned:
+        node = node[:4] + ([] if node[4] is None else list(node[4]),)
+        state[node_id] = node
+        owned.add(node_id)
+    return node[4]
+
+def _undo(state, owned, nodes, op):
+    if op[0] == 'node':
+        node_id, old = op[1], op[2]
+        current = _current(state, nodes, node_id)
+        if old is MISSING or old[4] is None or current is MISSING or current[4] is None:
+            # Its list (if any) is the one it had then: removed nodes' lists don't change anymore
+            state[node_id] = old
+            owned.discard(node_id)
+        else:
+            # Children lists are changed in place, the append / remove ops rebuild them
+            state[node_id] = old[:4] + (current[4],)
+    elif op[0] == 'append':
+        children = _own_children(state, owned, nodes, op[1])
+        if len(children) > 0 and children[-1] == op[2]:
+            children.pop()
+        elif op[2] in children:
+            children.reverse()
+            children.remove(op[2])
+            children.reverse()
+    elif op[0] == 'remove':
+        _own_children(state, owned, nodes, op[1]).insert(op[3], op[2])
+    elif op[0] == 'sort':
+        # The children with sort >= threshold were moved by delta
+        parent, threshold, delta = op[1], op[2], op[3]
+        for child_id in _current(state, nodes, parent)[4] or ():
+            child = _current(state, nodes, child_id)
+            if child is not MISSING and child[3] >= threshold:
+                state[child_id] = child[:3] + (child[3] - delta, child[4])
+    return
@@ -0,0 +1,194 @@
+"""
+Approximate memory and node counts per tree (tenant) and segment, and the node / memory quotas of the trees
+
+A tree is counted once (on its first quota check, or when its usage is asked for), then EpicTree keeps the counts up
+to date on every write (add / remove node directly, whole segments and trees through the record listener), so a quota
+check is O(1). Memory is an estimate of the Python objects of a segment, by storage form:
+    dict        NODE_BYTES per node (dict slot, ID, tuple, parent ID) + its payload + its children list
+    frozen      its arrays and payload blob (see snapshot.FrozenSegment)
+    encoded     0: loaded from a snapshot / segments directory and not decoded yet (mapped or still on disk)
+(1M nodes with int payloads and 10 children per directory take ~268 bytes per node of RSS, the estimate ~267.)
+A segment frozen / thawed / duplicated is counted again by EpicTree, a segment decoded since it was counted (LazySegments
+keeps a list of them) on the next quota check or usage read.
+"""
+
+# Standard libraries
+import json
+import sys
+
+from snapshot import FrozenSegment, segment_node_count
+
+NODE_BYTES = 230
+LIST_BYTES = 72
+POINTER_BYTES = 8
+
+class QuotaExceeded(Exception):
+    """A write would take a tree over its node or memory quota (507 in the API)"""
+
+def payload_bytes(payload):
+    if payload is None or payload is True or payload is False:
+        return 0
+    if isinstance(payload, (int, long, float, basestring)):
+        return sys.getsizeof(payload)
+    # Lists / dicts: about twice their JSON
+    return 2 * len(json.dumps(payload))
+
+def node_bytes(node):
+    """Estimated bytes of a node of a segment dict (its children, but not the pointer to it in its parent's list)"""
+    size = NODE_BYTES + payload_bytes(node[2])
+    if node[4] is not None:
+        size += LIST_BYTES + POINTER_BYTES * len(node[4])
+    return size
+
+def added_node_bytes(node, parent_node):
+    """Estimated bytes a new node adds to a segment dict: the node + its pointer in its parent's list (new or not)"""
+    size = node_bytes(node) + POINTER_BYTES
+    if parent_node[4] is None:
+        size += LIST_BYTES
+    return size
+
+def segment_bytes(nodes):
+    if isinstance(nodes, FrozenSegment):
+        return nodes.get_size()
+    if isinstance(nodes, dict):
+        return sum(node_bytes(x) for x in nodes.itervalues())
+    return 0
+
+def segment_form(nodes):
+    if isinstance(nodes, FrozenSegment):
+        return 'frozen'
+    if isinstance(nodes, dict):
+        return 'dict'
+    return 'encoded'
+
+def count_segment(nodes):
+    """[nodes, bytes, id of the storage counted]"""
+    return [segment_node_count(nodes), segment_bytes(nodes), id(nodes)]
+
+class UsageAccounting:
+    """
+    Counts of the counted trees: trees {tree_id: [nodes, bytes, id of the segments dict counted]},
+    segments {tree_id: {segment_id: [nodes, bytes, id of the storage counted]}}
+    """
+
+    def __init__(self, max_nodes=0, max_bytes=0, tenant_scales=None):
+        self.trees = {}
+        self.segments = {}
+        self.configure(max_nodes, max_bytes, tenant_scales)
+
+    def configure(self, max_nodes=0, max_bytes=0, tenant_scales=None):
+        """Quotas per tree (0: none), tenant_scales {tree_id: scale} (see ratelimit.parse_tenant_scales)"""
+        self.max_nodes = max_nodes
+        self.max_bytes = max_bytes
+        self.tenant_scales = tenant_scales or {}
+        self.enabled = max_nodes > 0 or max_bytes > 0
+        return
+
+    def get_quota(self, tree_id):
+        """(max nodes, max bytes) of a tree, None: no quota"""
+        scale = self.tenant_scales.get(tree_id, 1.0)
+        max_nodes = int(self.max_nodes * scale) if self.max_nodes > 0 else None
+        max_bytes = int(self.max_bytes * scale) if self.max_bytes > 0 else None
+        return max_nodes, max_bytes
+
+    def check(self, tree_id, segments, node_count, size):
+        """Raise QuotaExceeded if adding node_count nodes / size bytes would take the tree over its quota"""
+        if not self.enabled:
+            return
+        max_nodes, max_bytes = self.get_quota(tree_id)
+        tree = self._get_tree(tree_id, segments)
+        if max_nodes is not None and tree[0] + node_count > max_nodes:
+            raise QuotaExceeded('Tree ' + str(tree_id) + ' would go over its quota of ' + str(max_nodes) + ' nodes')
+        if max_bytes is not None and tree[1] + size > max_bytes:
+            raise QuotaExceeded('Tree ' + str(tree_id) + ' would go over its quota of ' + str(max_bytes) + ' bytes')
+        return
+
+    def add(self, tree_id, segment_id, node_count, size):
+        """A write added (negative: removed) nodes / bytes to a segment (nothing to do if its tree isn't counted)"""
+        tree = self.trees.get(tree_id)
+        if tree is None:
+            return
+        tree[0] += node_count
+        tree[1] += size
+        counted = self.segments[tree_id].get(segment_id)
+        if counted is not None:
+            counted[0] += node_count
+            counted[1] += size
+        return
+
+    def replace(self, tree_id, segment_id, nodes):
+        """A segment stored as a whole (frozen / thawed, a duplicate): counted again"""
+        if tree_id in self.trees:
+            self._recount(tree_id, segment_id, nodes)
+        return
+
+    def get_usage(self, tree_id, segments, segment_details=False):
+        """{nodes, bytes, max_nodes, max_bytes (None: no quota)} of a tree (+ segments {segment_id: {nodes, bytes, form}})"""
+        self._get_tree(tree_id, segments)
+        counted = self.segments[tree_id]
+        # Segments decoded / frozen / thawed since they were counted (or changed behind EpicTree's back)
+        for segment_id, nodes in iter(dict.items(segments)):
+            if segment_id not in counted or counted[segment_id][2] != id(nodes):
+                self._recount(tree_id, segment_id, nodes)
+        for segment_id in [x for x in counted if x not in segments]:
+            self._recount(tree_id, segment_id, None)
+        tree = self.trees[tree_id]
+        max_nodes, max_bytes = self.get_quota(tree_id)
+        usage = {'nodes': tree[0], 'bytes': tree[1], 'max_nodes': max_nodes, 'max_bytes': max_bytes}
+        if segment_details:
+            usage['segments'] = dict((segment_id, {
+                'nodes': counted[segment_id][0], 'bytes': counted[segment_id][1], 'form': segment_form(nodes)
+            }) for segment_id, nodes in iter(dict.items(segments)))
+        return usage
+
+    def record(self, tree_id, segment_id, node_ids, change):
+        """EpicTree listener: whole segments / trees (the node writes are counted by EpicTree itself, see add)"""
+        op = change['op']
+        if op == 'clear':
+            self.trees = {}
+            self.segments = {}
+        elif op == 'remove_tree':
+            self.trees.pop(tree_id, None)
+            self.segments.pop(tree_id, None)
+        elif tree_id in self.trees:
+            if op == 'add_segment':
+                # id None: counted again (one node) when its usage is read
+                self._set(tree_id, segment_id, [1, NODE_BYTES, None])
+            elif op == 'remove_segment':
+                self._set(tree_id, segment_id, None)
+        return
+
+    def _get_tree(self, tree_id, segments):
+        """[nodes, bytes, id] of a tree, counted if it wasn't (or if its segments dict was replaced)"""
+        tree = self.trees.get(tree_id)
+        decoded = getattr(segments, 'decoded', None)
+        if tree is None or tree[2] != id(segments):
+            counted = dict((segment_id, count_segment(nodes)) for segment_id, nodes in iter(dict.items(segments)))
+            tree = [sum(x[0] for x in counted.values()), sum(x[1] for x in counted.values()), id(segments)]
+            self.trees[tree_id] = tree
+            self.segments[tree_id] = counted
+        elif decoded:
+            # Counted while still encoded (0 bytes)
+            for segment_id in decoded:
+                if segment_id in segments:
+                    self._recount(tree_id, segment_id, dict.get(segments, segment_id))
+        if decoded:
+            del decoded[:]
+        return tree
+
+    def _recount(self, tree_id, segment_id, nodes):
+        self._set(tree_id, segment_id, None if nodes is None else count_segment(nodes))
+        return
+
+    def _set(self, tree_id, segment_id, counted):
+        """Replace the counts of a segment (None: removed) and the tree's totals"""
+        tree = self.trees[tree_id]
+        old = self.segments[tree_id].pop(segment_id, None)
+        if old is not None:
+            tree[0] -= old[0]
+            tree[1] -= old[1]
+        if counted is not None:
+            self.segments[tree_id][segment_id] = counted
+            tree[0] += counted[0]
+            tree[1] += counted[1]
+        return